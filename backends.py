@@ -0,0 +1,323 @@
+"""
+State backends: sessions, processed-message dedup and per-phone locking.
+
+  sqlite  - default, state in Config.DB_PATH. Single process, or several
+            processes on one host with STATE_SHARED=true.
+  memory  - everything in-process (development, tests). Single process only.
+  redis   - any Redis-protocol server (Redis, Valkey, KeyDB, ...). Shared
+            across workers and hosts. Needs the 'redis' package.
+
+Leads, email_log etc. always stay in SQLite; only hot conversation state is
+pluggable.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from config import Config
+import database
+from phone_locks import PhoneLocks
+
+logger = logging.getLogger(__name__)
+
+
+class StateBackend:
+    name = "base"
+    # True: andere Prozesse sehen denselben State -> kein Write-Behind über Turns hinweg
+    shared = False
+
+    def __init__(self):
+        self.local_locks = PhoneLocks()
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    # --- Sessions ---
+
+    async def get_session(self, phone):
+        """Return (step, context, language); ("START", {}, None) if unknown."""
+        raise NotImplementedError
+
+    async def save_sessions(self, rows):
+        """Upsert (phone, step, context, language) rows. language=None keeps the stored one."""
+        raise NotImplementedError
+
+    async def complete_lead(self, phone, ctx, lang, msg_id):
+        """Store the lead and set the session to COMPLETED. `msg_id` is the message
+        that finished the lead; a repeated call for it queues no second mail."""
+        await database.save_lead(phone, ctx, lang, msg_id)
+        await self.save_sessions([(phone, "COMPLETED", {}, lang)])
+
+    async def delete_user_data(self, phone, trigger=None):
+        """Delete session and lead, mark email_log entries, queue the deletion mail
+        if `trigger` is given. Returns the lead data or None."""
+        raise NotImplementedError
+
+    # --- Dedup ---
+
+    async def claim_messages(self, msg_ids):
+        """Atomically mark IDs as processed; return the set of IDs nobody claimed before."""
+        raise NotImplementedError
+
+    async def mark_messages(self, msg_ids):
+        """Persist IDs that were already deduplicated locally (write-behind)."""
+        await self.claim_messages(msg_ids)
+
+    async def release_messages(self, msg_ids):
+        """Undo claim_messages for IDs whose message could not be queued, so a redelivery is processed."""
+        raise NotImplementedError
+
+    async def recent_message_ids(self, seconds):
+        """(msg_id, age_in_seconds) of the last `seconds`, oldest first, for cache warmup."""
+        return []
+
+    # --- Locking ---
+
+    @asynccontextmanager
+    async def lock(self, phone):
+        """Serialize conversation turns of one phone."""
+        async with self.local_locks.lock(phone):
+            yield
+
+
+class SQLiteBackend(StateBackend):
+    name = "sqlite"
+
+    def __init__(self, shared=None):
+        super().__init__()
+        self.shared = Config.STATE_SHARED if shared is None else shared
+        self.owner = uuid.uuid4().hex
+
+    async def get_session(self, phone):
+        return await database.get_session(phone)
+
+    async def save_sessions(self, rows):
+        await database.save_sessions(rows)
+
+    async def complete_lead(self, phone, ctx, lang, msg_id):
+        # Lead + Session in einer Transaktion
+        await database.complete_lead(phone, ctx, lang, msg_id)
+
+    async def delete_user_data(self, phone, trigger=None):
+        return await database.delete_user_data(phone, trigger)
+
+    async def claim_messages(self, msg_ids):
+        return await database.filter_new_messages(msg_ids)
+
+    async def mark_messages(self, msg_ids):
+        await database.mark_msgs_processed(msg_ids)
+
+    async def release_messages(self, msg_ids):
+        await database.forget_msgs(msg_ids)
+
+    async def recent_message_ids(self, seconds):
+        return await database.recent_processed_ids(seconds)
+
+    @asynccontextmanager
+    async def lock(self, phone):
+        # Lokaler Lock zuerst, damit Wartende im selben Prozess nicht die DB pollen
+        async with self.local_locks.lock(phone):
+            if not self.shared:
+                yield
+                return
+            await _acquire(lambda: database.try_lock_phone(phone, self.owner, time.time(), Config.LOCK_TTL), phone)
+            keeper = asyncio.create_task(_keep(
+                lambda: database.renew_phone_lock(phone, self.owner, time.time() + Config.LOCK_TTL), phone))
+            try:
+                yield
+            finally:
+                keeper.cancel()
+                await database.unlock_phone(phone, self.owner)
+
+
+class MemoryBackend(StateBackend):
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self._sessions = {}
+        self._processed = {}  # msg_id -> timestamp
+
+    async def get_session(self, phone):
+        step, ctx, lang = self._sessions.get(phone, ("START", {}, None))
+        return step, json.loads(json.dumps(ctx)), lang
+
+    async def save_sessions(self, rows):
+        for phone, step, ctx, lang in rows:
+            if lang is None:
+                lang = self._sessions.get(phone, (None, None, None))[2] or "en"
+            self._sessions[phone] = (step, json.loads(json.dumps(ctx)), lang)
+
+    async def delete_user_data(self, phone, trigger=None):
+        self._sessions.pop(phone, None)
+        return await database.delete_user_data(phone, trigger)
+
+    async def claim_messages(self, msg_ids):
+        now = time.time()
+        cutoff = now - Config.DEDUP_TTL_SECONDS
+        # Abgelaufene IDs vorne abschneiden (dict ist nach Einfügezeit sortiert)
+        while self._processed:
+            first = next(iter(self._processed))
+            if self._processed[first] >= cutoff:
+                break
+            del self._processed[first]
+        new = set()
+        for msg_id in msg_ids:
+            if msg_id not in self._processed:
+                self._processed[msg_id] = now
+                new.add(msg_id)
+        return new
+
+    async def release_messages(self, msg_ids):
+        for msg_id in msg_ids:
+            self._processed.pop(msg_id, None)
+
+
+class RedisBackend(StateBackend):
+    name = "redis"
+    shared = True
+
+    # Key nur löschen/verlängern, wenn er noch den erwarteten Wert hat (Lock gehört noch uns)
+    _DELETE_IF = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+    _EXPIRE_IF = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+
+    def __init__(self, url=None, prefix=None):
+        super().__init__()
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self.prefix = prefix or Config.REDIS_PREFIX
+        self._redis = aioredis.from_url(url or Config.REDIS_URL, decode_responses=True)
+        self.owner = uuid.uuid4().hex
+
+    def _key(self, kind, ident):
+        return f"{self.prefix}:{kind}:{ident}"
+
+    async def start(self):
+        await self._redis.ping()
+        # Vorgemerkte Leads nachholen, deren Prozess vor dem SQLite-Commit abgestürzt ist
+        async for key in self._redis.scan_iter(match=self._key("lead", "*")):
+            raw = await self._redis.get(key)
+            if raw is not None:
+                await self._save_lead(key.rsplit(":", 1)[1], raw)
+
+    async def close(self):
+        await self._redis.aclose()
+
+    async def get_session(self, phone):
+        raw, lead = await self._redis.mget([self._key("session", phone), self._key("lead", phone)])
+        if lead is not None:
+            await self._save_lead(phone, lead)
+        if raw is None:
+            return "START", {}, None
+        data = json.loads(raw)
+        return data["step"], data["context"], data["language"]
+
+    async def save_sessions(self, rows):
+        if not rows:
+            return
+        keep_lang = [phone for phone, _, _, lang in rows if lang is None]
+        known = {}
+        if keep_lang:
+            raws = await self._redis.mget([self._key("session", p) for p in keep_lang])
+            known = {p: json.loads(r)["language"] for p, r in zip(keep_lang, raws) if r}
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for phone, step, ctx, lang in rows:
+                data = {"step": step, "context": ctx, "language": lang or known.get(phone) or "en"}
+                pipe.set(self._key("session", phone), json.dumps(data), ex=Config.SESSION_TTL_SECONDS)
+            await pipe.execute()
+
+    async def complete_lead(self, phone, ctx, lang, msg_id):
+        # Der Lead liegt in SQLite, die Session hier: Session COMPLETED und Vormerkung des Leads
+        # atomar (MULTI), dann den Lead speichern. Fehlt der Commit (Absturz, DB-Fehler), holen
+        # get_session()/start() ihn nach; wiederholt ist das harmlos (Lead pro Nummer, Mail pro msg_id)
+        session = json.dumps({"step": "COMPLETED", "context": {}, "language": lang or "en"})
+        intent = json.dumps({"ctx": ctx, "lang": lang, "msg_id": msg_id})
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key("session", phone), session, ex=Config.SESSION_TTL_SECONDS)
+            pipe.set(self._key("lead", phone), intent)
+            await pipe.execute()
+        await self._save_lead(phone, intent)
+
+    async def _save_lead(self, phone, intent):
+        data = json.loads(intent)
+        await database.save_lead(phone, data["ctx"], data["lang"], data["msg_id"])
+        # Nur diese Vormerkung löschen, nicht eine inzwischen neuere
+        await self._redis.eval(self._DELETE_IF, 1, self._key("lead", phone), intent)
+
+    async def delete_user_data(self, phone, trigger=None):
+        await self._redis.delete(self._key("session", phone), self._key("lead", phone))
+        return await database.delete_user_data(phone, trigger)
+
+    async def claim_messages(self, msg_ids):
+        msg_ids = list(dict.fromkeys(msg_ids))
+        if not msg_ids:
+            return set()
+        async with self._redis.pipeline(transaction=False) as pipe:
+            for msg_id in msg_ids:
+                pipe.set(self._key("msg", msg_id), 1, nx=True, ex=Config.DEDUP_TTL_SECONDS)
+            results = await pipe.execute()
+        return {m for m, ok in zip(msg_ids, results) if ok}
+
+    async def release_messages(self, msg_ids):
+        if msg_ids:
+            await self._redis.delete(*[self._key("msg", m) for m in msg_ids])
+
+    @asynccontextmanager
+    async def lock(self, phone):
+        key = self._key("lock", phone)
+        async with self.local_locks.lock(phone):
+            await _acquire(lambda: self._redis.set(key, self.owner, nx=True, px=int(Config.LOCK_TTL * 1000)), phone)
+            keeper = asyncio.create_task(_keep(
+                lambda: self._redis.eval(self._EXPIRE_IF, 1, key, self.owner, int(Config.LOCK_TTL * 1000)), phone))
+            try:
+                yield
+            finally:
+                keeper.cancel()
+                await self._redis.eval(self._DELETE_IF, 1, key, self.owner)
+
+
+async def _acquire(try_once, phone):
+    """Poll a distributed lock with capped exponential backoff until LOCK_WAIT runs out."""
+    deadline = time.monotonic() + Config.LOCK_WAIT
+    delay = 0.01
+    while not await try_once():
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Could not lock phone {phone} within {Config.LOCK_WAIT}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+async def _keep(renew, phone):
+    """Renew a held distributed lock every LOCK_TTL/3, so a slow turn (SMTP, Graph API)
+    does not lose it to another worker. Cancelled when the turn ends."""
+    while True:
+        await asyncio.sleep(Config.LOCK_TTL / 3)
+        try:
+            await renew()
+        except Exception as e:
+            logger.warning(f"Could not renew lock for phone {phone}: {e}")
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+    "memory": MemoryBackend,
+    "redis": RedisBackend,
+}
+
+
+def create_backend(name=None):
+    name = (name or Config.STATE_BACKEND).lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown STATE_BACKEND {name!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[name]()
+
+
+backend = create_backend()
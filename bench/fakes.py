@@ -0,0 +1,180 @@
+"""Fake Graph API and fake SMTP server for the benchmark harness (bench/run.py).
+
+Both run in the harness' event loop, so the harness can wait for "the bot
+answered phone X" without polling.
+"""
+
+import asyncio
+import random
+import socket
+import time
+from collections import Counter, defaultdict
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+def _socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+class FakeGraphAPI:
+    """
+    POST /<version>/<phone_number_id>/messages with configurable latency
+    (mean, +-jitter), a share of 429 throttling answers (Graph error code
+    `throttle_code`) and a share of 500 errors. `on_sent(to, wamid)` is
+    called for every accepted message (e.g. to send status callbacks).
+    """
+
+    def __init__(self, latency=0.05, jitter=0.5, rate_429=0.0, rate_error=0.0, throttle_code=130429, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.rate_error = rate_error
+        self.throttle_code = throttle_code
+        self.random = random.Random(seed)
+        self.status = Counter()
+        self.delivered = defaultdict(int)
+        # phone -> [Future], erfüllt bei der nächsten erfolgreichen Nachricht an diese Nummer
+        self._waiters = defaultdict(list)
+        self.on_sent = None
+        self._server = None
+        self._task = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v18.0"
+
+    def expect_reply(self, phone):
+        """Future resolved with the monotonic time of the next message sent to `phone`."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[phone].append(future)
+        return future
+
+    async def _messages(self, request):
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency * (1 + self.jitter * (2 * self.random.random() - 1)))
+
+        roll = self.random.random()
+        if roll < self.rate_429:
+            self.status[429] += 1
+            return JSONResponse({"error": {"message": "(#%d) Rate limit hit" % self.throttle_code,
+                                           "code": self.throttle_code}}, status_code=429)
+        if roll < self.rate_429 + self.rate_error:
+            self.status[500] += 1
+            return JSONResponse({"error": {"message": "Something went wrong", "code": 131000}}, status_code=500)
+
+        self.status[200] += 1
+        to = body.get("to", "")
+        self.delivered[to] += 1
+        now = time.monotonic()
+        for future in self._waiters.pop(to, ()):
+            if not future.done():
+                future.set_result(now)
+        wamid = f"wamid.fake{sum(self.status.values())}"
+        if self.on_sent is not None:
+            self.on_sent(to, wamid)
+        return JSONResponse({"messaging_product": "whatsapp", "contacts": [{"input": to, "wa_id": to}],
+                             "messages": [{"id": wamid}]})
+
+    async def start(self):
+        app = Starlette(routes=[Route("/{version}/{phone_id}/messages", self._messages, methods=["POST"])])
+        sock = _socket()
+        self.port = sock.getsockname()[1]
+        self._server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off"))
+        self._task = asyncio.create_task(self._server.serve(sockets=[sock]))
+        while not self._server.started:
+            await asyncio.sleep(0.01)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            await self._task
+
+    def stats(self):
+        return {"requests": sum(self.status.values()), "status": {str(k): v for k, v in sorted(self.status.items())},
+                "recipients": len(self.delivered)}
+
+
+class FakeSMTP:
+    """Plain SMTP (no TLS) with AUTH PLAIN/LOGIN, optional latency and failure rate per mail."""
+
+    def __init__(self, latency=0.02, rate_error=0.0, seed=None):
+        self.latency = latency
+        self.rate_error = rate_error
+        self.random = random.Random(seed)
+        self.mails = 0
+        self.rejected = 0
+        self.sessions = 0
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._session, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _session(self, reader, writer):
+        self.sessions += 1
+
+        async def reply(line):
+            writer.write(line.encode() + b"\r\n")
+            await writer.drain()
+
+        try:
+            await reply("220 fake-smtp ESMTP")
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line.decode(errors="replace").strip()
+                verb = command.split(" ", 1)[0].upper()
+                if verb == "EHLO":
+                    writer.write(b"250-fake-smtp\r\n250-8BITMIME\r\n250-AUTH PLAIN LOGIN\r\n")
+                    await reply("250 SIZE 10485760")
+                elif verb == "AUTH":
+                    parts = command.split()
+                    if parts[1].upper() == "LOGIN":
+                        await reply("334 VXNlcm5hbWU6")
+                        await reader.readline()
+                        await reply("334 UGFzc3dvcmQ6")
+                        await reader.readline()
+                    elif len(parts) == 2:
+                        await reply("334 ")
+                        await reader.readline()
+                    await reply("235 2.7.0 Authentication successful")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    while (await reader.readline()) not in (b".\r\n", b".\n", b""):
+                        pass
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    if self.random.random() < self.rate_error:
+                        self.rejected += 1
+                        await reply("451 4.3.0 Temporary failure")
+                    else:
+                        self.mails += 1
+                        await reply("250 2.0.0 Ok: queued")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:  # HELO, MAIL, RCPT, RSET, NOOP
+                    await reply("250 Ok")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def stats(self):
+        return {"mails": self.mails, "rejected": self.rejected, "sessions": self.sessions}
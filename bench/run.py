@@ -0,0 +1,553 @@
+"""Benchmark: runs the bot against a fake Graph API and a fake SMTP server and replays webhook traffic.
+
+Nutzung:
+  python bench/run.py                                  # 200 generierte Gespräche
+  python bench/run.py --phones 1000 --concurrency 200 --batch-window 0.005 --redeliver 0.05
+  python bench/run.py --graph-latency 0.2 --graph-429 0.02 --graph-errors 0.01
+  python bench/run.py --statuses --env DELIVERY_TRACKING=true   # mit sent/delivered/read-Callbacks
+  python bench/run.py --record traffic.jsonl           # generierten Traffic mitschreiben
+  python bench/run.py --replay traffic.jsonl --speed 2 # aufgezeichneten Traffic abspielen
+  python bench/run.py --env INGEST_WORKERS=32 --compare bench/results/<alt>.json
+
+Der Bot läuft als eigener uvicorn-Prozess mit frischer DB in einem Temp-Ordner.
+Generierte Gespräche laufen "closed loop": die nächste Nachricht einer Nummer
+geht erst raus, wenn der Bot auf die vorige geantwortet hat (Antwort = erster
+erfolgreicher Send an diese Nummer beim Fake-Graph). Aufgezeichneter Traffic
+wird "open loop" zu den aufgezeichneten Zeitpunkten gesendet.
+
+Ergebnis: JSON unter bench/results/ (oder --out) mit Durchsatz, p50/p95/p99
+je Stufe (Client-Sicht + /metrics des Bots), Fehlern und "database is locked"
+im Bot-Log.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime
+
+import httpx
+
+import traffic
+from fakes import FakeGraphAPI, FakeSMTP
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "bench", "results")
+APP_SECRET = "bench-secret"
+ADMIN_TOKEN = "bench-admin"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    p.add_argument("--phones", type=int, default=200, help="generated conversations (one phone each)")
+    p.add_argument("--concurrency", type=int, default=50, help="conversations running at the same time")
+    p.add_argument("--think", type=float, default=0.0, help="seconds between a reply and the next message")
+    p.add_argument("--batch-window", type=float, default=0.0,
+                   help="collect messages for N seconds into one webhook payload (0 = one per payload)")
+    p.add_argument("--batch-max", type=int, default=10, help="max. messages per batched payload")
+    p.add_argument("--redeliver", type=float, default=0.0, help="share of payloads delivered twice (like Meta)")
+    p.add_argument("--statuses", action="store_true",
+                   help="answer every accepted send with sent/delivered/read status callbacks")
+    p.add_argument("--reply-timeout", type=float, default=15.0)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--replay", help="recorded JSONL file to replay instead of generated conversations")
+    p.add_argument("--speed", type=float, default=1.0, help="replay speed factor")
+    p.add_argument("--record", help="write the generated webhook traffic to this JSONL file")
+    p.add_argument("--graph-latency", type=float, default=0.05)
+    p.add_argument("--graph-429", type=float, default=0.0, help="share of Graph API calls answered with 429")
+    p.add_argument("--graph-errors", type=float, default=0.0, help="share of Graph API calls answered with 500")
+    p.add_argument("--graph-throttle-code", type=int, default=130429)
+    p.add_argument("--smtp-latency", type=float, default=0.02)
+    p.add_argument("--smtp-errors", type=float, default=0.0)
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the bot")
+    p.add_argument("--drain-timeout", type=float, default=30.0, help="wait for queue/outbox after the traffic")
+    p.add_argument("--out", help="result file (default: bench/results/<timestamp>.json)")
+    p.add_argument("--compare", help="earlier result file to compare against")
+    return p.parse_args(argv)
+
+
+# --- Auswertung ---
+
+def summarize(values):
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    n = len(values)
+    result = {"count": n, "mean_ms": round(sum(values) / n * 1000, 3)}
+    for q in QUANTILES:
+        result[f"p{int(q * 100)}_ms"] = round(values[min(n - 1, int(q * n))] * 1000, 3)
+    result["max_ms"] = round(values[-1] * 1000, 3)
+    return result
+
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][\w:]*)(?:\{(.*)\})? (\S+)$')
+_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_metrics(text):
+    """Prometheus text -> [(name, {label: value}, float)]."""
+    samples = []
+    for line in text.splitlines():
+        m = _SAMPLE.match(line)
+        if m:
+            name, labels, value = m.groups()
+            samples.append((name, dict(_LABEL.findall(labels or "")), float(value)))
+    return samples
+
+
+def histograms(samples, name, group_by=()):
+    """{group values: [(le, cumulative count)]} for one histogram."""
+    result = {}
+    for sample, labels, value in samples:
+        if sample != f"{name}_bucket":
+            continue
+        key = tuple(labels.get(g, "") for g in group_by)
+        le = float("inf") if labels["le"] == "+Inf" else float(labels["le"])
+        result.setdefault(key, []).append((le, value))
+    return {k: sorted(v) for k, v in result.items()}
+
+
+def histogram_quantile(q, buckets):
+    """Like PromQL histogram_quantile: linear interpolation inside the bucket."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0.0
+    for le, count in buckets:
+        if count >= rank:
+            if le == float("inf"):
+                return lower
+            return lower + (le - lower) * ((rank - below) / (count - below) if count > below else 0)
+        lower, below = le, count
+    return lower
+
+
+def summarize_histogram(buckets):
+    count = int(buckets[-1][1]) if buckets else 0
+    result = {"count": count}
+    for q in QUANTILES:
+        value = histogram_quantile(q, buckets)
+        result[f"p{int(q * 100)}_ms"] = None if value is None else round(value * 1000, 3)
+    return result
+
+
+def counter(samples, name, **match):
+    return sum(v for n, labels, v in samples if n == name and all(labels.get(k) == x for k, x in match.items()))
+
+
+def stage_report(samples):
+    stages = {}
+    for key, name in (("webhook", "wa_webhook_request_seconds"), ("e2e", "wa_message_e2e_seconds"),
+                      ("graph", "wa_graph_request_seconds"), ("smtp", "wa_smtp_send_seconds")):
+        h = histograms(samples, name).get(())
+        stages[key] = summarize_histogram(h or [])
+    stages["db"] = {f"{mode}:{query}": summarize_histogram(b)
+                    for (query, mode), b in sorted(histograms(samples, "wa_db_query_seconds", ("query", "mode")).items())}
+    stages["flow"] = {step: summarize_histogram(b)
+                      for (step,), b in sorted(histograms(samples, "wa_flow_transition_seconds", ("step",)).items())}
+    return stages
+
+
+# --- Bot-Prozess ---
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class BotProcess:
+    def __init__(self, env, workdir):
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.env = env
+        self.log_path = os.path.join(workdir, "bot.log")
+        self.proc = None
+
+    async def start(self, client, timeout=30):
+        self._log = open(self.log_path, "wb")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port),
+             "--log-level", "warning"],
+            cwd=ROOT, env=self.env, stdout=self._log, stderr=subprocess.STDOUT,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"bot exited during startup, see {self.log_path}")
+            try:
+                if (await client.get(f"{self.url}/readyz")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError(f"bot not ready after {timeout}s, see {self.log_path}")
+
+    def stop(self, timeout=30):
+        if self.proc and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self._log.close()
+
+    def log(self):
+        with open(self.log_path, "r", encoding="utf-8", errors="replace") as f:
+            return f.read()
+
+
+# --- Traffic ---
+
+class Sender:
+    """Posts webhook payloads (signed like Meta), optional batching and redelivery."""
+
+    def __init__(self, client, url, args, recorder):
+        self.client = client
+        self.url = f"{url}/webhook"
+        self.window = args.batch_window
+        self.batch_max = args.batch_max
+        self.redeliver = args.redeliver
+        self.random = random.Random(args.seed)
+        self.recorder = recorder
+        self.started = time.monotonic()
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+        self.latencies = []
+        self.status = Counter()
+        self.payloads = 0
+        self.batched = 0
+        self.redelivered = 0
+        self.messages = 0
+        self.statuses = 0
+
+    async def send_message(self, message):
+        """Send one (phone, name, text, msg_id); returns once the webhook has answered."""
+        if not self.window:
+            await self.post(traffic.webhook_payload([message]))
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message, future))
+        if len(self._pending) >= self.batch_max:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            self._spawn(self._post_batch(batch))
+
+    async def _post_batch(self, batch):
+        try:
+            await self.post(traffic.webhook_payload([m for m, _ in batch]))
+        finally:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def post(self, payload, original=True):
+        body = json.dumps(payload, separators=(",", ":")).encode()
+        signature = "sha256=" + hmac.new(APP_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        headers = {"Content-Type": "application/json", "X-Hub-Signature-256": signature}
+        if original:
+            self.payloads += 1
+            n = len(traffic.message_ids(payload))
+            self.messages += n
+            self.batched += n > 1
+            self.recorder.write(time.monotonic() - self.started, payload)
+
+        # Wie Meta: bei Nicht-200 erneut zustellen
+        for attempt in range(4):
+            started = time.monotonic()
+            try:
+                response = await self.client.post(self.url, content=body, headers=headers)
+                status = response.status_code
+            except httpx.TransportError as e:
+                status = type(e).__name__
+            self.latencies.append(time.monotonic() - started)
+            self.status[str(status)] += 1
+            if status == 200:
+                break
+            await asyncio.sleep(0.5 * 2 ** attempt)
+
+        if original and self.redeliver and self.random.random() < self.redeliver:
+            self.redelivered += 1
+            self._spawn(self._redeliver(payload))
+
+    async def _redeliver(self, payload):
+        await asyncio.sleep(self.random.random())
+        await self.post(payload, original=False)
+
+    def send_statuses(self, to, wamid):
+        """Status callbacks like Meta: sent, delivered, read, each as its own POST."""
+        self._spawn(self._statuses(to, wamid))
+
+    async def _statuses(self, to, wamid):
+        for status, delay in (("sent", 0.05), ("delivered", 0.2), ("read", 1.0)):
+            await asyncio.sleep(delay * (0.5 + self.random.random()))
+            self.statuses += 1
+            await self.post(traffic.status_payload(wamid, to, status, time.time()), original=False)
+
+    async def drain(self):
+        self._flush()
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+
+async def run_generated(args, sender, graph):
+    convs = traffic.conversations(args.phones, args.seed)
+    sem = asyncio.Semaphore(args.concurrency)
+    replies = []
+    timeouts = Counter()
+
+    async def run(conv):
+        async with sem:
+            for i, text in enumerate(conv.texts):
+                reply = graph.expect_reply(conv.phone)
+                started = time.monotonic()
+                await sender.send_message((conv.phone, conv.name, text, f"wamid.bench.{conv.phone}.{i}"))
+                try:
+                    replies.append(await asyncio.wait_for(reply, args.reply_timeout) - started)
+                except asyncio.TimeoutError:
+                    timeouts[conv.kind] += 1
+                if args.think:
+                    await asyncio.sleep(args.think)
+
+    await asyncio.gather(*(run(c) for c in convs))
+    return {"conversations": Counter(c.kind for c in convs), "reply": replies, "reply_timeouts": dict(timeouts)}
+
+
+async def run_replay(args, sender):
+    items = traffic.load_jsonl(args.replay)
+    started = time.monotonic()
+
+    async def post_at(offset, payload):
+        delay = offset / args.speed - (time.monotonic() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await sender.post(payload)
+
+    await asyncio.gather(*(post_at(t, p) for t, p in items))
+    return {"replayed_payloads": len(items), "reply": [], "reply_timeouts": {}}
+
+
+async def wait_drained(client, url, timeout):
+    """Wait until the ingest queue and the outbox are empty."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = (await client.get(f"{url}/ingest/stats", headers={"Authorization": f"Bearer {ADMIN_TOKEN}"})).json()
+        rows = stats.get("outbox", {}).get("rows", {})
+        if stats.get("depth", 0) == 0 and not rows.get("pending") and not rows.get("sending"):
+            return True
+        await asyncio.sleep(0.2)
+    return False
+
+
+# --- Ablauf ---
+
+def bot_env(args, workdir, graph, smtp):
+    env = dict(os.environ)
+    env.update({
+        "DB_PATH": os.path.join(workdir, "bench.db"),
+        "GRAPH_API_URL": graph.base_url,
+        "PHONE_NUMBER_ID": "bench",
+        "WHATSAPP_TOKEN": "bench",
+        "APP_SECRET": APP_SECRET,
+        "ADMIN_TOKEN": ADMIN_TOKEN,
+        "WA_HTTP2": "false",
+        "SMTP_HOST": "127.0.0.1",
+        "SMTP_PORT": str(smtp.port),
+        "SMTP_USER": "bench",
+        "SMTP_PASS": "bench",
+        "SMTP_FROM": "bot@bench.local",
+        "SMTP_STARTTLS": "false",
+        "CONTACT_EMAIL": "owner@bench.local",
+        "PRIVACY_EMAIL": "privacy@bench.local",
+        "LANG_RELOAD_INTERVAL": "0",
+        "OUTBOX_POLL_INTERVAL": "0.5",
+    })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    return env
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+async def bench(args):
+    graph = FakeGraphAPI(args.graph_latency, rate_429=args.graph_429, rate_error=args.graph_errors,
+                         throttle_code=args.graph_throttle_code, seed=args.seed)
+    smtp = FakeSMTP(args.smtp_latency, args.smtp_errors, seed=args.seed)
+    await graph.start()
+    await smtp.start()
+    workdir = tempfile.mkdtemp(prefix="wa-bench-")
+    env = bot_env(args, workdir, graph, smtp)
+    bot = BotProcess(env, workdir)
+    recorder = traffic.Recorder(args.record)
+
+    limits = httpx.Limits(max_connections=max(args.concurrency, 10), max_keepalive_connections=max(args.concurrency, 10))
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        try:
+            await bot.start(client)
+            sender = Sender(client, bot.url, args, recorder)
+            if args.statuses:
+                graph.on_sent = sender.send_statuses
+            started = time.monotonic()
+            if args.replay:
+                result = await run_replay(args, sender)
+            else:
+                result = await run_generated(args, sender, graph)
+            await sender.drain()
+            traffic_seconds = time.monotonic() - started
+            drained = await wait_drained(client, bot.url, args.drain_timeout)
+            total_seconds = time.monotonic() - started
+            samples = parse_metrics((await client.get(f"{bot.url}/metrics")).text)
+        finally:
+            bot.stop()
+            recorder.close()
+            await graph.stop()
+            await smtp.stop()
+
+    log = bot.log()
+    processed = counter(samples, "wa_messages_total")
+    return {
+        "meta": {
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "mode": "replay" if args.replay else "generated",
+            "args": vars(args),
+            "bot_env": {k: env[k] for k in sorted(env) if env[k] != os.environ.get(k)},
+            "workdir": workdir,
+        },
+        "traffic": {
+            "payloads": sender.payloads,
+            "messages": sender.messages,
+            "batched_payloads": sender.batched,
+            "redeliveries": sender.redelivered,
+            "status_callbacks": sender.statuses,
+            **({"conversations": dict(result["conversations"])} if "conversations" in result else {}),
+            **({"replayed_payloads": result["replayed_payloads"]} if "replayed_payloads" in result else {}),
+        },
+        "throughput": {
+            "traffic_seconds": round(traffic_seconds, 3),
+            "total_seconds": round(total_seconds, 3),
+            "drained": drained,
+            "messages_per_s": round(processed / total_seconds, 2) if total_seconds else 0,
+            "webhooks_per_s": round(sum(sender.status.values()) / traffic_seconds, 2) if traffic_seconds else 0,
+        },
+        "client": {
+            "webhook": summarize(sender.latencies),
+            "reply": summarize(result["reply"]),
+        },
+        "stages": stage_report(samples),
+        "errors": {
+            "webhook_status": dict(sender.status),
+            "reply_timeouts": result["reply_timeouts"],
+            "turn_failures": counter(samples, "wa_messages_total", result="error"),
+            "dedup_duplicates": counter(samples, "wa_dedup_messages_total", result="duplicate"),
+            "graph_status": {labels["status"]: v for n, labels, v in samples if n == "wa_graph_responses_total"},
+            "smtp_failures": counter(samples, "wa_smtp_failures_total"),
+            "db_locked": len(re.findall(r"database is locked", log)),
+            "log_errors": len(re.findall(r"^ERROR", log, re.M)),
+        },
+        "fakes": {"graph": graph.stats(), "smtp": smtp.stats()},
+    }
+
+
+# --- Ausgabe ---
+
+COMPARE_KEYS = [
+    ("throughput", "messages_per_s", True),
+    ("client.reply", "p50_ms", False),
+    ("client.reply", "p95_ms", False),
+    ("client.reply", "p99_ms", False),
+    ("client.webhook", "p95_ms", False),
+    ("stages.e2e", "p95_ms", False),
+    ("stages.graph", "p95_ms", False),
+    ("stages.smtp", "p95_ms", False),
+    ("errors", "db_locked", False),
+    ("errors", "turn_failures", False),
+]
+
+
+def _get(result, path, key):
+    node = result
+    for part in path.split("."):
+        node = node.get(part, {})
+    return node.get(key)
+
+
+def print_summary(result, previous=None):
+    t, c, s, e = result["throughput"], result["client"], result["stages"], result["errors"]
+    print(f"\n{result['traffic']['messages']} messages in {t['total_seconds']}s -> {t['messages_per_s']} msg/s"
+          f" ({result['traffic']['payloads']} payloads, {result['traffic']['redeliveries']} redeliveries"
+          f"{'' if t['drained'] else ', NOT DRAINED'})")
+    print(f"{'stage':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, row in (("reply (client)", c["reply"]), ("webhook (cl.)", c["webhook"]),
+                      ("webhook", s["webhook"]), ("e2e", s["e2e"]), ("graph", s["graph"]), ("smtp", s["smtp"])):
+        print(f"{name:<14}{row.get('count', 0):>8}" + "".join(
+            f"{'-' if row.get(k) is None else row[k]:>10}" for k in ("p50_ms", "p95_ms", "p99_ms")))
+    print(f"errors: {json.dumps(e)}")
+
+    if previous:
+        print(f"\ncompared to {previous['meta'].get('started')} ({previous['meta'].get('git')}):")
+        for path, key, higher_is_better in COMPARE_KEYS:
+            old, new = _get(previous, path, key), _get(result, path, key)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else ""
+            better = (new > old) == higher_is_better if new != old else None
+            mark = {True: "better", False: "worse", None: ""}[better]
+            print(f"  {path + '.' + key:<24} {old:>10} -> {new:<10} {change:>8} {mark}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(bench(args))
+
+    out = args.out or os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+    print_summary(result, previous)
+    print(f"\nresult: {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Webhook traffic for the benchmark: generated conversations or a recorded JSONL file.
+
+Recorded format (one webhook per line, as written by --record):
+  {"t": 0.153, "payload": {...webhook body...}}
+A line without "t"/"payload" is taken as a bare webhook body, sent back to back.
+"""
+
+import json
+import random
+
+# Gesprächsskripte entlang flows/lead.json; Button-Titel wie in lang/*.json
+SCRIPTS = {
+    "lead": {
+        "en": ["hi", "Send Message", "Project inquiry", "Yes, correct", "{email}", "No, email only", "thanks"],
+        "de": ["hallo", "Nachricht senden", "Projektanfrage", "Ja, ist korrekt", "{email}", "Nein, nur E-Mail", "danke"],
+    },
+    "contact": {
+        "en": ["hi", "Contact Info"],
+        "de": ["hallo", "Kontaktdaten"],
+    },
+    "privacy": {
+        "en": ["privacy", "Yes, delete all"],
+        "de": ["datenschutz", "Ja, alles löschen"],
+    },
+    "abort": {
+        "en": ["hello", "Send Message", "stop"],
+        "de": ["hallo", "Nachricht senden", "stop"],
+    },
+}
+
+MIX = {"lead": 0.7, "contact": 0.15, "privacy": 0.05, "abort": 0.1}
+
+NAMES = ["Max", "Erika", "Jonas", "Lea", "Tom", "Mia", "Paul", "Anna"]
+
+
+class Conversation:
+    def __init__(self, phone, name, kind, texts):
+        self.phone = phone
+        self.name = name
+        self.kind = kind
+        self.texts = texts
+
+
+def conversations(count, seed=None, mix=None):
+    """`count` conversations on distinct phones, half German (49...), half US (1...)."""
+    rnd = random.Random(seed)
+    mix = mix or MIX
+    kinds, weights = zip(*mix.items())
+    result = []
+    for i in range(count):
+        lang = "de" if i % 2 else "en"
+        phone = f"49170{i:07d}" if lang == "de" else f"1555{i:07d}"
+        kind = rnd.choices(kinds, weights)[0]
+        name = rnd.choice(NAMES)
+        texts = [t.format(email=f"{name.lower()}{i}@example.com") for t in SCRIPTS[kind][lang]]
+        result.append(Conversation(phone, name, kind, texts))
+    return result
+
+
+def webhook_payload(messages):
+    """Webhook body for [(phone, name, text, msg_id)] - several messages = one batched delivery."""
+    contacts = {}
+    items = []
+    for phone, name, text, msg_id in messages:
+        contacts[phone] = {"wa_id": phone, "profile": {"name": name}}
+        items.append({"from": phone, "id": msg_id, "timestamp": "0", "type": "text", "text": {"body": text}})
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "0", "changes": [{"field": "messages", "value": {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": "0", "phone_number_id": "0"},
+            "contacts": list(contacts.values()),
+            "messages": items,
+        }}]}],
+    }
+
+
+def status_payload(wamid, phone, status, timestamp):
+    """Webhook body of one status callback (sent, delivered, read)."""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "0", "changes": [{"field": "messages", "value": {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": "0", "phone_number_id": "0"},
+            "statuses": [{"id": wamid, "status": status, "timestamp": str(int(timestamp)),
+                          "recipient_id": phone}],
+        }}]}],
+    }
+
+
+def message_ids(payload):
+    return [m["id"] for e in payload.get("entry", []) for c in e.get("changes", [])
+            for m in c.get("value", {}).get("messages", [])]
+
+
+def load_jsonl(path):
+    """[(offset_seconds, payload)] from a recorded file."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            data = json.loads(line)
+            if "payload" in data:
+                items.append((float(data.get("t", 0.0)), data["payload"]))
+            else:
+                items.append((0.0, data))
+    return items
+
+
+class Recorder:
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="utf-8") if path else None
+
+    def write(self, offset, payload):
+        if self._file:
+            self._file.write(json.dumps({"t": round(offset, 4), "payload": payload}, separators=(",", ":")) + "\n")
+
+    def close(self):
+        if self._file:
+            self._file.close()
@@ -0,0 +1,483 @@
+"""
+Broadcasts: one message to every stored lead matching a filter.
+
+A broadcast is a row in `broadcasts` (message spec, lead filter, cursor,
+counts). Leads are streamed in phone order, BROADCAST_PAGE_SIZE at a time
+(keyset paging, the next page is read while the current one is sent), and
+sent through the shared dispatcher with at most BROADCAST_CONCURRENCY
+requests in flight and at most BROADCAST_RATE messages per second. Whenever
+the Graph API throttles the app, the rate is halved and then raised again
+page by page. After every page the recipients and the cursor are committed
+in one transaction, so an interrupted broadcast resumes at the first
+unconfirmed page (only that page can be sent twice).
+
+Inside the bot broadcasts run on the scheduler leader (service "broadcasts"),
+one after the other; every run holds the lease "broadcast:<id>", so a
+broadcast started from the command line is never sent twice in parallel.
+
+Message spec: {"template": name, "languages": {lead language: template
+language code}, "params": ["name", "phone"]} for an approved template
+(needed outside the 24h window), or {"text": str or {language: str}} with
+$NAME / $PHONE placeholders. Filter: {"language": [...], "status": [...],
+"created_after": date, "created_before": date}.
+
+Standalone:
+  python broadcast.py start --template angebot --params name --language de --lead-status new
+  python broadcast.py start --text 'Hallo $NAME, ...' --since 2024-01-01 --dry
+  python broadcast.py list
+  python broadcast.py status 3
+  python broadcast.py run 3                      # Unterbrochenen Broadcast hier fortsetzen
+  python broadcast.py pause|resume|cancel 3
+"""
+
+import argparse
+import asyncio
+import logging
+import signal
+import sys
+import time
+from datetime import datetime, timezone
+from string import Template
+from config import Config
+import database
+import delivery
+import metrics
+from ratelimit import TokenBucket
+from scheduler import lease_owner
+from whatsapp import dispatcher, build_message, build_template, SendResult
+
+logger = logging.getLogger(__name__)
+
+_SENT = metrics.BROADCAST_MESSAGES.labels("sent")
+_FAILED = metrics.BROADCAST_MESSAGES.labels("failed")
+
+PARAM_FIELDS = ("name", "phone")
+
+# Aktion -> (neuer Status, erlaubte bisherige Status)
+_TRANSITIONS = {
+    "pause": ("paused", ("running",)),
+    "resume": ("running", ("paused",)),
+    "cancel": ("cancelled", ("running", "paused")),
+}
+
+
+def _timestamp(value, field):
+    # leads.created_at ist CURRENT_TIMESTAMP (UTC, "YYYY-MM-DD HH:MM:SS"); Angaben mit
+    # Offset nach UTC umrechnen, ohne Offset gelten sie als UTC
+    try:
+        parsed = datetime.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{field}: expected an ISO date, got {value!r}") from None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _strings(value, field):
+    values = [value] if isinstance(value, str) else value
+    if not isinstance(values, list) or not all(isinstance(v, str) and v for v in values):
+        raise ValueError(f"{field}: expected a string or a list of strings")
+    return values
+
+
+def parse_request(data):
+    """(spec, lead_filter) from an admin request body; ValueError if it is invalid."""
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    if ("template" in data) == ("text" in data):
+        raise ValueError("exactly one of 'template' and 'text' is required")
+
+    if "template" in data:
+        if not isinstance(data["template"], str) or not data["template"]:
+            raise ValueError("template: expected the name of an approved template")
+        params = _strings(data.get("params") or [], "params")
+        unknown = set(params) - set(PARAM_FIELDS)
+        if unknown:
+            raise ValueError(f"params: unknown fields {sorted(unknown)}, allowed: {list(PARAM_FIELDS)}")
+        languages = data.get("languages") or {}
+        if not isinstance(languages, dict) or not all(isinstance(v, str) and v for v in languages.values()):
+            raise ValueError("languages: expected {lead language: template language code}")
+        spec = {"template": data["template"], "languages": languages, "params": params}
+    else:
+        text = data["text"]
+        if isinstance(text, dict):
+            if not text or not all(isinstance(v, str) and v for v in text.values()):
+                raise ValueError("text: expected a string or {language: string}")
+        elif not isinstance(text, str) or not text:
+            raise ValueError("text: expected a string or {language: string}")
+        spec = {"text": text}
+
+    raw = data.get("filter") or {}
+    if not isinstance(raw, dict):
+        raise ValueError("filter: expected a JSON object")
+    unknown = set(raw) - {"language", "status", "created_after", "created_before"}
+    if unknown:
+        raise ValueError(f"filter: unknown keys {sorted(unknown)}")
+    lead_filter = {}
+    for key in ("language", "status"):
+        if raw.get(key):
+            lead_filter[key] = _strings(raw[key], f"filter.{key}")
+    for key in ("created_after", "created_before"):
+        if raw.get(key):
+            lead_filter[key] = _timestamp(raw[key], f"filter.{key}")
+    return spec, lead_filter
+
+
+def compile_spec(spec):
+    """fn(phone, name, language) -> Graph API payload for one lead."""
+    if "template" in spec:
+        name, languages, params = spec["template"], spec.get("languages") or {}, spec.get("params") or ()
+
+        def render(phone, lead_name, language):
+            lang = language or Config.DEFAULT_LANGUAGE
+            fields = {"name": lead_name or "", "phone": phone}
+            return build_template(phone, name, languages.get(lang, lang), [fields[p] for p in params])
+        return render
+
+    text = spec["text"]
+    texts = {lang: Template(t) for lang, t in text.items()} if isinstance(text, dict) else {None: Template(text)}
+    fallback = texts.get(Config.DEFAULT_LANGUAGE) or next(iter(texts.values()))
+
+    def render(phone, lead_name, language):
+        tpl = texts.get(language or Config.DEFAULT_LANGUAGE, fallback)
+        return build_message(phone, tpl.safe_substitute(NAME=lead_name or "", PHONE=phone))
+    return render
+
+
+class Broadcaster:
+    def __init__(self, rate=None, concurrency=None, page_size=None, max_failures=None,
+                 poll_interval=None, lease_ttl=None):
+        self.rate = rate or Config.BROADCAST_RATE
+        self.concurrency = concurrency or Config.BROADCAST_CONCURRENCY
+        self.page_size = page_size or Config.BROADCAST_PAGE_SIZE
+        self.max_failures = max_failures or Config.BROADCAST_MAX_FAILURES
+        self.poll_interval = poll_interval or Config.BROADCAST_POLL_INTERVAL
+        self.lease_ttl = lease_ttl or Config.SCHEDULER_LEASE_TTL
+        self.owner = lease_owner()
+        self._wake = asyncio.Event()
+        self._task = None
+        self._stopping = False
+
+        # Fortschritt des Broadcasts, den dieser Prozess gerade sendet
+        self.live = None
+        self._failures = 0  # fehlgeschlagene Sends in Folge
+        self._last_error = None
+
+    async def create(self, spec, lead_filter):
+        """Store a broadcast (status 'running'). Returns (id, number of matching leads)."""
+        return await database.create_broadcast(spec, lead_filter, time.time())
+
+    async def control(self, broadcast_id, action):
+        """pause / resume / cancel. False if the broadcast is not in a state that allows it."""
+        status, expected = _TRANSITIONS[action]
+        moved = await database.set_broadcast_status(broadcast_id, status, expected, time.time())
+        if moved and status == "running":
+            self.wake()
+        return moved
+
+    async def status(self, broadcast_id):
+        """The broadcast row with failures by error code, delivery callbacks and live progress."""
+        row = await database.get_broadcast(broadcast_id)
+        if row is None:
+            return None
+        row["pending"] = max(0, row["total"] - row["sent"] - row["failed"])
+        row["errors"] = await database.broadcast_errors(broadcast_id)
+        row["delivery"] = await database.broadcast_delivery(broadcast_id)
+        if self.live is not None and self.live["id"] == broadcast_id:
+            row["live"] = self.stats()
+        return row
+
+    # --- Service auf dem Scheduler-Leader ---
+
+    def wake(self):
+        """Look for broadcasts to run now (call after creating or resuming one)."""
+        self._wake.set()
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self, timeout=10):
+        if self._task is None:
+            return
+        # Laufende Seite noch zu Ende senden und bestätigen, dann aufhören
+        self._stopping = True
+        self._wake.set()
+        _, pending = await asyncio.wait({self._task}, timeout=timeout)
+        if pending:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def _loop(self):
+        while not self._stopping:
+            try:
+                for row in await database.list_broadcasts("running"):
+                    if self._stopping:
+                        break
+                    await self.run(row["id"])
+            except Exception as e:
+                logger.error(f"Broadcast error: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    # --- Senden ---
+
+    async def run(self, broadcast_id, progress=None):
+        """Send broadcast `broadcast_id` from its checkpoint until it is done, paused,
+        cancelled or this process stops; `progress(stats)` is called after every page.
+        Returns the status afterwards, None if another process is sending it."""
+        lease = f"broadcast:{broadcast_id}"
+        if not await database.acquire_lease(lease, self.owner, time.time(), self.lease_ttl):
+            return None
+        keeper = asyncio.create_task(self._keep_lease(lease))
+        try:
+            return await self._run(broadcast_id, keeper, progress)
+        finally:
+            keeper.cancel()
+            await asyncio.gather(keeper, return_exceptions=True)
+            self.live = None
+            try:
+                await database.release_lease(lease, self.owner)
+            except Exception as e:
+                logger.error(f"Releasing {lease} failed: {e}")
+
+    async def _keep_lease(self, lease):
+        # Endet, sobald der Lease verloren ist; _run hört dann nach der laufenden Seite auf
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                if not await database.acquire_lease(lease, self.owner, time.time(), self.lease_ttl):
+                    logger.warning(f"{lease}: lease lost, stopping after this page")
+                    return
+            except Exception as e:
+                logger.error(f"{lease}: lease renewal failed: {e}")
+
+    async def _run(self, broadcast_id, keeper, progress):
+        row = await database.get_broadcast(broadcast_id)
+        if row is None or row["status"] != "running":
+            return row and row["status"]
+        render = compile_spec(row["spec"])
+        lead_filter = row["filter"]
+        bucket = TokenBucket(self.rate, self.concurrency)
+        sem = asyncio.Semaphore(self.concurrency)
+        self._failures = 0
+        self.live = {"id": broadcast_id, "total": row["total"], "sent": row["sent"], "failed": row["failed"],
+                     "processed": 0, "started": time.monotonic(), "bucket": bucket}
+        logger.info(f"Broadcast {broadcast_id}: sending from {row['cursor'] or 'the start'} "
+                    f"({row['sent'] + row['failed']}/{row['total']} done)")
+
+        status = "running"
+        next_page = asyncio.create_task(database.lead_page(lead_filter, row["cursor"], self.page_size))
+        try:
+            while True:
+                page = await next_page
+                if not page:
+                    if await database.set_broadcast_status(broadcast_id, "done", ("running",), time.time()):
+                        status = "done"
+                    else:
+                        status = (await database.get_broadcast(broadcast_id))["status"]
+                    break
+                cursor = page[-1]["phone"]
+                # Nächste Seite lesen, während diese gesendet wird
+                next_page = asyncio.create_task(database.lead_page(lead_filter, cursor, self.page_size))
+
+                throttled = dispatcher.throttled
+                results = await asyncio.gather(*(self._send(render, lead, bucket, sem) for lead in page))
+                status = await database.broadcast_checkpoint(broadcast_id, cursor, results, time.time())
+                self._adapt(bucket, dispatcher.throttled > throttled)
+                if progress:
+                    progress(self.stats())
+
+                if self._failures >= self.max_failures and status == "running":
+                    error = f"{self._failures} failed sends in a row, last: {self._last_error}"
+                    if await database.set_broadcast_status(broadcast_id, "paused", ("running",), time.time(), error):
+                        status = "paused"
+                    logger.error(f"Broadcast {broadcast_id} paused: {error}")
+                if status != "running" or self._stopping or keeper.done():
+                    break
+        finally:
+            next_page.cancel()
+            await asyncio.gather(next_page, return_exceptions=True)
+        logger.info(f"Broadcast {broadcast_id}: {status} ({self.live['sent']} sent, {self.live['failed']} failed)")
+        return status
+
+    async def _send(self, render, lead, bucket, sem):
+        phone = lead["phone"]
+        async with sem:
+            while not bucket.take():
+                await asyncio.sleep((1 - bucket.tokens) / bucket.rate)
+            try:
+                result = await dispatcher.send(phone, render(phone, lead["name"], lead["language"]))
+            except Exception as e:
+                result = SendResult(False, error=f"{type(e).__name__}: {e}")
+
+        live = self.live
+        live["processed"] += 1
+        if result.ok:
+            self._failures = 0
+            live["sent"] += 1
+            _SENT.inc()
+            return phone, result.message_id, None
+        self._failures += 1
+        self._last_error = result.error
+        live["failed"] += 1
+        _FAILED.inc()
+        # Graph-API-Code, sonst HTTP-Status, 0 = keine Antwort
+        return phone, None, result.error_code if result.error_code is not None else (result.status or 0)
+
+    def _adapt(self, bucket, throttled):
+        # AIMD: bei Drosselung durch die Graph API halbieren, danach schrittweise zurück zu BROADCAST_RATE
+        if throttled:
+            bucket.rate = max(self.rate / 32, bucket.rate / 2)
+            logger.warning(f"Broadcast throttled by the Graph API, rate now {bucket.rate:.1f}/s")
+        else:
+            bucket.rate = min(self.rate, bucket.rate * 1.25)
+
+    def stats(self):
+        live = self.live
+        if live is None:
+            return {"running": None, "owner": self.owner}
+        elapsed = time.monotonic() - live["started"]
+        return {
+            "running": live["id"],
+            "owner": self.owner,
+            "total": live["total"],
+            "sent": live["sent"],
+            "failed": live["failed"],
+            "per_second": round(live["processed"] / elapsed, 1) if elapsed > 0 else None,
+            "rate_limit": round(live["bucket"].rate, 1),
+        }
+
+
+broadcaster = Broadcaster()
+
+
+# --- Kommandozeile ---
+
+def _print_row(row):
+    done = row["sent"] + row["failed"]
+    print(f"  #{row['id']} {row['status']:<9} {done}/{row['total']} "
+          f"(gesendet {row['sent']}, fehlgeschlagen {row['failed']}) "
+          f"{row['spec'].get('template') or 'text'} {row['filter'] or ''}")
+
+
+def _progress_printer():
+    live = sys.stdout.isatty()
+
+    def progress(stats):
+        line = (f"#{stats['running']}: {stats['sent'] + stats['failed']}/{stats['total']} "
+                f"gesendet {stats['sent']}, fehlgeschlagen {stats['failed']}, "
+                f"{stats['per_second']}/s (Limit {stats['rate_limit']}/s)")
+        print(f"\r  {line}".ljust(90) if live else f"  {line}", end="" if live else "\n", flush=True)
+    return progress
+
+
+async def _run_here(broadcast_id):
+    if await database.get_broadcast(broadcast_id) is None:
+        sys.exit(f"Broadcast #{broadcast_id} nicht gefunden")
+    # Strg+C: laufende Seite noch bestätigen (zweimal: sofort abbrechen)
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+
+    def interrupt():
+        if broadcaster._stopping:
+            task.cancel()
+            return
+        broadcaster._stopping = True
+        print("\n  Stoppe nach der laufenden Seite ...", flush=True)
+    loop.add_signal_handler(signal.SIGINT, interrupt)
+
+    delivery.tracker.start()
+    try:
+        status = await broadcaster.run(broadcast_id, _progress_printer())
+    finally:
+        loop.remove_signal_handler(signal.SIGINT)
+        await dispatcher.close()
+        await delivery.tracker.stop()
+    if sys.stdout.isatty():
+        print()
+    if status is None:
+        print(f"  #{broadcast_id} wird bereits von einem anderen Prozess gesendet (Lease broadcast:{broadcast_id}).")
+    else:
+        _print_row(await database.get_broadcast(broadcast_id))
+
+
+async def _main(args):
+    if args.command == "list":
+        for row in await database.list_broadcasts(limit=args.limit):
+            _print_row(row)
+    elif args.command == "status":
+        row = await broadcaster.status(args.id)
+        if row is None:
+            sys.exit(f"Broadcast #{args.id} nicht gefunden")
+        _print_row(row)
+        print(f"  Cursor: {row['cursor']}, offen: {row['pending']}, Fehler je Code: {row['errors']}")
+        print(f"  Zustellung: {row['delivery']}")
+        if row["last_error"]:
+            print(f"  Letzter Fehler: {row['last_error']}")
+    elif args.command in _TRANSITIONS:
+        if not await broadcaster.control(args.id, args.command):
+            sys.exit(f"Broadcast #{args.id}: {args.command} nicht möglich")
+        print(f"  #{args.id}: {_TRANSITIONS[args.command][0]}")
+    elif args.command == "run":
+        await _run_here(args.id)
+    elif args.command == "start":
+        data = {"filter": {"language": args.language, "status": args.lead_status,
+                           "created_after": args.since, "created_before": args.until}}
+        if args.text:
+            data["text"] = args.text
+        if args.template:
+            languages = dict(item.partition("=")[::2] for item in args.languages or ())
+            data.update(template=args.template, params=args.params, languages=languages)
+        try:
+            spec, lead_filter = parse_request(data)
+        except ValueError as e:
+            sys.exit(f"Ungültig: {e}")
+        if args.dry:
+            print(f"  {await database.count_leads(lead_filter)} Leads passen auf {lead_filter or 'alle'} (DRY RUN)")
+            return
+        broadcast_id, total = await broadcaster.create(spec, lead_filter)
+        print(f"  Broadcast #{broadcast_id} an {total} Leads angelegt")
+        if args.detach:
+            print("  Wird vom Bot (Scheduler-Leader) gesendet")
+        else:
+            await _run_here(broadcast_id)
+
+
+def _parse_args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n", 2)[1])
+    sub = p.add_subparsers(dest="command", required=True)
+    start = sub.add_parser("start", help="create a broadcast and send it")
+    message = start.add_mutually_exclusive_group(required=True)
+    message.add_argument("--template", help="approved WhatsApp template")
+    message.add_argument("--text", help="free text with $NAME/$PHONE (only reaches users within 24h)")
+    start.add_argument("--params", nargs="*", choices=PARAM_FIELDS, help="template body parameters")
+    start.add_argument("--languages", nargs="*", metavar="LEAD=CODE", help="template language per lead language")
+    start.add_argument("--language", nargs="*", help="only leads with these languages")
+    start.add_argument("--lead-status", nargs="*", help="only leads with these statuses")
+    start.add_argument("--since", help="only leads created at or after (ISO date, UTC)")
+    start.add_argument("--until", help="only leads created before (ISO date, UTC)")
+    start.add_argument("--dry", action="store_true", help="only count matching leads")
+    start.add_argument("--detach", action="store_true", help="leave sending to the running bot")
+    lst = sub.add_parser("list", help="latest broadcasts")
+    lst.add_argument("--limit", type=int, default=20)
+    for command, help in (("status", "counts, errors and delivery of a broadcast"),
+                          ("run", "send/resume a broadcast in this process"),
+                          ("pause", None), ("resume", None), ("cancel", None)):
+        sub.add_parser(command, help=help).add_argument("id", type=int)
+    return p.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    args = _parse_args()
+    database.init_db()
+    try:
+        asyncio.run(_main(args))
+    finally:
+        database.close()
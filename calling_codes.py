@@ -0,0 +1,119 @@
+"""
+ITU-T E.164 country calling codes -> candidate languages, and a digit trie for
+longest-prefix lookups.
+
+Candidates are ISO 639-1 codes in order of preference; the first one with a
+file in LANG_DIR wins (see localization.Catalog). Longer prefixes refine
+shared codes, e.g. Quebec area codes inside +1 or Kazakhstan inside +7.
+Non-geographic codes (800, 808, 870, 878, 881-883, 888, 979, 991) are left
+out on purpose.
+"""
+
+CALLING_CODES = {
+    # Zone 1: North American Numbering Plan
+    "1": ("en",),
+    "1418": ("fr", "en"), "1438": ("fr", "en"), "1450": ("fr", "en"), "1514": ("fr", "en"),
+    "1579": ("fr", "en"), "1581": ("fr", "en"), "1819": ("fr", "en"), "1873": ("fr", "en"),
+    "1367": ("fr", "en"), "1354": ("fr", "en"), "1468": ("fr", "en"),  # Québec
+    "1787": ("es", "en"), "1939": ("es", "en"),  # Puerto Rico
+    "1809": ("es",), "1829": ("es",), "1849": ("es",),  # Dominikanische Republik
+    "1721": ("nl", "en"),  # Sint Maarten
+
+    # Zone 2: Afrika, Atlantik
+    "20": ("ar",),
+    "211": ("en",), "212": ("ar", "fr"), "213": ("ar", "fr"), "216": ("ar", "fr"), "218": ("ar",),
+    "220": ("en",), "221": ("fr",), "222": ("ar", "fr"), "223": ("fr",), "224": ("fr",),
+    "225": ("fr",), "226": ("fr",), "227": ("fr",), "228": ("fr",), "229": ("fr",),
+    "230": ("en", "fr"), "231": ("en",), "232": ("en",), "233": ("en",), "234": ("en",),
+    "235": ("fr", "ar"), "236": ("fr",), "237": ("fr", "en"), "238": ("pt",), "239": ("pt",),
+    "240": ("es", "fr", "pt"), "241": ("fr",), "242": ("fr",), "243": ("fr",), "244": ("pt",),
+    "245": ("pt",), "246": ("en",), "247": ("en",), "248": ("en", "fr"), "249": ("ar", "en"),
+    "250": ("rw", "en", "fr"), "251": ("am",), "252": ("so", "ar"), "253": ("fr", "ar"), "254": ("en", "sw"),
+    "255": ("sw", "en"), "256": ("en", "sw"), "257": ("rn", "fr"), "258": ("pt",),
+    "260": ("en",), "261": ("mg", "fr"), "262": ("fr",), "263": ("en",), "264": ("en",),
+    "265": ("en",), "266": ("en",), "267": ("en",), "268": ("en",), "269": ("ar", "fr"),
+    "27": ("en", "af"),
+    "290": ("en",), "291": ("ti", "ar", "en"), "297": ("nl",), "298": ("fo", "da"), "299": ("kl", "da"),
+
+    # Zone 3/4: Europa
+    "30": ("el",), "31": ("nl",), "32": ("nl", "fr", "de"), "33": ("fr",), "34": ("es",),
+    "350": ("en",), "351": ("pt",), "352": ("lb", "fr", "de"), "353": ("en",), "354": ("is",),
+    "355": ("sq",), "356": ("mt", "en"), "357": ("el", "tr"), "358": ("fi", "sv"), "359": ("bg",),
+    "36": ("hu",),
+    "370": ("lt",), "371": ("lv",), "372": ("et",), "373": ("ro",), "374": ("hy",),
+    "375": ("be", "ru"), "376": ("ca", "es", "fr"), "377": ("fr",), "378": ("it",), "379": ("it",),
+    "380": ("uk",), "381": ("sr",), "382": ("sr",), "383": ("sq", "sr"), "385": ("hr",),
+    "386": ("sl",), "387": ("bs", "hr", "sr"), "389": ("mk",),
+    "39": ("it",),
+    "40": ("ro",), "41": ("de", "fr", "it"),
+    "420": ("cs",), "421": ("sk",), "423": ("de",),
+    "43": ("de",), "44": ("en",), "45": ("da",), "46": ("sv",), "47": ("nb", "no"), "48": ("pl",), "49": ("de",),
+
+    # Zone 5: Mittel- und Südamerika
+    "500": ("en",), "501": ("en", "es"), "502": ("es",), "503": ("es",), "504": ("es",),
+    "505": ("es",), "506": ("es",), "507": ("es",), "508": ("fr",), "509": ("fr", "ht"),
+    "51": ("es",), "52": ("es",), "53": ("es",), "54": ("es",), "55": ("pt",),
+    "56": ("es",), "57": ("es",), "58": ("es",),
+    "590": ("fr",), "591": ("es",), "592": ("en",), "593": ("es",), "594": ("fr",),
+    "595": ("es", "gn"), "596": ("fr",), "597": ("nl",), "598": ("es",), "599": ("nl", "pap"),
+
+    # Zone 6: Südostasien, Ozeanien
+    "60": ("ms", "en"), "61": ("en",), "62": ("id",), "63": ("en", "tl"), "64": ("en", "mi"),
+    "65": ("en", "zh", "ms"), "66": ("th",),
+    "670": ("pt", "tet"), "672": ("en",), "673": ("ms",), "674": ("en",), "675": ("en",),
+    "676": ("to", "en"), "677": ("en",), "678": ("bi", "en", "fr"), "679": ("en",),
+    "680": ("en",), "681": ("fr",), "682": ("en",), "683": ("en",), "685": ("sm", "en"),
+    "686": ("en",), "687": ("fr",), "688": ("en",), "689": ("fr",),
+    "690": ("en",), "691": ("en",), "692": ("en", "mh"),
+
+    # Zone 7: Russland, Kasachstan
+    "7": ("ru",), "76": ("kk", "ru"), "77": ("kk", "ru"),
+
+    # Zone 8: Ostasien
+    "81": ("ja",), "82": ("ko",), "84": ("vi",), "850": ("ko",), "852": ("zh", "en"),
+    "853": ("zh", "pt"), "855": ("km",), "856": ("lo",), "86": ("zh",),
+    "880": ("bn",), "886": ("zh",),
+
+    # Zone 9: West-, Süd- und Zentralasien, Naher Osten
+    "90": ("tr",), "91": ("hi", "en"), "92": ("ur", "en"), "93": ("ps", "fa"), "94": ("si", "ta", "en"),
+    "95": ("my",),
+    "960": ("dv",), "961": ("ar", "fr"), "962": ("ar",), "963": ("ar",), "964": ("ar", "ku"),
+    "965": ("ar",), "966": ("ar",), "967": ("ar",), "968": ("ar",),
+    "970": ("ar",), "971": ("ar", "en"), "972": ("he", "ar"), "973": ("ar",), "974": ("ar",),
+    "975": ("dz",), "976": ("mn",), "977": ("ne",),
+    "98": ("fa",),
+    "992": ("tg", "ru"), "993": ("tk", "ru"), "994": ("az",), "995": ("ka",), "996": ("ky", "ru"),
+    "998": ("uz", "ru"),
+}
+
+
+class PrefixTrie:
+    """Digit trie: longest_match() walks at most len(number) nodes."""
+
+    __slots__ = ("_root", "size")
+
+    def __init__(self, items=()):
+        # Knoten: [Kinder {Ziffer: Knoten}, Wert]
+        self._root = [{}, None]
+        self.size = 0
+        for prefix, value in items:
+            self.insert(prefix, value)
+
+    def insert(self, prefix, value):
+        node = self._root
+        for digit in prefix:
+            children = node[0]
+            node = children.get(digit) or children.setdefault(digit, [{}, None])
+        if node[1] is None:
+            self.size += 1
+        node[1] = value
+
+    def longest_match(self, number, default=None):
+        node, found = self._root, default
+        for digit in number:
+            node = node[0].get(digit)
+            if node is None:
+                break
+            if node[1] is not None:
+                found = node[1]
+        return found
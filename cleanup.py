@@ -1,51 +1,202 @@
 """
-Cleanup: Deletes old DB entries (leads, email_log) past retention time.
-Runs as background task in FastAPI or standalone via: python cleanup.py
+Cleanup: Retention engine for all DB tables.
+
+Every table has its own policy (see default_policies()). Rows are deleted in
+chunks of CLEANUP_BATCH, each chunk is one short transaction on the DB writer
+thread; between chunks the scheduler yields (CLEANUP_PAUSE) so webhook writes
+are not blocked behind a large purge.
+
+Runs as scheduler job in FastAPI (see scheduler.py) or standalone via:
+  python cleanup.py          # Normaler Lauf
+  python cleanup.py --dry    # Nur anzeigen, nichts löschen
+
+Cron-Beispiel (täglich 3 Uhr):
+  0 3 * * * cd /path/to/project && python cleanup.py >> data/cleanup.log 2>&1
 """
 
 import asyncio
 import logging
-from database import init_db, get_db
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime
+import database
+from database import init_db
 from config import Config
 
 logger = logging.getLogger(__name__)
 
 
-def cleanup_old_entries():
-    """Delete DB entries older than DATA_RETENTION_TIME."""
-    db = get_db()
+def _older_than(seconds):
+    return lambda: (f"-{seconds} seconds",)
 
-    deleted_leads = db.execute(
-        "DELETE FROM leads WHERE phone IN (SELECT phone FROM email_log WHERE deletion_requested = 1)"
-    ).rowcount
 
-    deleted_logs = db.execute(
-        "DELETE FROM email_log WHERE deletion_requested = 1 AND deletion_requested_at < datetime('now', ?)",
-        (f"-{Config.DATA_RETENTION_SECONDS} seconds",)
+@dataclass
+class Policy:
+    """Rows of `table` matching `where` are expired; `key` identifies a row for chunked deletes."""
+    name: str
+    table: str
+    where: str
+    params: object = tuple  # fn() -> SQL-Parameter für `where`, beim Lauf ausgewertet
+    key: str = "rowid"
+    enabled: bool = True
+
+
+def default_policies():
+    return [
+        # Leads, deren Löschung angefordert wurde (Reihenfolge: vor email_log)
+        Policy("leads", "leads",
+               "phone IN (SELECT phone FROM email_log WHERE deletion_requested = 1)"),
+        Policy("email_log", "email_log",
+               "deletion_requested = 1 AND deletion_requested_at < datetime('now', ?)",
+               _older_than(Config.DATA_RETENTION_SECONDS)),
+        # Dedup-Gedächtnis; muss DEDUP_WARM abdecken
+        Policy("processed_messages", "processed_messages",
+               "timestamp < datetime('now', ?)",
+               _older_than(Config.RETENTION_PROCESSED_MESSAGES), key="msg_id",
+               enabled=Config.RETENTION_PROCESSED_MESSAGES > 0),
+        Policy("sessions_completed", "sessions",
+               "step = 'COMPLETED' AND updated_at < datetime('now', ?)",
+               _older_than(Config.RETENTION_COMPLETED_SESSIONS),
+               enabled=Config.RETENTION_COMPLETED_SESSIONS > 0),
+        Policy("sessions_stale", "sessions",
+               "updated_at < datetime('now', ?)",
+               _older_than(Config.RETENTION_STALE_SESSIONS),
+               enabled=Config.RETENTION_STALE_SESSIONS > 0),
+        Policy("outbox_done", "outbox",
+               "status = 'done' AND done_at < datetime('now', ?)",
+               _older_than(Config.RETENTION_OUTBOX_DONE),
+               enabled=Config.RETENTION_OUTBOX_DONE > 0),
+        # Dead-Letter enthalten Lead-Daten -> gleiche Frist wie email_log
+        Policy("outbox_dead", "outbox",
+               "status = 'dead' AND created_at < datetime('now', ?)",
+               _older_than(Config.DATA_RETENTION_SECONDS)),
+        Policy("delivery_status", "delivery_status", "updated_at < ?",
+               lambda: (time.time() - Config.RETENTION_DELIVERY_STATUS,), key="wamid",
+               enabled=Config.RETENTION_DELIVERY_STATUS > 0),
+        # Empfängerlisten abgeschlossener Broadcasts (Telefonnummern)
+        Policy("broadcast_recipients", "broadcast_recipients",
+               "broadcast_id IN (SELECT id FROM broadcasts WHERE finished_at < ?)",
+               lambda: (time.time() - Config.RETENTION_BROADCAST_RECIPIENTS,),
+               enabled=Config.RETENTION_BROADCAST_RECIPIENTS > 0),
+        Policy("phone_locks", "phone_locks", "expires_at < ?", lambda: (time.time(),), key="phone"),
+    ]
+
+
+def _prune_chunk(db, policy, params, limit):
+    return db.execute(
+        f"DELETE FROM {policy.table} WHERE {policy.key} IN "
+        f"(SELECT {policy.key} FROM {policy.table} WHERE {policy.where} LIMIT ?)",
+        (*params, limit)
     ).rowcount
 
-    db.commit()
 
-    if deleted_leads or deleted_logs:
-        logger.info(f"Cleanup: {deleted_leads} leads, {deleted_logs} email_log entries deleted.")
+def _optimize(db):
+    # Planner-Statistiken (sqlite_stat1) aktuell halten; analysis_limit hält ANALYZE billig
+    db.execute("PRAGMA analysis_limit = 1000")
+    db.execute("PRAGMA optimize")
+
+
+def _dry_run(db, runs, limit):
+    # Derselbe Lösch-Pfad wie im echten Lauf (gleiche Chunks, gleiche Reihenfolge, also auch
+    # überlappende Policies), aber in einem Savepoint, der am Ende zurückgerollt wird
+    db.execute("SAVEPOINT retention_dry_run")
+    try:
+        results = {}
+        for policy, params in runs:
+            total = 0
+            while True:
+                deleted = _prune_chunk(db, policy, params, limit)
+                total += deleted
+                if deleted < limit:
+                    break
+            results[policy.name] = total
+        return results
+    finally:
+        db.execute("ROLLBACK TO retention_dry_run")
+        db.execute("RELEASE retention_dry_run")
+
+
+class RetentionEngine:
+    def __init__(self, policies=None, batch=None, pause=None):
+        self.policies = policies if policies is not None else default_policies()
+        self.batch = batch or Config.CLEANUP_BATCH
+        self.pause = Config.CLEANUP_PAUSE if pause is None else pause
+        self.last_run = None
+
+    async def run(self, dry_run=False, progress=None):
+        """
+        Apply all enabled policies. Returns {policy name: rows deleted}. With dry_run the
+        deletes run in one transaction that is rolled back, so the counts are what a
+        real run would delete now. `progress(policy, rows_so_far)` is called after every chunk.
+        """
+        started = time.monotonic()
+        runs = [(policy, policy.params()) for policy in self.policies if policy.enabled]
+        if dry_run:
+            # Eine Transaktion auf dem Writer; zählt, was ein echter Lauf jetzt löschen würde
+            results = await database.write(_dry_run, runs, self.batch)
+            if progress:
+                for policy, _ in runs:
+                    progress(policy, results[policy.name])
+        else:
+            results = {}
+            for policy, params in runs:
+                total = 0
+                while True:
+                    deleted = await database.write(_prune_chunk, policy, params, self.batch)
+                    total += deleted
+                    if progress:
+                        progress(policy, total)
+                    if deleted < self.batch:
+                        break
+                    # Andere Schreiber zwischen den Chunks drankommen lassen
+                    await asyncio.sleep(self.pause)
+                results[policy.name] = total
+            await database.write(_optimize)
+
+        elapsed = time.monotonic() - started
+        self.last_run = {"at": time.time(), "dry_run": dry_run, "seconds": round(elapsed, 3), "rows": results}
+        if any(results.values()):
+            summary = ", ".join(f"{n} {name}" for name, n in results.items() if n)
+            logger.info(f"Cleanup{' (dry run)' if dry_run else ''}: {summary} in {elapsed:.2f}s")
+        return results
+
+    def stats(self):
+        return {"batch": self.batch, "last_run": self.last_run}
+
+
+retention = RetentionEngine()
+
+
+async def cleanup_old_entries(dry_run=False, progress=None):
+    """Apply all retention policies (chunked, on the DB writer thread)."""
+    return await retention.run(dry_run, progress)
+
 
+async def _main(dry_run):
+    print(f"[{datetime.now().isoformat()}] Cleanup gestartet (DB: {Config.DB_PATH})")
+    if dry_run:
+        print("  DRY RUN — nichts wird gelöscht")
 
-async def run_scheduler():
-    """Background scheduler: startup check + periodic cleanup."""
-    interval = Config.CLEANUP_INTERVAL_SECONDS
-    logger.info(f"Cleanup-Scheduler started (interval: {interval}s)")
+    live = sys.stdout.isatty()
 
-    cleanup_old_entries()
+    def progress(policy, rows):
+        if live:
+            print(f"\r  {policy.name}: {rows} ...".ljust(60), end="", flush=True)
 
-    while True:
-        await asyncio.sleep(interval)
-        try:
-            cleanup_old_entries()
-        except Exception as e:
-            logger.error(f"Cleanup error: {e}")
+    results = await cleanup_old_entries(dry_run, progress)
+    if live:
+        print("\r".ljust(61), end="\r")
+    for name, rows in results.items():
+        print(f"  {name}: {rows}")
+    total = sum(results.values())
+    print(f"  {total} Zeilen {'betroffen' if dry_run else 'gelöscht'}.")
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+    logging.basicConfig(level=logging.WARNING)
     init_db()
-    cleanup_old_entries()
+    try:
+        asyncio.run(_main("--dry" in sys.argv))
+    finally:
+        database.close()
@@ -19,6 +19,19 @@ def parse_duration(s, default_seconds=30*86400):
     d, h, mi, sec = (int(g or 0) for g in m.groups())
     return d * 86400 + h * 3600 + mi * 60 + sec
 
+def parse_prefixes(s):
+    """Parse '34=es, 1418=fr' to {'34': 'es', '1418': 'fr'} (calling-code prefix -> language)."""
+    result = {}
+    for item in (s or "").split(","):
+        prefix, _, lang = item.partition("=")
+        prefix, lang = prefix.strip().lstrip("+"), lang.strip()
+        if not prefix.isdigit() or not lang:
+            if item.strip():
+                raise ValueError(f"LANGUAGE_PREFIXES: expected <digits>=<lang>, got {item.strip()!r}")
+            continue
+        result[prefix] = lang
+    return result
+
 class Config:
     # Meta API
     WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
@@ -26,6 +39,59 @@ class Config:
     VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
     APP_SECRET = os.getenv("APP_SECRET")
     BASE_URL = os.getenv("BASE_URL", "https://localhost")
+    GRAPH_API_URL = os.getenv("GRAPH_API_URL", "https://graph.facebook.com/v18.0").rstrip("/")
+
+    # Outbound WhatsApp dispatcher
+    WA_MAX_CONCURRENCY = int(os.getenv("WA_MAX_CONCURRENCY", "16"))
+    WA_MAX_RETRIES = int(os.getenv("WA_MAX_RETRIES", "4"))
+    WA_HTTP2 = os.getenv("WA_HTTP2", "true").lower() == "true"
+    WA_TIMEOUT = float(os.getenv("WA_TIMEOUT", "10"))
+    WA_BACKOFF_BASE = float(os.getenv("WA_BACKOFF_BASE", "0.5"))
+    WA_BACKOFF_MAX = float(os.getenv("WA_BACKOFF_MAX", "30"))
+
+    # Ingest queue (webhook -> worker pool)
+    INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "8"))
+    INGEST_MAX_DEPTH = int(os.getenv("INGEST_MAX_DEPTH", "1000"))
+    INGEST_OVERFLOW = os.getenv("INGEST_OVERFLOW", "reject").lower()  # reject (503) | drop
+    INGEST_DRAIN_TIMEOUT = float(os.getenv("INGEST_DRAIN_TIMEOUT", "10"))
+
+    # Rate limits am Webhook (ratelimit.py)
+    RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))  # 0 = aus
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "10"))
+    RATE_LIMIT_NOTICE_WINDOW = parse_duration(os.getenv("RATE_LIMIT_NOTICE_WINDOW", "10m"), default_seconds=600)
+    RATE_LIMIT_MAX_PHONES = int(os.getenv("RATE_LIMIT_MAX_PHONES", "50000"))
+    RATE_LIMIT_GLOBAL = float(os.getenv("RATE_LIMIT_GLOBAL", "80"))  # Nachrichten/s, 0 = aus
+    RATE_LIMIT_GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "160"))
+
+    # Dedup cache (in front of processed_messages)
+    DEDUP_TTL_SECONDS = parse_duration(os.getenv("DEDUP_TTL", "1d"), default_seconds=86400)
+    DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "100000"))
+    DEDUP_FLUSH_INTERVAL = float(os.getenv("DEDUP_FLUSH_INTERVAL", "1"))
+    DEDUP_FLUSH_BATCH = int(os.getenv("DEDUP_FLUSH_BATCH", "500"))
+    DEDUP_WARM_SECONDS = parse_duration(os.getenv("DEDUP_WARM", "1d"), default_seconds=86400)
+
+    # State backend (sessions, dedup, per-phone locks): sqlite | memory | redis
+    STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").lower()
+    # sqlite: true, wenn mehrere Prozesse dieselbe DB nutzen (uvicorn --workers N)
+    STATE_SHARED = os.getenv("STATE_SHARED", "false").lower() == "true"
+    REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    REDIS_PREFIX = os.getenv("REDIS_PREFIX", "wabot")
+    SESSION_TTL_SECONDS = parse_duration(os.getenv("SESSION_TTL", "7d"), default_seconds=7*86400)
+    LOCK_TTL = float(os.getenv("LOCK_TTL", "60"))
+    LOCK_WAIT = float(os.getenv("LOCK_WAIT", "30"))
+    # Wartezeit-Statistik pro Nummer (begrenzt, inaktive Nummern fliegen raus)
+    PHONE_STATS_MAX = int(os.getenv("PHONE_STATS_MAX", "1000"))
+    PHONE_STATS_IDLE = parse_duration(os.getenv("PHONE_STATS_IDLE", "10m"), default_seconds=600)
+
+    # Session cache (write-behind)
+    SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+    SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", "2"))
+    SESSION_FLUSH_THRESHOLD = int(os.getenv("SESSION_FLUSH_THRESHOLD", "100"))
+
+    # Zustellstatus ausgehender Nachrichten (write-behind, delivery.py)
+    DELIVERY_TRACKING = os.getenv("DELIVERY_TRACKING", "false").lower() == "true"
+    DELIVERY_FLUSH_INTERVAL = float(os.getenv("DELIVERY_FLUSH_INTERVAL", "10"))
+    DELIVERY_FLUSH_THRESHOLD = int(os.getenv("DELIVERY_FLUSH_THRESHOLD", "1000"))
     
     # Owner Info
     OWNER_NAME = os.getenv("OWNER_NAME", "Alexander")
@@ -39,12 +105,64 @@ class Config:
     SMTP_PASS = os.getenv("SMTP_PASS")
     SMTP_FROM = os.getenv("SMTP_FROM")
     SMTP_VERIFY_TLS = os.getenv("SMTP_VERIFY_TLS", "true").lower() == "true"
+    SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "true").lower() == "true"
+    SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "10"))
+    # Wiederverwendete SMTP-Sessions (email_service.SMTPPool)
+    SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+    SMTP_HEALTHCHECK_AFTER = parse_duration(os.getenv("SMTP_HEALTHCHECK_AFTER", "30s"), default_seconds=30)
+    SMTP_MAX_IDLE = parse_duration(os.getenv("SMTP_MAX_IDLE", "5m"), default_seconds=300)
+    # Lead-Digest: mehr als THRESHOLD Leads pro WINDOW -> Sammelmail (0 = aus)
+    LEAD_DIGEST_THRESHOLD = int(os.getenv("LEAD_DIGEST_THRESHOLD", "0"))
+    LEAD_DIGEST_WINDOW = parse_duration(os.getenv("LEAD_DIGEST_WINDOW", "1m"), default_seconds=60)
+    LEAD_DIGEST_MAX = int(os.getenv("LEAD_DIGEST_MAX", "50"))
+
+    # Outbox (Lead-/Privacy-Mails, asynchrone WhatsApp-Nachrichten)
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+    OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "20"))
+    OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "120"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    OUTBOX_BACKOFF_BASE = parse_duration(os.getenv("OUTBOX_BACKOFF_BASE", "30s"), default_seconds=30)
+    OUTBOX_BACKOFF_MAX = parse_duration(os.getenv("OUTBOX_BACKOFF_MAX", "1h"), default_seconds=3600)
+
+    # Broadcasts an gespeicherte Leads (broadcast.py); Admin-Endpoints nur mit ADMIN_TOKEN
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+    BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "20"))  # Nachrichten/s, Obergrenze
+    BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "4"))  # < WA_MAX_CONCURRENCY
+    BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "200"))
+    BROADCAST_MAX_FAILURES = int(os.getenv("BROADCAST_MAX_FAILURES", "50"))  # in Folge -> pausieren
+    BROADCAST_POLL_INTERVAL = parse_duration(os.getenv("BROADCAST_POLL_INTERVAL", "30s"), default_seconds=30)
 
     # Privacy
     PRIVACY_EMAIL = os.getenv("PRIVACY_EMAIL")
     DATA_RETENTION_SECONDS = parse_duration(os.getenv("DATA_RETENTION_TIME", "30d"))
+    # Hintergrund-Jobs laufen nur im Worker mit dem Scheduler-Lease (scheduler.py)
+    SCHEDULER_LEASE_TTL = parse_duration(os.getenv("SCHEDULER_LEASE_TTL", "30s"), default_seconds=30)
+    SCHEDULER_HEARTBEAT = parse_duration(os.getenv("SCHEDULER_HEARTBEAT", "10s"), default_seconds=10)
+    SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "0.1"))
     CLEANUP_INTERVAL_SECONDS = parse_duration(os.getenv("CLEANUP_INTERVAL", "1h"), default_seconds=3600)
+    # Aufbewahrung je Tabelle (0 = nie löschen)
+    RETENTION_PROCESSED_MESSAGES = parse_duration(os.getenv("RETENTION_PROCESSED_MESSAGES", "1d"), default_seconds=86400)
+    RETENTION_COMPLETED_SESSIONS = parse_duration(os.getenv("RETENTION_COMPLETED_SESSIONS", "1d"), default_seconds=86400)
+    RETENTION_STALE_SESSIONS = parse_duration(os.getenv("RETENTION_STALE_SESSIONS", "7d"), default_seconds=604800)
+    RETENTION_OUTBOX_DONE = parse_duration(os.getenv("RETENTION_OUTBOX_DONE", "7d"), default_seconds=604800)
+    RETENTION_DELIVERY_STATUS = parse_duration(os.getenv("RETENTION_DELIVERY_STATUS", "7d"), default_seconds=604800)
+    RETENTION_BROADCAST_RECIPIENTS = parse_duration(os.getenv("RETENTION_BROADCAST_RECIPIENTS", "30d"))
+    # Gelöscht wird in Chunks, mit Pause dazwischen
+    CLEANUP_BATCH = int(os.getenv("CLEANUP_BATCH", "500"))
+    CLEANUP_PAUSE = float(os.getenv("CLEANUP_PAUSE", "0.05"))
 
     # Paths
     DB_PATH = os.getenv("DB_PATH", "data/bot.db")
+    DB_READERS = int(os.getenv("DB_READERS", "4"))
+    # SQLite-Tuning pro Connection
+    DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").upper()
+    DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))
+    DB_MMAP_MB = int(os.getenv("DB_MMAP_MB", "64"))
+    DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "5"))
     LANG_DIR = os.getenv("LANG_DIR", "lang")
+    # Sprache nach Vorwahl: "34=es,1418=fr" ergänzt/ersetzt calling_codes.py; Fallback DEFAULT_LANGUAGE
+    LANGUAGE_PREFIXES = parse_prefixes(os.getenv("LANGUAGE_PREFIXES", ""))
+    DEFAULT_LANGUAGE = os.getenv("DEFAULT_LANGUAGE", "en")
+    FLOW_FILE = os.getenv("FLOW_FILE", "flows/lead.json")
+    # Sekunden zwischen Checks auf geänderte Sprachdateien (0 = kein Hot-Reload)
+    LANG_RELOAD_INTERVAL = float(os.getenv("LANG_RELOAD_INTERVAL", "5"))
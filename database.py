@@ -1,18 +1,142 @@
+import asyncio
 import sqlite3
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from config import Config
+import metrics
+
+# --- Connection Pool ---
+# Ein Writer (eigener Thread, serialisiert alle Schreibzugriffe -> kein "database is locked"
+# zwischen eigenen Connections) und mehrere Reader unter WAL. Alle Connections leben so
+# lange wie der Prozess; sqlite3 cached die Prepared Statements pro Connection.
+
+_write_executor = None
+_read_executor = None
+_writer = None
+_readers = []
+_local = threading.local()
+_pool_lock = threading.Lock()
+
+def _configure(conn):
+    # Verbindungs-Pragmas (gelten nur für diese Connection, nicht für die Datei)
+    conn.execute(f"PRAGMA busy_timeout = {int(Config.DB_BUSY_TIMEOUT * 1000)}")
+    # Unter WAL ist NORMAL sicher gegen Korruption; nur die letzten Commits vor einem Stromausfall können fehlen
+    conn.execute(f"PRAGMA synchronous = {Config.DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {-Config.DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {Config.DB_MMAP_MB * 1024 * 1024}")
 
 def get_db():
-    conn = sqlite3.connect(Config.DB_PATH, check_same_thread=False)
+    """Open a standalone connection (scripts, tools). The bot itself uses the pool."""
+    conn = sqlite3.connect(Config.DB_PATH, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    _configure(conn)
     return conn
 
-def init_db():
-    db = get_db()
+def _executors():
+    global _write_executor, _read_executor
+    if _write_executor is None:
+        with _pool_lock:
+            if _write_executor is None:
+                _read_executor = ThreadPoolExecutor(Config.DB_READERS, thread_name_prefix="db-read")
+                _write_executor = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+    return _write_executor, _read_executor
+
+def _run_write(fn, args):
+    global _writer
+    if _writer is None:
+        _writer = get_db()
+        _writer.execute("PRAGMA journal_mode=WAL")
+    try:
+        result = fn(_writer, *args)
+        _writer.commit()
+        return result
+    except BaseException:
+        _writer.rollback()
+        raise
+
+def _run_read(fn, args):
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = get_db()
+        conn.execute("PRAGMA query_only=ON")
+        with _pool_lock:
+            _readers.append(conn)
+    return fn(conn, *args)
+
+def _timed(run, fn, args):
+    # Zeit im DB-Thread messen, beobachtet wird im Event-Loop (keine Locks in metrics)
+    started = time.perf_counter()
+    result = run(fn, args)
+    return result, time.perf_counter() - started
+
+async def write(fn, *args):
+    """Run fn(conn, *args) on the writer thread inside one transaction."""
+    result, elapsed = await asyncio.wrap_future(_executors()[0].submit(_timed, _run_write, fn, args))
+    metrics.DB_QUERY_SECONDS.labels(fn.__name__.lstrip("_"), "write").observe(elapsed)
+    return result
+
+async def read(fn, *args):
+    """Run fn(conn, *args) on a reader thread."""
+    result, elapsed = await asyncio.wrap_future(_executors()[1].submit(_timed, _run_read, fn, args))
+    metrics.DB_QUERY_SECONDS.labels(fn.__name__.lstrip("_"), "read").observe(elapsed)
+    return result
+
+def write_sync(fn, *args):
+    """Blocking variant of write() for startup code and standalone scripts."""
+    return _executors()[0].submit(_run_write, fn, args).result()
+
+def _ping(db):
+    return db.execute("SELECT 1").fetchone()
+
+def _open_reader(barrier):
+    _run_read(_ping, ())
+    # Thread festhalten, bis alle dran waren -> jeder Reader-Thread öffnet seine eigene Connection
+    try:
+        barrier.wait(5)
+    except threading.BrokenBarrierError:
+        pass
+
+async def open_pool():
+    """Open every reader connection now instead of on first use (the writer is opened by init_db)."""
+    _, reader = _executors()
+    barrier = threading.Barrier(Config.DB_READERS)
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*(loop.run_in_executor(reader, _open_reader, barrier) for _ in range(Config.DB_READERS)))
+    return len(_readers)
+
+def close():
+    """Close all pooled connections and stop the executor threads."""
+    global _write_executor, _read_executor, _writer
+    if _write_executor is None:
+        return
+    def _close_writer():
+        global _writer
+        if _writer is not None:
+            _writer.close()
+            _writer = None
+    _write_executor.submit(_close_writer).result()
+    _write_executor.shutdown()
+    _read_executor.shutdown()
+    with _pool_lock:
+        for conn in _readers:
+            conn.close()
+        _readers.clear()
+    _write_executor = _read_executor = None
+
+# --- Schema ---
+# Migrationen laufen in Reihenfolge, jede genau einmal; PRAGMA user_version = Anzahl
+# angewandter Schritte. Neue Schritte nur hinten anhängen, bestehende nie ändern.
 
-    db.execute("PRAGMA journal_mode=WAL")
+def _add_column(db, table, column, ddl):
+    # Alt-Datenbanken (vor dem Migration-Runner) haben manche Spalten noch nicht
+    if column not in {row["name"] for row in db.execute(f"PRAGMA table_info({table})")}:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
 
+def _m1_baseline(db):
+    """Tables as created by init_db before versioned migrations."""
     # Sessions: Jetzt mit 'language'
     db.execute("""
         CREATE TABLE IF NOT EXISTS sessions (
@@ -23,13 +147,8 @@ def init_db():
             updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    _add_column(db, "sessions", "updated_at", "DATETIME DEFAULT CURRENT_TIMESTAMP")
 
-    # Migration: updated_at nachrüsten falls Tabelle schon existiert
-    try:
-        db.execute("ALTER TABLE sessions ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP")
-    except sqlite3.OperationalError:
-        pass  # Spalte existiert bereits
-    
     # Leads
     db.execute("""
         CREATE TABLE IF NOT EXISTS leads (
@@ -45,15 +164,32 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    _add_column(db, "leads", "call_optin", "INTEGER DEFAULT 0")
 
-    # Migration: call_optin nachrüsten falls Tabelle schon existiert
-    try:
-        db.execute("ALTER TABLE leads ADD COLUMN call_optin INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
-    
     db.execute("CREATE TABLE IF NOT EXISTS processed_messages (msg_id TEXT PRIMARY KEY, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
 
+    # Outbox: E-Mails / WhatsApp-Nachrichten, in derselben Transaktion wie die
+    # auslösende Änderung geschrieben und von outbox.py zugestellt
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            idem_key TEXT NOT NULL UNIQUE,
+            phone TEXT,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            lease_until REAL,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            done_at DATETIME
+        )
+    """)
+
+    # Per-Phone Locks über Prozessgrenzen (nur bei STATE_SHARED=true genutzt)
+    db.execute("CREATE TABLE IF NOT EXISTS phone_locks (phone TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
     # Email Log für DSGVO-Tracking
     db.execute("""
         CREATE TABLE IF NOT EXISTS email_log (
@@ -69,64 +205,562 @@ def init_db():
         )
     """)
 
-    db.commit()
+def _m2_processed_messages_without_rowid(db):
+    """processed_messages is only ever looked up by msg_id: store it clustered on the key."""
+    db.execute("""
+        CREATE TABLE processed_messages_new (
+            msg_id TEXT PRIMARY KEY,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    """)
+    db.execute("INSERT INTO processed_messages_new (msg_id, timestamp) SELECT msg_id, timestamp FROM processed_messages")
+    db.execute("DROP TABLE processed_messages")
+    db.execute("ALTER TABLE processed_messages_new RENAME TO processed_messages")
 
-def is_msg_processed(msg_id):
-    db = get_db()
-    try:
-        db.execute("INSERT INTO processed_messages (msg_id) VALUES (?)", (msg_id,))
-        db.commit()
-        return False
-    except sqlite3.IntegrityError:
-        return True
-
-def get_session(phone):
-    res = get_db().execute("SELECT step, context, language FROM sessions WHERE phone = ?", (phone,)).fetchone()
+def _m3_indexes(db):
+    """Indexes for cleanup, dedup warm-up, outbox polling and data deletion."""
+    # Dedup-Warmup + Retention; msg_id steckt als Primärschlüssel mit im Index
+    db.execute("CREATE INDEX IF NOT EXISTS idx_processed_messages_timestamp ON processed_messages (timestamp)")
+    # Retention: COMPLETED-Sessions / inaktive Sessions
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_step_updated ON sessions (step, updated_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+    # Löschanfragen (Cleanup von leads und email_log), deckt phone mit ab
+    db.execute("CREATE INDEX IF NOT EXISTS idx_email_log_deletion "
+               "ON email_log (deletion_requested, deletion_requested_at, phone)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_email_log_phone ON email_log (phone)")
+    # Outbox: fällige Einträge claimen, Einträge einer Nummer löschen
+    db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_outbox_phone ON outbox (phone)")
+
+def _m4_delivery_status(db):
+    """Delivery status per outgoing WhatsApp message (delivery.py), times as unix seconds."""
+    db.execute("""
+        CREATE TABLE delivery_status (
+            wamid TEXT PRIMARY KEY,
+            phone TEXT,
+            sent_at REAL,
+            delivered_at REAL,
+            read_at REAL,
+            failed_at REAL,
+            error_code INTEGER,
+            updated_at REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    # Auswertung nach Sendezeit, Retention, Datenlöschung
+    db.execute("CREATE INDEX idx_delivery_status_sent ON delivery_status (sent_at)")
+    db.execute("CREATE INDEX idx_delivery_status_updated ON delivery_status (updated_at)")
+    db.execute("CREATE INDEX idx_delivery_status_phone ON delivery_status (phone)")
+
+def _m5_leases(db):
+    """Named leases (leader election of scheduler.py)."""
+    db.execute("CREATE TABLE leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL) WITHOUT ROWID")
+
+def _m6_broadcasts(db):
+    """Broadcasts to stored leads with their checkpoint, and one row per processed recipient (broadcast.py)."""
+    db.execute("""
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            spec TEXT NOT NULL,
+            filter TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor TEXT,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            updated_at REAL NOT NULL,
+            finished_at REAL
+        )
+    """)
+    db.execute("""
+        CREATE TABLE broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            wamid TEXT,
+            error_code INTEGER,
+            PRIMARY KEY (broadcast_id, phone)
+        )
+    """)
+    # Datenlöschung pro Nummer
+    db.execute("CREATE INDEX idx_broadcast_recipients_phone ON broadcast_recipients (phone)")
+
+MIGRATIONS = [
+    _m1_baseline,
+    _m2_processed_messages_without_rowid,
+    _m3_indexes,
+    _m4_delivery_status,
+    _m5_leases,
+    _m6_broadcasts,
+]
+
+def schema_version(db):
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+def _migrate(db):
+    """Apply pending migrations in one transaction. Returns the list of applied steps."""
+    version = schema_version(db)
+    if version >= len(MIGRATIONS):
+        return []  # Schema aktuell: kein DDL
+    # sqlite3 öffnet vor DDL keine Transaktion von selbst
+    db.execute("BEGIN IMMEDIATE")
+    # Nochmal lesen: ein anderer Prozess könnte inzwischen migriert haben
+    version = schema_version(db)
+    pending = MIGRATIONS[version:]
+    for step in pending:
+        step(db)
+    db.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+    return [step.__name__ for step in pending]
+
+
+def init_db():
+    applied = write_sync(_migrate)
+    if applied:
+        print(f"DB migrated to schema version {len(MIGRATIONS)}: {', '.join(applied)}")
+
+# --- Processed Messages ---
+
+def _filter_new_messages(db, msg_ids):
+    placeholders = ", ".join("(?)" for _ in msg_ids)
+    rows = db.execute(
+        f"INSERT INTO processed_messages (msg_id) VALUES {placeholders} "
+        "ON CONFLICT(msg_id) DO NOTHING RETURNING msg_id",
+        msg_ids
+    ).fetchall()
+    return {r["msg_id"] for r in rows}
+
+async def filter_new_messages(msg_ids):
+    """Mark a batch of message IDs as processed in one statement.
+    Returns the set of IDs that were not seen before."""
+    msg_ids = list(dict.fromkeys(msg_ids))
+    if not msg_ids:
+        return set()
+    return await write(_filter_new_messages, msg_ids)
+
+def _mark_msgs_processed(db, msg_ids):
+    db.executemany("INSERT OR IGNORE INTO processed_messages (msg_id) VALUES (?)",
+                   [(m,) for m in msg_ids])
+
+async def mark_msgs_processed(msg_ids):
+    """Persist already-deduplicated message IDs (batched write-behind of dedup.py)."""
+    await write(_mark_msgs_processed, msg_ids)
+
+def _forget_msgs(db, msg_ids):
+    db.executemany("DELETE FROM processed_messages WHERE msg_id = ?", [(m,) for m in msg_ids])
+
+async def forget_msgs(msg_ids):
+    """Remove claimed message IDs again (the message could not be queued)."""
+    await write(_forget_msgs, msg_ids)
+
+def _recent_processed_ids(db, seconds):
+    rows = db.execute(
+        "SELECT msg_id, (julianday('now') - julianday(timestamp)) * 86400 AS age "
+        "FROM processed_messages WHERE timestamp >= datetime('now', ?) ORDER BY timestamp",
+        (f"-{int(seconds)} seconds",)
+    ).fetchall()
+    return [(r["msg_id"], r["age"]) for r in rows]
+
+async def recent_processed_ids(seconds):
+    """(msg_id, age_in_seconds) of the last `seconds`, oldest first."""
+    return await read(_recent_processed_ids, seconds)
+
+# --- Sessions ---
+
+def _get_session(db, phone):
+    res = db.execute("SELECT step, context, language FROM sessions WHERE phone = ?", (phone,)).fetchone()
     if res:
         return res["step"], json.loads(res["context"]), res["language"]
     return "START", {}, None # None = Sprache noch nicht gesetzt
 
-def update_session(phone, step, context, language=None):
-    db = get_db()
-    # Bestehende Sprache holen, falls language=None
-    if language is None:
-        curr = db.execute("SELECT language FROM sessions WHERE phone = ?", (phone,)).fetchone()
-        language = curr["language"] if curr else "en"
-        
-    db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)",
-               (phone, step, json.dumps(context), language))
-    db.commit()
-
-def clear_session(phone):
+async def get_session(phone):
+    return await read(_get_session, phone)
+
+def _update_session(db, phone, step, context, language=None):
+    # language=None -> bestehende Sprache behalten (neue Session: 'en'), ohne extra SELECT
+    db.execute("""
+        INSERT INTO sessions (phone, step, context, language, updated_at)
+        VALUES (?, ?, ?, COALESCE(?, 'en'), CURRENT_TIMESTAMP)
+        ON CONFLICT(phone) DO UPDATE SET
+            step = excluded.step,
+            context = excluded.context,
+            language = COALESCE(?, sessions.language),
+            updated_at = CURRENT_TIMESTAMP
+    """, (phone, step, json.dumps(context), language, language))
+
+async def update_session(phone, step, context, language=None):
+    await write(_update_session, phone, step, context, language)
+
+def _save_sessions(db, rows):
+    for phone, step, context, language in rows:
+        _update_session(db, phone, step, context, language)
+
+async def save_sessions(rows):
+    """Upsert many (phone, step, context, language) rows in one transaction."""
+    if rows:
+        await write(_save_sessions, rows)
+
+def _clear_session(db, phone):
+    _update_session(db, phone, "START", {}, None)
+    db.execute("UPDATE sessions SET language = 'en' WHERE phone = ? AND language IS NULL", (phone,))
+
+async def clear_session(phone):
     # Reset auf START, behalte aber Sprache bei, wenn möglich
-    _, _, lang = get_session(phone)
-    update_session(phone, "START", {}, lang or "en")
+    await write(_clear_session, phone)
+
+# --- Phone Locks (multi-process) ---
+
+def _try_lock_phone(db, phone, owner, now, ttl):
+    # Neu anlegen oder abgelaufenen Lock übernehmen; rowcount 0 = fremder, gültiger Lock
+    return db.execute("""
+        INSERT INTO phone_locks (phone, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(phone) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE phone_locks.expires_at < ?
+    """, (phone, owner, now + ttl, now)).rowcount == 1
 
-def log_sent_email(phone, name, email, reason):
-    db = get_db()
+async def try_lock_phone(phone, owner, now, ttl):
+    return await write(_try_lock_phone, phone, owner, now, ttl)
+
+def _renew_phone_lock(db, phone, owner, expires_at):
+    db.execute("UPDATE phone_locks SET expires_at = ? WHERE phone = ? AND owner = ?", (expires_at, phone, owner))
+
+async def renew_phone_lock(phone, owner, expires_at):
+    await write(_renew_phone_lock, phone, owner, expires_at)
+
+def _unlock_phone(db, phone, owner):
+    db.execute("DELETE FROM phone_locks WHERE phone = ? AND owner = ?", (phone, owner))
+
+async def unlock_phone(phone, owner):
+    await write(_unlock_phone, phone, owner)
+
+# --- Leases ---
+
+def _acquire_lease(db, name, owner, now, ttl):
+    # Neu anlegen, eigenen Lease verlängern oder abgelaufenen übernehmen; rowcount 0 = fremder, gültiger Lease
+    return db.execute("""
+        INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+        ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE leases.owner = excluded.owner OR leases.expires_at < ?
+    """, (name, owner, now + ttl, now)).rowcount == 1
+
+async def acquire_lease(name, owner, now, ttl):
+    """Take or renew lease `name` until now + ttl. True if `owner` holds it afterwards."""
+    return await write(_acquire_lease, name, owner, now, ttl)
+
+def _release_lease(db, name, owner):
+    db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+async def release_lease(name, owner):
+    await write(_release_lease, name, owner)
+
+# --- Leads ---
+
+def _save_lead(db, phone, ctx, lang, msg_id):
+    contact_num = ctx.get("contact_number")
+
+    # SMS_OPTIN ist jetzt 0 (wir senden keine SMS)
+    # CALL_OPTIN ist 1, wenn eine Nummer hinterlegt wurde
+    call_optin = 1 if contact_num else 0
+
+    db.execute("""
+        INSERT OR REPLACE INTO leads
+        (phone, name, email, reason, sms_number, sms_optin, call_optin, language, status)
+        VALUES (?, ?, ?, ?, ?, 0, ?, ?, 'new')
+    """, (phone, ctx.get("name"), ctx.get("email"), ctx.get("reason"), contact_num, call_optin, lang))
+
+    # Benachrichtigung an den Owner über die Outbox (gleiche Transaktion wie der Lead).
+    # Schlüssel = auslösende Nachricht: wird derselbe Turn erneut verarbeitet, bleibt es bei einer Mail
+    lead = {k: ctx.get(k) for k in ("name", "email", "reason", "contact_number")}
+    _enqueue_outbox(db, "lead_email", f"lead_email:{msg_id}",
+                    {"phone": phone, "lang": lang, "lead": lead}, phone)
+
+async def save_lead(phone, ctx, lang, msg_id):
+    """Store the lead and queue its notification (session lives in another state backend).
+    The notification is keyed by `msg_id`, the message that finished the lead."""
+    await write(_save_lead, phone, ctx, lang, msg_id)
+
+def _complete_lead(db, phone, ctx, lang, msg_id):
+    _save_lead(db, phone, ctx, lang, msg_id)
+    _update_session(db, phone, "COMPLETED", {}, lang)
+
+async def complete_lead(phone, ctx, lang, msg_id):
+    """Store the lead, queue its notification and set the session to COMPLETED in one transaction."""
+    await write(_complete_lead, phone, ctx, lang, msg_id)
+
+def _log_sent_email(db, phone, name, email, reason):
     delete_by = (datetime.utcnow() + timedelta(seconds=Config.DATA_RETENTION_SECONDS)).strftime("%Y-%m-%d %H:%M:%S")
     db.execute(
         "INSERT INTO email_log (phone, lead_name, lead_email, reason, delete_by) VALUES (?, ?, ?, ?, ?)",
         (phone, name, email, reason, delete_by)
     )
-    db.commit()
-
 
-def delete_user_data(phone):
-    db = get_db()
+def _delete_user_data(db, phone, trigger=None):
     # Lead-Daten holen bevor sie gelöscht werden
-    lead = db.execute("SELECT name, email, reason FROM leads WHERE phone = ?", (phone,)).fetchone()
-    lead_data = dict(lead) if lead else None
+    lead = db.execute("SELECT rowid, name, email, reason FROM leads WHERE phone = ?", (phone,)).fetchone()
+    lead_data = {k: lead[k] for k in ("name", "email", "reason")} if lead else None
 
     db.execute("DELETE FROM sessions WHERE phone = ?", (phone,))
     db.execute("DELETE FROM leads WHERE phone = ?", (phone,))
 
-    # Lösch-Anfrage markieren (gleiche Connection, ein Commit)
+    # Lösch-Anfrage markieren (gleiche Transaktion)
     now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
     db.execute(
         "UPDATE email_log SET deletion_requested = 1, deletion_requested_at = ? WHERE phone = ?",
         (now, phone)
     )
 
-    db.commit()
+    # Outbox-Einträge enthalten ebenfalls personenbezogene Daten: auch offene und gerade
+    # zugestellte löschen, damit sie nicht mehr (erneut) gesendet werden
+    db.execute("DELETE FROM outbox WHERE phone = ?", (phone,))
+    db.execute("DELETE FROM delivery_status WHERE phone = ?", (phone,))
+    db.execute("DELETE FROM broadcast_recipients WHERE phone = ?", (phone,))
+
+    # Lösch-Mail an PRIVACY_EMAIL in derselben Transaktion einreihen, eine pro gelöschtem Lead
+    if lead_data and trigger:
+        _enqueue_outbox(db, "privacy_email", f"privacy_email:{phone}:{lead['rowid']}",
+                        {"email_type": "deletion_request", "lead_data": {**lead_data, "phone": phone, "trigger": trigger}})
     return lead_data
+
+async def delete_user_data(phone, trigger=None):
+    """Delete session + lead, mark email_log entries. With `trigger`, a deletion
+    request mail is queued in the same transaction. Returns the lead data or None."""
+    return await write(_delete_user_data, phone, trigger)
+
+# --- Outbox ---
+
+def _enqueue_outbox(db, kind, idem_key, payload, phone=None):
+    # Gleicher idem_key = gleiche Nachricht -> nur einmal einreihen
+    db.execute(
+        "INSERT OR IGNORE INTO outbox (kind, idem_key, phone, payload, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+        (kind, idem_key, phone, json.dumps(payload), time.time())
+    )
+
+def _claim_outbox(db, now, lease, limit):
+    # Fällige Einträge + Einträge, deren Lease abgelaufen ist (Worker abgestürzt)
+    rows = db.execute("""
+        UPDATE outbox SET status = 'sending', lease_until = ?
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'sending' AND lease_until < ?)
+            ORDER BY next_attempt_at LIMIT ?
+        )
+        RETURNING id, kind, idem_key, phone, payload, attempts
+    """, (now + lease, now, now, limit)).fetchall()
+    return [dict(r, payload=json.loads(r["payload"])) for r in rows]
+
+async def claim_outbox(now, lease, limit):
+    return await write(_claim_outbox, now, lease, limit)
+
+def _outbox_done(db, outbox_id, email_log=None):
+    # rowcount 0: Eintrag wurde während der Zustellung gelöscht (Datenlöschung) -> nichts protokollieren
+    found = db.execute("UPDATE outbox SET status = 'done', done_at = CURRENT_TIMESTAMP, lease_until = NULL, "
+                       "attempts = attempts + 1, last_error = NULL WHERE id = ?", (outbox_id,)).rowcount == 1
+    if found and email_log is not None:
+        _log_sent_email(db, *email_log)
+    return found
+
+async def outbox_done(outbox_id, email_log=None):
+    """Mark delivered; `email_log` (phone, name, email, reason) is logged in the same transaction.
+    False if the row was deleted in the meantime."""
+    return await write(_outbox_done, outbox_id, email_log)
+
+def _outbox_failed(db, outbox_id, error, next_attempt_at, dead, notice):
+    # Ein inzwischen gelöschter Eintrag wird nicht wieder eingereiht
+    found = db.execute(
+        "UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?, next_attempt_at = ?, "
+        "lease_until = NULL WHERE id = ?",
+        ("dead" if dead else "pending", error, next_attempt_at, outbox_id)
+    ).rowcount == 1
+    if found and notice is not None:
+        _enqueue_outbox(db, *notice)
+    return found
+
+async def outbox_failed(outbox_id, error, next_attempt_at, dead=False, notice=None):
+    """Schedule a retry or dead-letter the row; `notice` (kind, idem_key, payload, phone) is
+    queued in the same transaction. False if the row was deleted in the meantime."""
+    return await write(_outbox_failed, outbox_id, error, next_attempt_at, dead, notice)
+
+def _renew_outbox_lease(db, outbox_id, lease_until):
+    db.execute("UPDATE outbox SET lease_until = ? WHERE id = ? AND status = 'sending'", (lease_until, outbox_id))
+
+async def renew_outbox_lease(outbox_id, lease_until):
+    await write(_renew_outbox_lease, outbox_id, lease_until)
+
+def _outbox_counts(db):
+    return {r["status"]: r["n"] for r in db.execute("SELECT status, COUNT(*) AS n FROM outbox GROUP BY status")}
+
+async def outbox_counts():
+    return await read(_outbox_counts)
+
+# --- Delivery status ---
+
+def _save_delivery_statuses(db, rows, now):
+    # Jede Zeitspalte behält den frühesten Wert (Redeliveries, Callbacks außer der Reihe)
+    db.executemany("""
+        INSERT INTO delivery_status (wamid, phone, sent_at, delivered_at, read_at, failed_at, error_code, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(wamid) DO UPDATE SET
+            phone = COALESCE(delivery_status.phone, excluded.phone),
+            sent_at = MIN(COALESCE(delivery_status.sent_at, excluded.sent_at), COALESCE(excluded.sent_at, delivery_status.sent_at)),
+            delivered_at = MIN(COALESCE(delivery_status.delivered_at, excluded.delivered_at), COALESCE(excluded.delivered_at, delivery_status.delivered_at)),
+            read_at = MIN(COALESCE(delivery_status.read_at, excluded.read_at), COALESCE(excluded.read_at, delivery_status.read_at)),
+            failed_at = MIN(COALESCE(delivery_status.failed_at, excluded.failed_at), COALESCE(excluded.failed_at, delivery_status.failed_at)),
+            error_code = COALESCE(excluded.error_code, delivery_status.error_code),
+            updated_at = excluded.updated_at
+    """, [(*row, now) for row in rows])
+
+async def save_delivery_statuses(rows, now):
+    """Upsert many (wamid, phone, sent_at, delivered_at, read_at, failed_at, error_code) rows in one transaction."""
+    if rows:
+        await write(_save_delivery_statuses, rows, now)
+
+def _delivery_summary(db, since):
+    row = db.execute("""
+        SELECT COUNT(*) AS sent, COUNT(delivered_at) AS delivered, COUNT(read_at) AS read,
+               COUNT(failed_at) AS failed,
+               AVG(delivered_at - sent_at) AS avg_delivered_seconds,
+               AVG(read_at - sent_at) AS avg_read_seconds
+        FROM delivery_status WHERE sent_at >= ?
+    """, (since,)).fetchone()
+    return dict(row)
+
+async def delivery_summary(since):
+    """Counts and average latencies (from our send) for messages sent since `since` (unix time)."""
+    return await read(_delivery_summary, since)
+
+# --- Broadcasts ---
+
+def _lead_filter(lead_filter):
+    # {"language": [...], "status": [...], "created_after": ts, "created_before": ts} -> WHERE-Teil
+    clauses, params = [], []
+    for column in ("language", "status"):
+        values = lead_filter.get(column)
+        if values:
+            clauses.append(f"{column} IN ({', '.join('?' for _ in values)})")
+            params.extend(values)
+    if lead_filter.get("created_after"):
+        clauses.append("created_at >= ?")
+        params.append(lead_filter["created_after"])
+    if lead_filter.get("created_before"):
+        clauses.append("created_at < ?")
+        params.append(lead_filter["created_before"])
+    return " AND ".join(clauses) or "1", params
+
+def _count_leads(db, lead_filter):
+    where, params = _lead_filter(lead_filter)
+    return db.execute(f"SELECT COUNT(*) FROM leads WHERE {where}", params).fetchone()[0]
+
+async def count_leads(lead_filter):
+    return await read(_count_leads, lead_filter)
+
+def _lead_page(db, lead_filter, after, limit):
+    # Keyset-Paging über den Primärschlüssel: keine offene Lese-Transaktion über
+    # den ganzen Broadcast (hielte den WAL-Checkpoint auf), jede Seite ein Index-Seek
+    where, params = _lead_filter(lead_filter)
+    return db.execute(
+        f"SELECT phone, name, language FROM leads WHERE phone > ? AND {where} ORDER BY phone LIMIT ?",
+        (after or "", *params, limit)
+    ).fetchall()
+
+async def lead_page(lead_filter, after, limit):
+    """Next `limit` matching leads (phone, name, language) with phone > `after`, in phone order."""
+    return await read(_lead_page, lead_filter, after, limit)
+
+def _create_broadcast(db, spec, lead_filter, now):
+    total = _count_leads(db, lead_filter)
+    broadcast_id = db.execute(
+        "INSERT INTO broadcasts (spec, filter, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+        (json.dumps(spec), json.dumps(lead_filter), total, now, now)
+    ).lastrowid
+    return broadcast_id, total
+
+async def create_broadcast(spec, lead_filter, now):
+    """Store a new broadcast in status 'running'. Returns (id, number of matching leads)."""
+    return await write(_create_broadcast, spec, lead_filter, now)
+
+def _broadcast_row(row):
+    return dict(row, spec=json.loads(row["spec"]), filter=json.loads(row["filter"]))
+
+def _get_broadcast(db, broadcast_id):
+    row = db.execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+    return _broadcast_row(row) if row else None
+
+async def get_broadcast(broadcast_id):
+    return await read(_get_broadcast, broadcast_id)
+
+def _list_broadcasts(db, status, limit):
+    if status:
+        rows = db.execute("SELECT * FROM broadcasts WHERE status = ? ORDER BY id LIMIT ?", (status, limit))
+    else:
+        rows = db.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+    return [_broadcast_row(r) for r in rows]
+
+async def list_broadcasts(status=None, limit=50):
+    """Broadcasts with `status` oldest first, or the latest `limit` of all newest first."""
+    return await read(_list_broadcasts, status, limit)
+
+def _broadcast_checkpoint(db, broadcast_id, cursor, results, now):
+    # Empfänger und Fortschritt in einer Transaktion: nach einem Absturz geht es
+    # genau ab der ersten nicht bestätigten Seite weiter
+    db.executemany(
+        "INSERT OR REPLACE INTO broadcast_recipients (broadcast_id, phone, wamid, error_code) VALUES (?, ?, ?, ?)",
+        [(broadcast_id, *r) for r in results]
+    )
+    sent = sum(1 for _, _, error_code in results if error_code is None)
+    row = db.execute(
+        "UPDATE broadcasts SET cursor = ?, sent = sent + ?, failed = failed + ?, updated_at = ?, "
+        "started_at = COALESCE(started_at, ?) WHERE id = ? RETURNING status",
+        (cursor, sent, len(results) - sent, now, now, broadcast_id)
+    ).fetchone()
+    return row["status"] if row else None
+
+async def broadcast_checkpoint(broadcast_id, cursor, results, now):
+    """Record one page of (phone, wamid, error_code or None if sent) and move the cursor.
+    Returns the broadcast's current status (it may have been paused or cancelled meanwhile)."""
+    return await write(_broadcast_checkpoint, broadcast_id, cursor, results, now)
+
+def _set_broadcast_status(db, broadcast_id, status, expected, now, error):
+    row = db.execute(
+        "UPDATE broadcasts SET status = ?, updated_at = ?, last_error = COALESCE(?, last_error), "
+        "finished_at = CASE WHEN ? IN ('done', 'cancelled') THEN ? END "
+        f"WHERE id = ? AND status IN ({', '.join('?' for _ in expected)}) RETURNING status",
+        (status, now, error, status, now, broadcast_id, *expected)
+    ).fetchone()
+    return row is not None
+
+async def set_broadcast_status(broadcast_id, status, expected, now, error=None):
+    """Move a broadcast to `status` if it is currently in one of `expected`. True if it was moved."""
+    return await write(_set_broadcast_status, broadcast_id, status, expected, now, error)
+
+def _broadcast_delivery(db, broadcast_id):
+    # Nur mit DELIVERY_TRACKING gefüllt; delivery_status wird über seinen Primärschlüssel getroffen
+    row = db.execute("""
+        SELECT COUNT(d.wamid) AS tracked, COUNT(d.delivered_at) AS delivered,
+               COUNT(d.read_at) AS read, COUNT(d.failed_at) AS failed
+        FROM broadcast_recipients r JOIN delivery_status d ON d.wamid = r.wamid
+        WHERE r.broadcast_id = ?
+    """, (broadcast_id,)).fetchone()
+    return dict(row)
+
+async def broadcast_delivery(broadcast_id):
+    """Delivered/read/failed callbacks for the messages of a broadcast."""
+    return await read(_broadcast_delivery, broadcast_id)
+
+def _broadcast_errors(db, broadcast_id):
+    return {r["error_code"]: r["n"] for r in db.execute(
+        "SELECT error_code, COUNT(*) AS n FROM broadcast_recipients "
+        "WHERE broadcast_id = ? AND error_code IS NOT NULL GROUP BY error_code", (broadcast_id,))}
+
+async def broadcast_errors(broadcast_id):
+    """Failed sends of a broadcast by error code (Graph API code, else HTTP status, 0 = no response)."""
+    return await read(_broadcast_errors, broadcast_id)
+
+# --- Metrics ---
+
+METRIC_TABLES = ("sessions", "processed_messages")
+
+def _table_sizes(db):
+    return {table: db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in METRIC_TABLES}
+
+async def table_sizes():
+    return await read(_table_sizes)
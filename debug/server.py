@@ -1,16 +1,46 @@
-"""Debug-Webserver: Zeigt alle DB-Tabellen als HTML-Tabellen an."""
+"""Debug-Webserver: Zeigt die DB-Tabellen als HTML-Tabellen an (nur lesend).
 
-import sqlite3
+Nutzung:
+  python debug/server.py
+  http://localhost:8888/                 Tabellenübersicht
+  http://localhost:8888/t/sessions       Tabelle, seitenweise
+
+Parameter für /t/<tabelle>:
+  cols=phone,step          nur diese Spalten
+  limit=100                Zeilen pro Seite (max. 1000)
+  desc=1                   neueste zuerst (nach Schlüssel)
+  where.<spalte>=<wert>    Filter: "=wert", "!wert", ">wert", ">=wert", "<wert",
+                           "<=wert", mit % -> LIKE; ohne Präfix Gleichheit
+  after=<cursor>           nächste Seite (Link unter der Tabelle)
+
+Die DB wird per URI mit mode=ro geöffnet: keine Schreibsperre, kein Checkpoint,
+keine Konkurrenz zum Writer des Bots. Seiten werden zeilenweise gestreamt
+(chunked), Zeilenzahlen kommen aus sqlite_stat1 (PRAGMA optimize) oder werden
+auf Klick gezählt und gecached.
+"""
+
+import html
+import json
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import sqlite3
+import threading
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit
 
 DB_PATH = os.getenv("DB_PATH", os.path.join(os.path.dirname(__file__), "..", "data", "bot.db"))
 PORT = int(os.getenv("DEBUG_PORT", "8888"))
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+COUNT_TTL = 60
+FLUSH_BYTES = 32 * 1024
 
 HTML_HEAD = """<!DOCTYPE html>
 <html><head><meta charset="utf-8"><title>DB Debug</title>
 <style>
   body { font-family: monospace; margin: 2em; background: #1a1a1a; color: #e0e0e0; }
+  a { color: #8cf; }
   h1 { color: #8f8; }
   h2 { color: #8cf; margin-top: 2em; }
   table { border-collapse: collapse; margin-bottom: 1em; width: 100%; }
@@ -24,52 +54,242 @@ HTML_HEAD = """<!DOCTYPE html>
 
 HTML_FOOT = "</body></html>"
 
+OPERATORS = (">=", "<=", "!", ">", "<", "=")
+
+# table -> (count, gezählt um)
+_counts = {}
+_counts_lock = threading.Lock()
+
+esc = html.escape
+
+
+def connect():
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(DB_PATH))}?mode=ro", uri=True)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute("PRAGMA busy_timeout=1000")
+    return conn
+
+
+def list_tables(conn):
+    return [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+def table_columns(conn, table):
+    """[(name, pk position)] from PRAGMA table_info."""
+    return [(r[1], r[5]) for r in conn.execute(f'PRAGMA table_info("{table}")')]
+
+
+def key_columns(conn, table, columns):
+    """Keyset columns: rowid, or the primary key of a WITHOUT ROWID table."""
+    try:
+        conn.execute(f'SELECT rowid FROM "{table}" LIMIT 0')
+        return ["rowid"]
+    except sqlite3.OperationalError:
+        return [name for name, pk in sorted(columns, key=lambda c: c[1]) if pk]
+
+
+def estimated_counts(conn):
+    """Row estimates from sqlite_stat1 (written by ANALYZE / PRAGMA optimize), table -> count."""
+    try:
+        rows = conn.execute("SELECT tbl, stat FROM sqlite_stat1").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    estimates = {}
+    for tbl, stat in rows:
+        n = int(stat.split()[0]) if stat else 0
+        estimates[tbl] = max(estimates.get(tbl, 0), n)
+    return estimates
+
+
+def cached_count(table, now=None):
+    now = now or time.monotonic()
+    with _counts_lock:
+        entry = _counts.get(table)
+    if entry and now - entry[1] < COUNT_TTL:
+        return entry[0]
+    return None
+
+
+def exact_count(conn, table):
+    n = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    with _counts_lock:
+        _counts[table] = (n, time.monotonic())
+    return n
 
-def render_table(cursor, table_name):
-    rows = cursor.execute(f"SELECT * FROM [{table_name}]").fetchall()
-    cols = [desc[0] for desc in cursor.description]
-    count = len(rows)
 
-    html = f'<h2>{table_name} <span class="count">({count} rows)</span></h2>'
-    if not rows:
-        return html + '<p class="empty">Keine Daten.</p>'
+def encode_cursor(values):
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
 
-    html += "<table><tr>"
-    for col in cols:
-        html += f"<th>{col}</th>"
-    html += "</tr>"
-    for row in rows:
-        html += "<tr>"
-        for val in row:
-            display = str(val) if val is not None else '<span class="empty">NULL</span>'
-            html += f"<td>{display}</td>"
-        html += "</tr>"
-    html += "</table>"
-    return html
+
+def decode_cursor(cursor):
+    return json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+
+
+def parse_filter(raw):
+    for op in OPERATORS:
+        if raw.startswith(op):
+            value = raw[len(op):]
+            return ("!=" if op == "!" else op), value
+    return ("LIKE" if "%" in raw else "="), raw
+
+
+def cell(val):
+    if val is None:
+        return '<td class="empty">NULL</td>'
+    if isinstance(val, bytes):
+        return f'<td class="empty">&lt;{len(val)} bytes&gt;</td>'
+    return f"<td>{esc(str(val))}</td>"
 
 
 class Handler(BaseHTTPRequestHandler):
+    # Chunked Transfer-Encoding braucht HTTP/1.1
+    protocol_version = "HTTP/1.1"
+
     def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qsl(url.query)
+        try:
+            conn = connect()
+        except sqlite3.Error as e:
+            return self.send_error_text(500, f"Error: {e}")
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            tables = [r[0] for r in cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name").fetchall()]
-
-            body = HTML_HEAD + f"<h1>DB Debug — {os.path.basename(DB_PATH)}</h1>"
-            for t in tables:
-                body += render_table(cur, t)
-            body += HTML_FOOT
+            if url.path in ("/", ""):
+                self.stream(self.render_index(conn, dict(params)))
+            elif url.path.startswith("/t/"):
+                table = url.path[3:]
+                if table not in list_tables(conn):
+                    return self.send_error_text(404, f"Unknown table: {table}")
+                self.stream(self.render_table(conn, table, params))
+            else:
+                self.send_error_text(404, "Not found")
+        except (ValueError, sqlite3.Error) as e:
+            self.send_error_text(400, f"Error: {e}")
+        finally:
             conn.close()
 
-            self.send_response(200)
-            self.send_header("Content-Type", "text/html; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(body.encode())
+    # --- Ausgabe ---
+
+    def send_error_text(self, status, text):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, parts):
+        """Send an iterable of HTML snippets as a chunked response."""
+        # Erstes Stück vor den Headern erzeugen: Fehler (z.B. ungültiger Filter) -> noch 400 möglich
+        parts = iter(parts)
+        first = next(parts, "")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        buf, size = [first], len(first)
+        try:
+            for part in parts:
+                buf.append(part)
+                size += len(part)
+                if size >= FLUSH_BYTES:
+                    self.write_chunk("".join(buf))
+                    buf, size = [], 0
         except Exception as e:
-            self.send_response(500)
-            self.send_header("Content-Type", "text/plain")
-            self.end_headers()
-            self.wfile.write(f"Error: {e}".encode())
+            # Header sind schon raus: Fehler in die Seite schreiben
+            buf.append(f"<p>Error: {esc(str(e))}</p>")
+        self.write_chunk("".join(buf))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, text):
+        data = text.encode()
+        if data:
+            self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+
+    # --- Seiten ---
+
+    def render_index(self, conn, params):
+        if params.get("count") in list_tables(conn):
+            exact_count(conn, params["count"])
+        estimates = estimated_counts(conn)
+        yield HTML_HEAD + f"<h1>DB Debug — {esc(os.path.basename(DB_PATH))}</h1>"
+        yield "<table><tr><th>Tabelle</th><th>Zeilen</th><th></th></tr>"
+        for table in list_tables(conn):
+            count = cached_count(table)
+            if count is not None:
+                shown = str(count)
+            elif table in estimates:
+                shown = f"~{estimates[table]}"
+            else:
+                shown = '<span class="empty">?</span>'
+            yield (f'<tr><td><a href="/t/{quote(table)}">{esc(table)}</a></td><td>{shown}</td>'
+                   f'<td><a class="count" href="/?{urlencode({"count": table})}">zählen</a></td></tr>')
+        yield "</table>" + HTML_FOOT
+
+    def render_table(self, conn, table, params):
+        columns = table_columns(conn, table)
+        names = [name for name, _ in columns]
+        keys = key_columns(conn, table, columns)
+        options = dict(params)
+
+        cols = [c for c in options.get("cols", "").split(",") if c] or names
+        unknown = [c for c in cols if c not in names]
+        if unknown:
+            raise ValueError(f"Unknown column(s): {', '.join(unknown)}")
+        limit = min(max(int(options.get("limit", PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        desc = options.get("desc") == "1"
+
+        where, args = [], []
+        filters = []
+        for name, raw in params:
+            if not name.startswith("where."):
+                continue
+            column = name[6:]
+            if column not in names:
+                raise ValueError(f"Unknown column: {column}")
+            op, value = parse_filter(raw)
+            where.append(f'"{column}" {op} ?')
+            args.append(value)
+            filters.append((name, raw))
+        if "after" in options:
+            after = decode_cursor(options["after"])
+            if len(after) != len(keys):
+                raise ValueError("Invalid cursor")
+            key_list = ", ".join(f'"{k}"' if k != "rowid" else k for k in keys)
+            marks = ", ".join("?" for _ in keys)
+            where.append(f"({key_list}) {'<' if desc else '>'} ({marks})")
+            args.extend(after)
+
+        key_sql = [k if k == "rowid" else f'"{k}"' for k in keys]
+        select = ", ".join(key_sql + [f'"{c}"' for c in cols])
+        order = ", ".join(f"{k} {'DESC' if desc else 'ASC'}" for k in key_sql)
+        sql = f'SELECT {select} FROM "{table}"'
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order} LIMIT ?"
+        cursor = conn.execute(sql, (*args, limit))
+
+        yield (HTML_HEAD + f'<h1><a href="/">DB Debug</a> — {esc(table)}</h1>'
+               f'<p class="count">Schlüssel: {esc(", ".join(keys))} · {limit} pro Seite'
+               + (f" · Filter: {esc(', '.join(f'{n[6:]} {v}' for n, v in filters))}" if filters else "")
+               + "</p>")
+        yield "<table><tr>" + "".join(f"<th>{esc(c)}</th>" for c in cols) + "</tr>"
+
+        n_keys = len(keys)
+        rows, last = 0, None
+        for row in cursor:
+            rows += 1
+            last = row[:n_keys]
+            yield "<tr>" + "".join(cell(v) for v in row[n_keys:]) + "</tr>"
+        yield "</table>"
+
+        if not rows:
+            yield '<p class="empty">Keine Daten.</p>'
+        if rows == limit:
+            base = [(k, v) for k, v in params if k != "after"]
+            link = urlencode(base + [("after", encode_cursor(list(last)))])
+            yield f'<p><a href="/t/{quote(table)}?{esc(link)}">Weiter →</a></p>'
+        yield HTML_FOOT
 
     def log_message(self, fmt, *args):
         print(f"[debug] {args[0]}")
@@ -78,4 +298,4 @@ class Handler(BaseHTTPRequestHandler):
 if __name__ == "__main__":
     print(f"Debug-Server: http://localhost:{PORT}")
     print(f"DB: {DB_PATH}")
-    HTTPServer(("0.0.0.0", PORT), Handler).serve_forever()
+    ThreadingHTTPServer(("0.0.0.0", PORT), Handler).serve_forever()
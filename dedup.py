@@ -0,0 +1,127 @@
+"""
+In-process dedup cache in front of processed_messages.
+
+Repeat message IDs (Meta redeliveries) are answered from memory. New IDs are
+buffered and written to processed_messages in batches by a background task,
+so dedup survives a restart once the cache is warmed from the table again.
+
+With a shared state backend the local cache only answers repeats it has seen
+itself; every unknown ID is claimed atomically in the backend, so two workers
+never both process the same message.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from config import Config
+from backends import backend
+import metrics
+from writebehind import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+_NEW = metrics.DEDUP_MESSAGES.labels("new")
+_DUPLICATE = metrics.DEDUP_MESSAGES.labels("duplicate")
+
+
+class DedupCache(WriteBehind):
+    def __init__(self, backend, ttl=None, max_entries=None, flush_interval=None, flush_batch=None):
+        super().__init__(flush_interval or Config.DEDUP_FLUSH_INTERVAL)
+        self.backend = backend
+        self.ttl = ttl or Config.DEDUP_TTL_SECONDS
+        self.max_entries = max_entries or Config.DEDUP_MAX_ENTRIES
+        self.flush_batch = flush_batch or Config.DEDUP_FLUSH_BATCH
+
+        # msg_id -> expires_at (monotonic). TTL ist konstant, daher ist die
+        # Einfügereihenfolge auch die Ablaufreihenfolge -> Expire von vorne.
+        self._seen = OrderedDict()
+        self._pending = []
+
+        self.hits = 0
+        self.misses = 0
+
+    def _expire(self, now):
+        seen = self._seen
+        while seen:
+            msg_id, expires_at = next(iter(seen.items()))
+            if expires_at > now and len(seen) <= self.max_entries:
+                break
+            seen.popitem(last=False)
+
+    def _add(self, msg_id, expires_at):
+        self._seen[msg_id] = expires_at
+        self._seen.move_to_end(msg_id)
+
+    async def filter_new(self, msg_ids):
+        """Return the IDs (in order, without duplicates) that were not seen before
+        and remember them. Only touches the backend for unknown IDs in shared mode;
+        if that fails the error propagates and nothing is remembered, so a
+        redelivery of the same IDs is processed."""
+        now = time.monotonic()
+        self._expire(now)
+        new = [m for m in dict.fromkeys(msg_ids) if m not in self._seen]
+
+        if new and self.backend.shared:
+            claimed = await self.backend.claim_messages(new)
+            # Erst nach erfolgreichem Claim merken, und nur was wir selbst geclaimt haben
+            new = [m for m in new if m in claimed]
+        else:
+            self._pending.extend(new)
+            if len(self._pending) >= self.flush_batch:
+                self.flush_soon()
+        now = time.monotonic()
+        for msg_id in new:
+            self._add(msg_id, now + self.ttl)
+        self.misses += len(new)
+        self.hits += len(msg_ids) - len(new)
+
+        _NEW.inc(len(new))
+        _DUPLICATE.inc(len(msg_ids) - len(new))
+        return new
+
+    async def release(self, msg_ids):
+        """Forget IDs returned by filter_new whose message could not be queued,
+        locally and in the backend, so Meta's redelivery is processed."""
+        ids = set(msg_ids)
+        for msg_id in ids:
+            self._seen.pop(msg_id, None)
+        self._pending = [m for m in self._pending if m not in ids]
+        # Auch ohne Shared-Backend: ein Flush kann die IDs schon geschrieben haben
+        await self.backend.release_messages(list(ids))
+
+    async def warm(self, seconds=None):
+        """Load the IDs of the last `seconds` from processed_messages."""
+        seconds = Config.DEDUP_WARM_SECONDS if seconds is None else seconds
+        if seconds <= 0:
+            return 0
+        rows = await self.backend.recent_message_ids(seconds)
+        now = time.monotonic()
+        # Älteste zuerst, damit die Ablaufreihenfolge stimmt
+        for msg_id, age in rows:
+            self._add(msg_id, now + self.ttl - age)
+        self._expire(now)
+        logger.info(f"Dedup cache warmed with {len(self._seen)} message IDs")
+        return len(rows)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        try:
+            await self.backend.mark_messages(batch)
+        except Exception as e:
+            # Zurücklegen, nächster Flush versucht es erneut
+            self._pending = batch + self._pending
+            logger.error(f"Dedup flush failed ({len(batch)} IDs): {e}")
+
+    def stats(self):
+        return {
+            "entries": len(self._seen),
+            "max_entries": self.max_entries,
+            "pending_writes": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+dedup = DedupCache(backend)
@@ -0,0 +1,106 @@
+"""
+Delivery-status tracking for outgoing WhatsApp messages (DELIVERY_TRACKING).
+
+The dispatcher reports every accepted send (wamid, phone, time), the webhook
+reports status callbacks (sent/delivered/read/failed). Both only update an
+in-memory record per wamid; a background task upserts all pending records
+into delivery_status in one transaction, every DELIVERY_FLUSH_INTERVAL
+seconds or as soon as DELIVERY_FLUSH_THRESHOLD records are pending, and once
+more on shutdown. Each timestamp column keeps the earliest value seen, so
+Meta's redeliveries and out-of-order callbacks are harmless.
+"""
+
+import logging
+import time
+from config import Config
+import database
+import metrics
+from writebehind import WriteBehind
+
+logger = logging.getLogger(__name__)
+
+# Status -> Index im Record [phone, sent_at, delivered_at, read_at, failed_at, error_code]
+_FIELDS = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+
+class DeliveryTracker(WriteBehind):
+    def __init__(self, enabled=None, flush_interval=None, flush_threshold=None):
+        super().__init__(flush_interval or Config.DELIVERY_FLUSH_INTERVAL)
+        self.enabled = Config.DELIVERY_TRACKING if enabled is None else enabled
+        self.flush_threshold = flush_threshold or Config.DELIVERY_FLUSH_THRESHOLD
+
+        # wamid -> [phone, sent_at, delivered_at, read_at, failed_at, error_code]
+        self._pending = {}
+
+        self.statuses = 0
+        self.flushed = 0
+
+    def _record(self, wamid):
+        record = self._pending.get(wamid)
+        if record is None:
+            record = self._pending[wamid] = [None] * 6
+            if len(self._pending) >= self.flush_threshold:
+                self.flush_soon()
+        return record
+
+    @staticmethod
+    def _merge(record, index, value):
+        if value is not None and (record[index] is None or value < record[index]):
+            record[index] = value
+
+    def sent(self, wamid, phone, at=None):
+        """A message was accepted by the Graph API (the start of the latency)."""
+        if not self.enabled or not wamid:
+            return
+        record = self._record(wamid)
+        record[0] = phone
+        self._merge(record, 1, time.time() if at is None else at)
+
+    def update(self, statuses):
+        """Merge decoded status callbacks (inbound.StatusUpdate)."""
+        if not self.enabled:
+            return
+        for s in statuses:
+            metrics.DELIVERY_STATUSES.labels(s.status).inc()
+            index = _FIELDS.get(s.status)
+            if index is None:
+                continue
+            self.statuses += 1
+            record = self._record(s.wamid)
+            record[0] = record[0] or s.phone
+            self._merge(record, index, s.timestamp)
+            if s.error_code is not None:
+                record[5] = s.error_code
+
+    def start(self):
+        if self.enabled:
+            super().start()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        rows = [(wamid, *record) for wamid, record in pending.items()]
+        try:
+            await database.save_delivery_statuses(rows, time.time())
+            self.flushed += len(rows)
+        except Exception as e:
+            # Zurückmischen; neuere Werte aus der Zwischenzeit bleiben erhalten
+            for wamid, record in pending.items():
+                current = self._record(wamid)
+                current[0] = current[0] or record[0]
+                for index in range(1, 5):
+                    self._merge(current, index, record[index])
+                current[5] = current[5] if current[5] is not None else record[5]
+            logger.error(f"Delivery status flush failed ({len(rows)} messages): {e}")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pending": len(self._pending),
+            "statuses": self.statuses,
+            "flushed": self.flushed,
+        }
+
+
+tracker = DeliveryTracker()
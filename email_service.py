@@ -1,10 +1,13 @@
 import asyncio
-import json
-import os
 import ssl
+import time
 import aiosmtplib
+from collections import deque
 from email.message import EmailMessage
+from email.utils import make_msgid
 from config import Config
+from localization import render_email
+import metrics
 
 
 def _tls_context():
@@ -17,98 +20,333 @@ def _tls_context():
     return ctx
 
 
-async def send_lead_email(ctx, lang):
-    """Send lead notification email to owner. Returns (success, error_reason)."""
-    if not all([Config.SMTP_HOST, Config.SMTP_USER, Config.SMTP_PASS, Config.SMTP_FROM]):
-        return False, "SMTP nicht konfiguriert" if lang == "de" else "SMTP not configured"
+def smtp_configured():
+    return all([Config.SMTP_HOST, Config.SMTP_USER, Config.SMTP_PASS, Config.SMTP_FROM])
 
-    phone_line = ctx.get("contact_number") or ("-" if lang == "en" else "–")
 
-    msg = EmailMessage()
-    msg["Subject"] = f"Neuer Lead: {ctx.get('name')}"
-    msg["From"] = Config.SMTP_FROM
-    msg["To"] = Config.CONTACT_EMAIL
-    msg.set_content(
-        f"Neuer Lead über WhatsApp-Bot\n"
-        f"{'=' * 30}\n\n"
-        f"Name:    {ctx.get('name')}\n"
-        f"E-Mail:  {ctx.get('email')}\n"
-        f"Telefon: {phone_line}\n"
-        f"Grund:   {ctx.get('reason')}\n"
-    )
+class SMTPPool:
+    """
+    Authenticated SMTP sessions that are reused across mails.
 
-    try:
-        await aiosmtplib.send(
-            msg,
+    Connect + STARTTLS + AUTH happens once per session instead of once per
+    mail. A session that sat idle longer than SMTP_HEALTHCHECK_AFTER is
+    checked with NOOP before reuse, one idle longer than SMTP_MAX_IDLE is
+    closed (the bridge drops those anyway). If the server closed the session
+    under us, the mail is sent once more over a fresh connection.
+    """
+
+    def __init__(self, size=None, timeout=None, check_after=None, max_idle=None):
+        self.size = size or Config.SMTP_POOL_SIZE
+        self.timeout = timeout or Config.SMTP_TIMEOUT
+        self.check_after = Config.SMTP_HEALTHCHECK_AFTER if check_after is None else check_after
+        self.max_idle = Config.SMTP_MAX_IDLE if max_idle is None else max_idle
+        self._slots = asyncio.Semaphore(self.size)
+        # [(client, last_used)], zuletzt benutzte Session zuerst wiederverwenden
+        self._idle = []
+        self.in_use = 0
+
+        self.connects = 0
+        self.reconnects = 0
+        self.health_checks = 0
+        self.sent = 0
+        self.failed = 0
+
+    async def _connect(self):
+        client = aiosmtplib.SMTP(
             hostname=Config.SMTP_HOST,
             port=Config.SMTP_PORT,
-            username=Config.SMTP_USER,
-            password=Config.SMTP_PASS,
-            start_tls=True,
+            start_tls=Config.SMTP_STARTTLS,
             tls_context=_tls_context(),
-            timeout=10,
+            timeout=self.timeout,
         )
+        await client.connect()
+        try:
+            await client.login(Config.SMTP_USER, Config.SMTP_PASS)
+        except Exception:
+            client.close()
+            raise
+        self.connects += 1
+        return client
+
+    @staticmethod
+    async def _discard(client, polite=False):
+        try:
+            if polite and client.is_connected:
+                await client.quit()
+        except Exception:
+            pass
+        client.close()
+
+    async def _checkout(self):
+        now = time.monotonic()
+        while self._idle:
+            client, last_used = self._idle.pop()
+            idle = now - last_used
+            if not client.is_connected or idle > self.max_idle:
+                await self._discard(client, polite=True)
+                continue
+            if idle > self.check_after:
+                self.health_checks += 1
+                try:
+                    await client.noop()
+                except Exception:
+                    await self._discard(client)
+                    continue
+            return client
+        return await self._connect()
+
+    async def send(self, msg):
+        """Send one EmailMessage over a pooled session. Raises like aiosmtplib.send."""
+        async with self._slots:
+            self.in_use += 1
+            started = time.perf_counter()
+            try:
+                client = await self._checkout()
+                try:
+                    await client.send_message(msg)
+                except aiosmtplib.SMTPServerDisconnected:
+                    # Session serverseitig geschlossen (Idle-Timeout): einmal neu verbinden
+                    await self._discard(client)
+                    self.reconnects += 1
+                    client = await self._connect()
+                    await self._send_or_discard(client, msg)
+                except aiosmtplib.SMTPResponseException:
+                    # Server hat die Mail abgelehnt, die Session selbst ist noch brauchbar
+                    self._idle.append((client, time.monotonic()))
+                    raise
+                except BaseException:
+                    await self._discard(client)
+                    raise
+                self._idle.append((client, time.monotonic()))
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                metrics.SMTP_FAILURES.labels(type(e).__name__).inc()
+                raise
+            finally:
+                self.in_use -= 1
+                metrics.SMTP_SEND_SECONDS.observe(time.perf_counter() - started)
+
+    async def _send_or_discard(self, client, msg):
+        try:
+            await client.send_message(msg)
+        except BaseException:
+            await self._discard(client)
+            raise
+
+    async def warm(self):
+        """Log in one session ahead of the first mail."""
+        if not smtp_configured():
+            return False
+        async with self._slots:
+            try:
+                client = await self._connect()
+            except Exception as e:
+                print(f"SMTP pre-connect failed: {type(e).__name__}: {e}")
+                return False
+            self._idle.append((client, time.monotonic()))
+        return True
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for client, _ in idle:
+            await self._discard(client, polite=True)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "in_use": self.in_use,
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "health_checks": self.health_checks,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
+
+
+pool = SMTPPool()
+
+
+def _failure_reason(e, lang):
+    if isinstance(e, aiosmtplib.SMTPAuthenticationError):
+        return "SMTP-Authentifizierung fehlgeschlagen" if lang == "de" else "SMTP authentication failed"
+    if isinstance(e, aiosmtplib.SMTPConnectError):
+        return "SMTP-Verbindung fehlgeschlagen" if lang == "de" else "SMTP connection failed"
+    if isinstance(e, (asyncio.TimeoutError, aiosmtplib.SMTPTimeoutError)):
+        return "SMTP-Timeout" if lang == "de" else "SMTP timeout"
+    return str(e)[:80]
+
+
+def _lead_details(ctx, lang):
+    _, body = render_email(
+        "lead_details", lang,
+        NAME=str(ctx.get("name")),
+        EMAIL=str(ctx.get("email")),
+        PHONE=ctx.get("contact_number") or ("-" if lang == "en" else "–"),
+        REASON=str(ctx.get("reason")),
+    )
+    return body
+
+
+async def _send_lead(ctx, lang, message_id=None):
+    subject, body = render_email("lead", lang, NAME=str(ctx.get("name")), DETAILS=_lead_details(ctx, lang))
+
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = Config.SMTP_FROM
+    msg["To"] = Config.CONTACT_EMAIL
+    if message_id:
+        msg["Message-ID"] = message_id
+    msg.set_content(body)
+
+    try:
+        await pool.send(msg)
         return True, None
-    except aiosmtplib.SMTPAuthenticationError:
-        reason = "SMTP-Authentifizierung fehlgeschlagen" if lang == "de" else "SMTP authentication failed"
-    except aiosmtplib.SMTPConnectError:
-        reason = "SMTP-Verbindung fehlgeschlagen" if lang == "de" else "SMTP connection failed"
-    except asyncio.TimeoutError:
-        reason = "SMTP-Timeout" if lang == "de" else "SMTP timeout"
     except Exception as e:
-        reason = str(e)[:80]
+        reason = _failure_reason(e, lang)
 
     print(f"Email send failed: {reason}")
     return False, reason
 
 
-async def send_privacy_email(email_type, lead_data):
+class LeadDigest:
+    """
+    Adaptive lead batching. As long as at most LEAD_DIGEST_THRESHOLD leads
+    arrived within LEAD_DIGEST_WINDOW, every lead is mailed on its own. Above
+    that, further leads are collected and sent as one summary mail when the
+    window has passed (or LEAD_DIGEST_MAX leads are waiting). Every caller
+    gets the result of the mail that contained its lead. The digest is
+    rendered in the language of its first lead.
+    """
+
+    def __init__(self, threshold=None, window=None, max_batch=None):
+        self.threshold = Config.LEAD_DIGEST_THRESHOLD if threshold is None else threshold
+        self.window = window or Config.LEAD_DIGEST_WINDOW
+        self.max_batch = max_batch or Config.LEAD_DIGEST_MAX
+        self._arrivals = deque()
+        # [(ctx, lang, future)]
+        self._pending = []
+        self._timer = None
+
+        self.single = 0
+        self.digests = 0
+        self.digested = 0
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+    async def submit(self, ctx, lang, message_id=None):
+        now = time.monotonic()
+        arrivals = self._arrivals
+        arrivals.append(now)
+        while arrivals and now - arrivals[0] > self.window:
+            arrivals.popleft()
+
+        if not self._pending and len(arrivals) <= self.threshold:
+            self.single += 1
+            return await _send_lead(ctx, lang, message_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((ctx, lang, future))
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self):
+        """Send all waiting leads now as one digest mail."""
+        if self._timer is not None and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        # Abgebrochene Zustellungen (Daten inzwischen gelöscht) nicht mehr mitsenden
+        batch, self._pending = [p for p in self._pending if not p[2].cancelled()], []
+        if not batch:
+            return
+
+        try:
+            lang = batch[0][1]
+            subject, body = render_email(
+                "lead_digest", lang,
+                COUNT=str(len(batch)),
+                DETAILS="\n".join(_lead_details(ctx, lang) for ctx, _, _ in batch),
+            )
+            msg = EmailMessage()
+            msg["Subject"] = subject
+            msg["From"] = Config.SMTP_FROM
+            msg["To"] = Config.CONTACT_EMAIL
+            msg["Message-ID"] = make_msgid(domain="wa-bot")
+            msg.set_content(body)
+            await pool.send(msg)
+            error = None
+            self.digests += 1
+            self.digested += len(batch)
+        except Exception as e:
+            error = e
+            print(f"Digest email ({len(batch)} leads) failed: {_failure_reason(e, 'en')}")
+
+        for _, lang, future in batch:
+            if not future.done():
+                future.set_result((True, None) if error is None else (False, _failure_reason(error, lang)))
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "single": self.single,
+            "digests": self.digests,
+            "digested_leads": self.digested,
+            "waiting": len(self._pending),
+        }
+
+
+digest = LeadDigest()
+
+
+async def send_lead_email(ctx, lang, message_id=None):
+    """Send lead notification email to owner (or queue it for a digest). Returns (success, error_reason)."""
+    if not smtp_configured():
+        return False, "SMTP nicht konfiguriert" if lang == "de" else "SMTP not configured"
+    if digest.enabled:
+        return await digest.submit(ctx, lang, message_id)
+    return await _send_lead(ctx, lang, message_id)
+
+
+async def send_privacy_email(email_type, lead_data, message_id=None):
     """Send privacy-related email (deletion request or reminder) to PRIVACY_EMAIL."""
     if not Config.PRIVACY_EMAIL:
         print("PRIVACY_EMAIL not configured, skipping privacy email")
         return False
 
-    if not all([Config.SMTP_HOST, Config.SMTP_USER, Config.SMTP_PASS, Config.SMTP_FROM]):
+    if not smtp_configured():
         print("SMTP not configured, skipping privacy email")
         return False
 
-    template_path = os.path.join(Config.LANG_DIR, "privacy-deletion-request.json")
-    with open(template_path, "r", encoding="utf-8") as f:
-        templates = json.load(f)
-
-    tpl = templates[email_type]
-
     name = lead_data.get("name") or lead_data.get("lead_name") or "–"
     email = lead_data.get("email") or lead_data.get("lead_email") or "–"
     phone = lead_data.get("phone") or "–"
     reason = lead_data.get("reason") or "–"
     trigger = lead_data.get("trigger") or "–"
 
-    subject = tpl["subject"].replace("$NAME", name)
-    body = (tpl["body"]
-            .replace("$NAME", name)
-            .replace("$EMAIL", email)
-            .replace("$PHONE", phone)
-            .replace("$REASON", reason)
-            .replace("$TRIGGER", trigger))
+    # Template aus lang/privacy-deletion-request.json (kompiliert im Sprachkatalog)
+    subject, body = render_email(email_type, NAME=name, EMAIL=email, PHONE=phone, REASON=reason, TRIGGER=trigger)
 
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = Config.SMTP_FROM
     msg["To"] = Config.PRIVACY_EMAIL
+    if message_id:
+        msg["Message-ID"] = message_id
     msg.set_content(body)
 
     try:
-        await aiosmtplib.send(
-            msg,
-            hostname=Config.SMTP_HOST,
-            port=Config.SMTP_PORT,
-            username=Config.SMTP_USER,
-            password=Config.SMTP_PASS,
-            start_tls=True,
-            tls_context=_tls_context(),
-            timeout=10,
-        )
+        await pool.send(msg)
         print(f"Privacy email ({email_type}) sent to {Config.PRIVACY_EMAIL}")
         return True
     except Exception as e:
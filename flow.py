@@ -0,0 +1,280 @@
+"""
+Declarative conversation engine.
+
+A flow file (JSON, see flows/lead.json) lists transitions as
+(state, input matcher, actions, next state). It is compiled once into hash
+tables keyed by (state, input), so dispatching a turn is a dict lookup on the
+resolved command / pressed button; only states that need free-text checks
+(regex, named checks) fall through to an ordered predicate list, then to the
+state's "else" transition.
+
+Matchers ("on"):
+  command:<CMD>        resolved command (localization.resolve_command)
+  button:<btn_key>     static reply button (localization.button_keys)
+  phone_button:<key>   button whose label is rendered with $PHONE
+  regex:<pattern>      re.search on the text, match -> $match
+  check:<name>         named Python predicate (register_check), result -> $match
+  else                 fallback of the state
+State "*" holds global transitions, checked before the current state.
+
+Actions ("do"), executed in order:
+  {"set": {"key": value}}              write into the session context
+  {"reset": true}                      clear the session context
+  {"send": "<msg_key>", "vars": {...}} send a text
+  {"prompt": "<prompt>"}               send a prompt (text + buttons) from "prompts"
+  {"sleep": seconds}
+  {"call": "<name>"}                   Python hook (register_action)
+Values starting with "$" are references: $text, $phone, $profile_name,
+$match, $ctx.<key>; "|default" supplies a fallback, e.g. "$ctx.name|Gast".
+
+"next" stores the session in that state after the actions; "goto" switches
+to that state and dispatches the same input again (without globals).
+"""
+
+import asyncio
+import json
+import re
+import time
+from dataclasses import dataclass
+from config import Config
+from localization import get_msg
+import metrics
+
+_ACTIONS = {}
+_CHECKS = {}
+
+ELSE = ("else", None)
+GLOBAL = "*"
+MAX_HOPS = 4
+
+
+def register_action(name):
+    """Decorator: async fn(turn) callable from a flow via {"call": name}."""
+    def deco(fn):
+        _ACTIONS[name] = fn
+        return fn
+    return deco
+
+
+def register_check(name):
+    """Decorator: fn(turn) -> value or None, usable as matcher "check:<name>"."""
+    def deco(fn):
+        _CHECKS[name] = fn
+        return fn
+    return deco
+
+
+@dataclass
+class Turn:
+    phone: str
+    text: str
+    profile_name: str
+    step: str
+    ctx: dict
+    lang: str
+    msg_id: str | None = None
+    command: str | None = None
+    pressed: frozenset = frozenset()
+    match: object = None
+    send: object = None  # async fn(phone, text, buttons=None)
+    save: object = None  # async fn(phone, step, ctx, lang)
+
+
+@dataclass
+class Transition:
+    index: int
+    state: str
+    on: str
+    actions: list
+    next: str | None = None
+    goto: str | None = None
+    # Laufzeit-Statistik
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+    @property
+    def label(self):
+        return f"{self.state} --{self.on}--> {self.next or self.goto or self.state}"
+
+
+@dataclass
+class _StateStats:
+    count: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+
+def _resolve(value, turn):
+    if not isinstance(value, str) or not value.startswith("$"):
+        return value
+    ref, _, default = value[1:].partition("|")
+    if ref.startswith("ctx."):
+        result = turn.ctx.get(ref[4:])
+    elif ref in ("text", "phone", "profile_name", "match"):
+        result = getattr(turn, ref)
+    else:
+        raise ValueError(f"Unknown reference {value!r}")
+    return result if result is not None or not default else default
+
+
+class Flow:
+    def __init__(self, spec):
+        self.start = spec.get("start", "START")
+        self.prompts = spec.get("prompts", {})
+        self.transitions = []
+        # (state, (kind, key)) -> Transition, für command/button
+        self._table = {}
+        # state -> [(kind, arg, Transition)], für phone_button/regex/check (geordnet)
+        self._predicates = {}
+        self.state_stats = {}
+        self._compile(spec.get("transitions", []))
+
+    @classmethod
+    def load(cls, path=None):
+        with open(path or Config.FLOW_FILE, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def _compile(self, rows):
+        for i, row in enumerate(rows):
+            t = Transition(i, row["state"], row.get("on", "else"), row.get("do", []),
+                           row.get("next"), row.get("goto"))
+            kind, _, arg = t.on.partition(":")
+            if t.on == "else":
+                key = ELSE
+            elif kind in ("command", "button"):
+                key = (kind, arg)
+            elif kind == "regex":
+                self._predicates.setdefault(t.state, []).append((kind, re.compile(arg), t))
+                key = None
+            elif kind in ("phone_button", "check"):
+                self._predicates.setdefault(t.state, []).append((kind, arg, t))
+                key = None
+            else:
+                raise ValueError(f"Transition {i}: unknown matcher {t.on!r}")
+            if key is not None:
+                if (t.state, key) in self._table:
+                    raise ValueError(f"Transition {i}: duplicate matcher {t.on!r} in state {t.state}")
+                self._table[(t.state, key)] = t
+            self.transitions.append(t)
+        self._validate()
+        self.state_stats = {s: _StateStats() for s in self.states}
+
+    @property
+    def states(self):
+        return {t.state for t in self.transitions if t.state != GLOBAL}
+
+    def _validate(self):
+        states = self.states
+        for t in self.transitions:
+            for target in (t.next, t.goto):
+                if target is not None and target not in states:
+                    raise ValueError(f"{t.label}: unknown state {target!r}")
+            if t.on.startswith("check:") and t.on[6:] not in _CHECKS:
+                raise ValueError(f"{t.label}: unknown check {t.on[6:]!r}")
+            for action in t.actions:
+                if "call" in action and action["call"] not in _ACTIONS:
+                    raise ValueError(f"{t.label}: unknown action {action['call']!r}")
+                if "prompt" in action and action["prompt"] not in self.prompts:
+                    raise ValueError(f"{t.label}: unknown prompt {action['prompt']!r}")
+
+    # --- Dispatch ---
+
+    def _select(self, state, turn, with_globals):
+        table = self._table
+        scopes = (state, GLOBAL) if with_globals else (state,)
+        if turn.command:
+            for scope in scopes:
+                t = table.get((scope, ("command", turn.command)))
+                if t:
+                    return t
+        for key in turn.pressed:
+            t = table.get((state, ("button", key)))
+            if t:
+                return t
+        for kind, arg, t in self._predicates.get(state, ()):
+            if kind == "regex":
+                m = arg.search(turn.text)
+                value = m.group(0) if m else None
+            elif kind == "check":
+                value = _CHECKS[arg](turn)
+            else:  # phone_button
+                label = get_msg(arg, turn.lang, PHONE=turn.phone)
+                value = turn.text if turn.text in (label, label[:20]) else None
+            if value is not None:
+                turn.match = value
+                return t
+        return table.get((state, ELSE))
+
+    async def run(self, turn):
+        """Dispatch one turn. Returns the transitions that fired."""
+        fired = []
+        state = turn.step
+        with_globals = True
+        for _ in range(MAX_HOPS):
+            t = self._select(state, turn, with_globals)
+            if t is None:
+                break
+            started = time.perf_counter()
+            await self._apply(t, turn)
+            elapsed = time.perf_counter() - started
+            t.count += 1
+            t.total += elapsed
+            t.max = max(t.max, elapsed)
+            stats = self.state_stats.get(state)
+            if stats is not None:
+                stats.count += 1
+                stats.total += elapsed
+                stats.max = max(stats.max, elapsed)
+                metrics.FLOW_TRANSITIONS.labels(state).inc()
+                metrics.FLOW_TRANSITION_SECONDS.labels(state).observe(elapsed)
+            fired.append(t)
+
+            if t.next is not None:
+                await turn.save(turn.phone, t.next, turn.ctx, turn.lang)
+            if t.goto is None:
+                break
+            state = turn.step = t.goto
+            with_globals = False
+        return fired
+
+    async def _apply(self, t, turn):
+        for action in t.actions:
+            if "set" in action:
+                for key, value in action["set"].items():
+                    turn.ctx[key] = _resolve(value, turn)
+            elif "reset" in action:
+                turn.ctx = {}
+            elif "send" in action:
+                kwargs = {k: _resolve(v, turn) for k, v in action.get("vars", {}).items()}
+                await turn.send(turn.phone, get_msg(action["send"], turn.lang, **kwargs))
+            elif "prompt" in action:
+                await self.prompt(turn, action["prompt"])
+            elif "sleep" in action:
+                await asyncio.sleep(action["sleep"])
+            elif "call" in action:
+                await _ACTIONS[action["call"]](turn)
+            else:
+                raise ValueError(f"{t.label}: unknown action {action!r}")
+
+    async def prompt(self, turn, name):
+        spec = self.prompts[name]
+        kwargs = {k: _resolve(v, turn) for k, v in spec.get("vars", {}).items()}
+        # Buttons werden immer mit $PHONE gerendert (btn_use_wa_num)
+        btns = [get_msg(b, turn.lang, PHONE=turn.phone) for b in spec.get("buttons", [])]
+        await turn.send(turn.phone, get_msg(spec["text"], turn.lang, **kwargs), btns or None)
+
+    def stats(self):
+        def ms(total, count):
+            return round(total / count * 1000, 2) if count else 0.0
+        return {
+            "states": {
+                s: {"count": st.count, "avg_ms": ms(st.total, st.count), "max_ms": round(st.max * 1000, 2)}
+                for s, st in sorted(self.state_stats.items())
+            },
+            "transitions": [
+                {"transition": t.label, "count": t.count, "avg_ms": ms(t.total, t.count),
+                 "max_ms": round(t.max * 1000, 2)}
+                for t in self.transitions if t.count
+            ],
+        }
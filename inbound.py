@@ -0,0 +1,104 @@
+"""
+Decoding of incoming webhook POSTs.
+
+The raw body is read once: the X-Hub-Signature-256 HMAC is checked over
+exactly these bytes, and only a verified body that contains a "messages"
+key (or a "statuses" key, when delivery tracking wants them) is
+JSON-decoded at all (orjson if installed). The result is flat lists of
+InboundMessage / StatusUpdate tuples instead of nested dicts.
+"""
+
+import hashlib
+import hmac
+import json
+import time
+from typing import NamedTuple, Optional
+
+from config import Config
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+# Status-Callbacks (sent/delivered/read) enthalten "messages" nicht
+_MESSAGES_KEY = b'"messages"'
+_STATUSES_KEY = b'"statuses"'
+_SIGNATURE_PREFIX = "sha256="
+
+
+class InboundMessage(NamedTuple):
+    msg_id: str
+    phone: str
+    text: str
+    name: str
+    reply_id: Optional[str] = None  # ID des gewählten Buttons/Listeneintrags
+
+
+class StatusUpdate(NamedTuple):
+    wamid: str
+    status: str  # sent, delivered, read, failed
+    timestamp: float
+    phone: str
+    error_code: Optional[int] = None
+
+
+def verify_signature(body, header, secret=None):
+    """Check the X-Hub-Signature-256 header against HMAC-SHA256(APP_SECRET, body).
+    Without a configured secret every body passes (warned once at startup)."""
+    secret = Config.APP_SECRET if secret is None else secret
+    if not secret:
+        return True
+    if not header or not header.startswith(_SIGNATURE_PREFIX):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, header[len(_SIGNATURE_PREFIX):])
+
+
+def _content(message):
+    """(text, reply_id) of a message; empty text for types the bot does not handle."""
+    interactive = message.get("interactive")
+    if interactive is not None:
+        reply = interactive.get("button_reply") or interactive.get("list_reply")
+        return (reply["title"], reply.get("id")) if reply else ("", None)
+    text = message.get("text")
+    return (text.get("body", ""), None) if text else ("", None)
+
+
+def _status(status):
+    errors = status.get("errors")
+    return StatusUpdate(status["id"], status["status"], float(status.get("timestamp") or 0) or time.time(),
+                        status.get("recipient_id"), errors[0].get("code") if errors else None)
+
+
+def decode(body, statuses=False):
+    """(messages, statuses) of a webhook body: all messages with text content in
+    payload order, status callbacks only if `statuses` is true. Bodies with
+    neither are not parsed. Raises ValueError for invalid webhook payloads."""
+    want_statuses = statuses and _STATUSES_KEY in body
+    if _MESSAGES_KEY not in body and not want_statuses:
+        return [], []
+    data = loads(body)
+    messages, updates = [], []
+    try:
+        for entry in data.get("entry") or ():
+            for change in entry.get("changes") or ():
+                value = change.get("value") or {}
+                if want_statuses:
+                    updates.extend(_status(s) for s in value.get("statuses") or ())
+                items = value.get("messages")
+                if not items:
+                    continue
+
+                # wa_id -> Profil-Name, ein Batch kann mehrere User enthalten
+                names = {c.get("wa_id"): (c.get("profile") or {}).get("name", "Gast")
+                         for c in value.get("contacts") or ()}
+                for message in items:
+                    text, reply_id = _content(message)
+                    if text:
+                        phone = message["from"]  # Format: 49176...
+                        messages.append(InboundMessage(message["id"], phone, text, names.get(phone, "Gast"), reply_id))
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError(f"unexpected webhook payload: {e!r}") from None
+    return messages, updates
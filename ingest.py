@@ -0,0 +1,138 @@
+"""
+Ingest queue: the webhook only validates, dedups and enqueues; a bounded pool
+of async workers runs the state machine.
+
+Every phone has its own mailbox. A phone is handed to at most one worker at a
+time, so turns of one user run strictly in order while different users are
+processed in parallel.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from config import Config
+from phone_locks import WaitStats
+import metrics
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_MODES = ("reject", "drop")
+
+
+class IngestQueue:
+    def __init__(self, handler, workers=None, max_depth=None, overflow=None):
+        self.handler = handler
+        self.workers = workers or Config.INGEST_WORKERS
+        self.max_depth = max_depth or Config.INGEST_MAX_DEPTH
+        self.overflow = overflow or Config.INGEST_OVERFLOW
+        if self.overflow not in OVERFLOW_MODES:
+            raise ValueError(f"INGEST_OVERFLOW must be one of {OVERFLOW_MODES}, got {self.overflow!r}")
+
+        # phone -> deque of (enqueued_at, args); Eintrag existiert solange die Nummer
+        # in der Ready-Queue steht oder gerade von einem Worker bearbeitet wird
+        self._mailboxes = {}
+        self._ready = asyncio.Queue()
+        self._tasks = []
+        self._depth = 0
+        self._busy = 0
+        self._accepting = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+        self.enqueued = 0
+        self.processed = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.queue_waits = WaitStats()
+
+    def start(self):
+        if self._tasks:
+            return
+        self._accepting = True
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Ingest queue started ({self.workers} workers, max depth {self.max_depth}, "
+                    f"overflow={self.overflow})")
+
+    async def stop(self, timeout=None):
+        """Stop accepting, let workers drain for up to `timeout` seconds, then cancel them."""
+        self._accepting = False
+        timeout = Config.INGEST_DRAIN_TIMEOUT if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Ingest queue stopped with {self._depth} messages still queued")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def alive(self):
+        """True while all worker tasks are running."""
+        return bool(self._tasks) and not any(task.done() for task in self._tasks)
+
+    def full(self, incoming=1):
+        """True if `incoming` more messages would not fit."""
+        return not self._accepting or self._depth + incoming > self.max_depth
+
+    def submit(self, phone, *args):
+        """Queue one message for `phone`. Returns False if the queue is full or stopped."""
+        if self.full():
+            self.overflowed += 1
+            action = "rejecting" if self.overflow == "reject" else "dropping"
+            logger.warning(f"Ingest queue full ({self._depth}/{self.max_depth}), {action} message for {phone}")
+            return False
+
+        item = (time.monotonic(), args)
+        mailbox = self._mailboxes.get(phone)
+        if mailbox is None:
+            self._mailboxes[phone] = deque([item])
+            self._ready.put_nowait(phone)
+        else:
+            mailbox.append(item)
+
+        self._depth += 1
+        self.enqueued += 1
+        self._idle.clear()
+        return True
+
+    async def _worker(self, n):
+        while True:
+            phone = await self._ready.get()
+            mailbox = self._mailboxes[phone]
+            self._busy += 1
+            try:
+                while mailbox:
+                    enqueued_at, args = mailbox.popleft()
+                    self.queue_waits.record(phone, time.monotonic() - enqueued_at)
+                    try:
+                        await self.handler(phone, *args)
+                        self.processed += 1
+                        metrics.MESSAGES.labels("ok").inc()
+                    except Exception as e:
+                        self.failed += 1
+                        metrics.MESSAGES.labels("error").inc()
+                        logger.error(f"Error handling message for {phone}: {e}")
+                    finally:
+                        self._depth -= 1
+                        metrics.MESSAGE_SECONDS.observe(time.monotonic() - enqueued_at)
+            finally:
+                self._busy -= 1
+                del self._mailboxes[phone]
+                if self._depth == 0:
+                    self._idle.set()
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "depth": self._depth,
+            "max_depth": self.max_depth,
+            "active_phones": len(self._mailboxes),
+            "overflow": self.overflow,
+            "enqueued": self.enqueued,
+            "processed": self.processed,
+            "failed": self.failed,
+            "overflowed": self.overflowed,
+            "queue_wait": self.queue_waits.summary(),
+        }
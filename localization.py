@@ -1,81 +1,255 @@
+import asyncio
 import json
+import logging
 import os
+from contextlib import contextmanager
+from contextvars import ContextVar
 from string import Template
 from config import Config
+from calling_codes import CALLING_CODES, PrefixTrie
+
+logger = logging.getLogger(__name__)
+
+# Button-Titel werden von WhatsApp auf 20 Zeichen gekürzt (siehe whatsapp.build_message)
+BUTTON_TITLE_MAX = 20
+
+
+class Catalog:
+    """
+    Compiled language files (immutable once built):
+      - alias -> command index per language (English aliases always win)
+      - message templates per language, English keys merged in as fallback,
+        static placeholders ($OWNER_NAME, $EMAIL, $WEBSITE) already substituted
+      - button label -> button keys per language (for static btn_* labels)
+      - email templates per (name, language): the "emails" section of a
+        language file, English and language-neutral template files
+        (e.g. privacy-deletion-request.json) as fallback
+      - calling-code prefix trie -> language, resolved against the
+        languages of this catalog (LANGUAGE_PREFIXES first)
+    """
+
+    def __init__(self, raw, shared_emails=None):
+        self.languages = frozenset(raw)
+        en = raw.get("en", {})
+
+        static = {"OWNER_NAME": Config.OWNER_NAME, "EMAIL": Config.CONTACT_EMAIL, "WEBSITE": Config.WEBSITE}
+        compiled = {lang: self._compile_messages(data.get("messages", {}), static) for lang, data in raw.items()}
+        en_msgs = compiled.get("en", {})
+        self._messages = {lang: {**en_msgs, **msgs} for lang, msgs in compiled.items()}
+        self._default_messages = en_msgs
+
+        en_cmds = self._index_commands(en.get("commands", {}))
+        self._commands = {lang: {**self._index_commands(data.get("commands", {})), **en_cmds}
+                          for lang, data in raw.items()}
+        self._default_commands = en_cmds
+
+        self._buttons = {lang: self._index_buttons(msgs) for lang, msgs in self._messages.items()}
+        self._default_buttons = self._buttons.get("en", {})
+
+        # In E-Mails ist $EMAIL die Adresse des Leads; statische Werte nur als Default beim Rendern
+        self._email_defaults = static
+        en_emails = {**self._compile_emails(shared_emails or {}), **self._compile_emails(en.get("emails", {}))}
+        self._emails = {(name, lang): tpl
+                        for lang, data in raw.items()
+                        for name, tpl in {**en_emails, **self._compile_emails(data.get("emails", {}))}.items()}
+        self._default_emails = en_emails
+
+        self._prefixes = self._build_prefixes(self.languages)
+
+    @staticmethod
+    def _build_prefixes(languages):
+        """Trie over all calling codes with an available language; overrides replace a prefix's candidates."""
+        candidates = {**CALLING_CODES, **{prefix: (lang,) for prefix, lang in Config.LANGUAGE_PREFIXES.items()}}
+        trie = PrefixTrie()
+        for prefix, langs in candidates.items():
+            lang = next((l for l in langs if l in languages), None)
+            if lang is not None:
+                trie.insert(prefix, lang)
+        return trie
+
+    @staticmethod
+    def _compile_messages(messages, static):
+        out = {}
+        for key, raw_msg in messages.items():
+            if not raw_msg:
+                continue
+            text = Template(raw_msg).safe_substitute(static)
+            # Nur Texte mit verbleibenden Platzhaltern brauchen zur Laufzeit ein Template
+            out[key] = Template(text) if "$" in text else text
+        return out
+
+    @staticmethod
+    def _compile_emails(templates):
+        # (subject, body) als Template; Rendern ist dann ein einziger Substitutionsdurchlauf
+        return {
+            name: tuple(Template(spec[part]) if spec.get(part) else None for part in ("subject", "body"))
+            for name, spec in templates.items()
+        }
+
+    @staticmethod
+    def _index_commands(commands):
+        return {alias.lower(): cmd for cmd, aliases in commands.items() for alias in aliases}
+
+    @staticmethod
+    def _index_buttons(messages):
+        index = {}
+        for key, msg in messages.items():
+            if not key.startswith("btn_") or isinstance(msg, Template):
+                continue
+            for label in {msg, msg[:BUTTON_TITLE_MAX]}:
+                index[label] = index.get(label, frozenset()) | {key}
+        return index
+
+    def get_msg(self, key, lang="en", **kwargs):
+        msg = self._messages.get(lang, self._default_messages).get(key)
+        if msg is None:
+            return f"[MISSING TEXT: {key}]"
+        if isinstance(msg, Template):
+            return msg.safe_substitute(kwargs)
+        return msg
+
+    def detect_language(self, phone):
+        """Language for a phone number (E.164 digits) by longest calling-code prefix."""
+        return self._prefixes.longest_match(phone.lstrip("+"), Config.DEFAULT_LANGUAGE)
+
+    def resolve_command(self, text, lang="en"):
+        text = text.lower().strip().replace("/", "")
+        return self._commands.get(lang, self._default_commands).get(text)
+
+    def button_keys(self, text, lang="en"):
+        return self._buttons.get(lang, self._default_buttons).get(text, frozenset())
+
+    def render_email(self, name, lang="en", **kwargs):
+        tpl = self._emails.get((name, lang)) or self._default_emails.get(name)
+        if tpl is None:
+            raise KeyError(f"Unknown email template {name!r}")
+        values = {**self._email_defaults, **kwargs}
+        return tuple(part.safe_substitute(values) if part else None for part in tpl)
+
+    @property
+    def email_templates(self):
+        return sorted({name for name, _ in self._emails} | set(self._default_emails))
+
+
+# Wird beim Start (main.warm_up) oder beim ersten Zugriff gebaut
+_catalog = None
+_signature = None
+# Während eines Turns fest gepinnter Katalog (siehe pinned())
+_pinned = ContextVar("localization_catalog", default=None)
+
+
+def _lang_files():
+    """(filename, mtime_ns, size) of all .json files in LANG_DIR."""
+    return tuple(sorted(
+        (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+        for entry in os.scandir(Config.LANG_DIR)
+        if entry.name.endswith(".json") and entry.is_file()
+    ))
+
+
+def _is_email_templates(data):
+    return isinstance(data, dict) and data and all(isinstance(v, dict) and "body" in v for v in data.values())
+
+
+def _build():
+    raw = {}
+    shared_emails = {}
+    for filename, _, _ in _lang_files():
+        lang_code = filename.split(".")[0]
+        try:
+            with open(os.path.join(Config.LANG_DIR, filename), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error loading language {filename}: {e}")
+            continue
+        if isinstance(data, dict) and "messages" in data:
+            raw[lang_code] = data
+        elif _is_email_templates(data):
+            # Sprachneutrale E-Mail-Templates (z.B. privacy-deletion-request.json)
+            shared_emails.update(data)
+    return Catalog(raw, shared_emails)
 
-# Cache für Sprachdateien
-_LANG_CACHE = {}
 
 def load_languages():
-    """Lädt alle .json Dateien aus dem lang/ Ordner"""
+    """Lädt alle Sprachdateien aus LANG_DIR und tauscht den Katalog atomar aus"""
+    global _catalog, _signature
     if not os.path.exists(Config.LANG_DIR):
         os.makedirs(Config.LANG_DIR)
+        _catalog = Catalog({})
+        return _catalog
+
+    signature = _lang_files()
+    _catalog = _build()
+    _signature = signature
+    return _catalog
+
+
+async def watch_languages(interval=None):
+    """Background task: reload the catalog when a file in LANG_DIR changes."""
+    global _catalog, _signature
+    interval = Config.LANG_RELOAD_INTERVAL if interval is None else interval
+    if interval <= 0:
         return
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            signature = await asyncio.to_thread(_lang_files)
+            if signature == _signature:
+                continue
+            catalog = await asyncio.to_thread(_build)
+            # Eine Referenz-Zuweisung: laufende Turns behalten ihren gepinnten Katalog
+            _catalog, _signature = catalog, signature
+            logger.info(f"Language files reloaded ({', '.join(sorted(catalog.languages))})")
+        except Exception as e:
+            logger.error(f"Language reload failed, keeping previous catalog: {e}")
 
-    for filename in os.listdir(Config.LANG_DIR):
-        if filename.endswith(".json"):
-            lang_code = filename.split(".")[0]
-            try:
-                with open(os.path.join(Config.LANG_DIR, filename), "r", encoding="utf-8") as f:
-                    _LANG_CACHE[lang_code] = json.load(f)
-            except Exception as e:
-                print(f"Error loading language {filename}: {e}")
 
-# Init beim Start
-load_languages()
+def catalog():
+    return _pinned.get() or _catalog or load_languages()
+
+
+@contextmanager
+def pinned():
+    """Use one catalog version for everything inside the block (one conversation turn)."""
+    token = _pinned.set(_catalog or load_languages())
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+def available_languages():
+    return catalog().languages
+
 
 def detect_language(phone_number):
-    """Simple Mapping basierend auf Vorwahl"""
-    if phone_number.startswith("49"): return "de"
-    if phone_number.startswith("43"): return "de" # Österreich
-    if phone_number.startswith("41"): return "de" # Schweiz
-    if phone_number.startswith("1"): return "en"  # USA/Canada
-    return "en" # Default Fallback
+    """Sprache anhand der Ländervorwahl (längster Präfix, siehe calling_codes.py)"""
+    return catalog().detect_language(phone_number)
 
 def get_msg(key, lang="en", **kwargs):
     """
     Holt Nachricht und ersetzt Platzhalter ($NAME, etc.).
     Fallback auf 'en', wenn Sprache oder Key nicht existiert.
     """
-    # 1. Versuch: Gewünschte Sprache
-    data = _LANG_CACHE.get(lang)
-    if not data:
-        data = _LANG_CACHE.get("en", {})
-    
-    raw_msg = data.get("messages", {}).get(key)
-    
-    # 2. Fallback: Englisch
-    if not raw_msg and lang != "en":
-         raw_msg = _LANG_CACHE.get("en", {}).get("messages", {}).get(key)
-    
-    if not raw_msg:
-        return f"[MISSING TEXT: {key}]"
-    
-    # Platzhalter ersetzen (füge Config-Vars global hinzu)
-    kwargs["OWNER_NAME"] = Config.OWNER_NAME
-    kwargs["EMAIL"] = Config.CONTACT_EMAIL
-    kwargs["WEBSITE"] = Config.WEBSITE
-    
-    return Template(raw_msg).safe_substitute(**kwargs)
+    return catalog().get_msg(key, lang, **kwargs)
 
 def resolve_command(text, lang="en"):
     """
     Prüft input gegen ENGLISCH (immer aktiv) und LOKALSPRACHE.
     Gibt den Canonical Command zurück (z.B. 'START') oder None.
     """
-    text = text.lower().strip().replace("/", "")
-    
-    # Prüfe erst Englisch (Global)
-    en_cmds = _LANG_CACHE.get("en", {}).get("commands", {})
-    for cmd_key, aliases in en_cmds.items():
-        if text in aliases:
-            return cmd_key
-            
-    # Prüfe Lokalsprache
-    if lang != "en":
-        loc_cmds = _LANG_CACHE.get(lang, {}).get("commands", {})
-        for cmd_key, aliases in loc_cmds.items():
-            if text in aliases:
-                return cmd_key
-                
-    return None
+    return catalog().resolve_command(text, lang)
+
+def render_email(name, lang="en", **kwargs):
+    """
+    E-Mail-Template rendern -> (subject, body). Ein Durchlauf, d.h. Platzhalter
+    in eingesetzten Werten werden nicht nochmal ersetzt. KeyError bei unbekanntem Template.
+    """
+    return catalog().render_email(name, lang, **kwargs)
+
+def button_keys(text, lang="en"):
+    """
+    Welche Buttons (btn_* Keys) haben diesen Titel? Leeres frozenset, wenn keiner.
+    Mehrere Keys möglich, z.B. 'Abbrechen' = btn_cancel und btn_delete_no.
+    """
+    return catalog().button_keys(text, lang)
@@ -1,25 +1,107 @@
 from fastapi import FastAPI, Request, Response
 from fastapi.responses import JSONResponse
-from database import init_db, is_msg_processed, delete_user_data
-from email_service import send_privacy_email
-from cleanup import run_scheduler
-from logic import handle_message
+import database
+from database import init_db
+from sessions import store as session_store, delete_user_data
+import outbox
+import inbound
+import delivery
+from ratelimit import limiter, ALLOW, NOTIFY
+import metrics
+import email_service
+from cleanup import cleanup_old_entries, retention
+from scheduler import scheduler
+from broadcast import broadcaster, parse_request as parse_broadcast
+from logic import handle_message, flow
+from whatsapp import dispatcher
+from ingest import IngestQueue
+from dedup import dedup
+from backends import backend
+from localization import watch_languages, load_languages
 from config import Config
 import asyncio
 import hashlib
 import hmac
 import json
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_BOOT = time.monotonic()
+
 app = FastAPI()
+ingest = IngestQueue(handle_message)
+
+# "starting" -> "ready" -> "stopping"; /readyz meldet erst nach dem Warm-up bereit
+lifecycle = {"state": "starting", "phases": {}}
+_warm_task = None
+
+# Nur im Worker mit dem Scheduler-Lease
+scheduler.add_job("retention", Config.CLEANUP_INTERVAL_SECONDS, cleanup_old_entries)
+scheduler.add_service("outbox", outbox.worker.start, outbox.worker.stop)
+scheduler.add_service("broadcasts", broadcaster.start, broadcaster.stop)
+
+async def _phase(name, coro):
+    started = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        elapsed = time.perf_counter() - started
+        lifecycle["phases"][name] = round(elapsed, 3)
+        metrics.STARTUP_SECONDS.labels(name).set(elapsed)
+
+async def warm_up():
+    """Open what the first webhook would otherwise pay for, then report ready."""
+    try:
+        await asyncio.gather(
+            _phase("db_readers", database.open_pool()),
+            _phase("languages", asyncio.to_thread(load_languages)),
+            _phase("graph", dispatcher.warm()),
+            _phase("smtp", email_service.pool.warm()),
+        )
+    except Exception as e:
+        # Ohne Warm-up läuft alles trotzdem, nur der erste Zugriff ist langsamer
+        logger.error(f"Warm-up failed: {e}")
+    if lifecycle["state"] == "starting":
+        lifecycle["state"] = "ready"
+        total = time.monotonic() - _BOOT
+        metrics.STARTUP_SECONDS.labels("total").set(total)
+        logger.info(f"Ready after {total:.2f}s ({lifecycle['phases']})")
 
 @app.on_event("startup")
 async def startup():
-    init_db()
-    asyncio.create_task(run_scheduler())
+    global _warm_task
+    if not Config.APP_SECRET:
+        logger.warning("APP_SECRET is not set: webhook signatures are NOT verified")
+    # Schema + Dedup-Gedächtnis vor dem ersten Webhook, sonst könnte eine Redelivery durchrutschen
+    await _phase("db", asyncio.to_thread(init_db))
+    await backend.start()
+    await _phase("dedup", dedup.warm())
+    dedup.start()
+    session_store.start()
+    delivery.tracker.start()
+    await dispatcher.start()
+    ingest.start()
+    scheduler.start()
+    asyncio.create_task(watch_languages())
+    _warm_task = asyncio.create_task(warm_up())
+
+@app.on_event("shutdown")
+async def shutdown():
+    lifecycle["state"] = "stopping"
+    if _warm_task is not None and not _warm_task.done():
+        _warm_task.cancel()
+    await ingest.stop()
+    await scheduler.stop()
+    await email_service.pool.close()
+    await dispatcher.close()
+    await delivery.tracker.stop()
+    await dedup.stop()
+    await session_store.stop()
+    await backend.close()
+    database.close()
 
 @app.get("/webhook")
 async def verify(request: Request):
@@ -29,42 +111,159 @@ async def verify(request: Request):
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    data = await request.json()
-    
+    started = time.perf_counter()
+    try:
+        return await _webhook(request)
+    finally:
+        metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+
+async def _webhook(request):
+    # Signatur über genau die empfangenen Bytes prüfen, erst danach parsen
+    body = await request.body()
+    if not inbound.verify_signature(body, request.headers.get("X-Hub-Signature-256")):
+        metrics.WEBHOOK_REJECTED.labels("signature").inc()
+        return Response(status_code=403)
+    try:
+        messages, statuses = inbound.decode(body, statuses=delivery.tracker.enabled)
+    except ValueError as e:
+        metrics.WEBHOOK_REJECTED.labels("malformed").inc()
+        logger.warning(f"Rejected webhook payload: {e}")
+        return Response(status_code=400)
+
+    if statuses:
+        delivery.tracker.update(statuses)
+
     try:
-        changes = data.get("entry", [])[0].get("changes", [])[0]
-        value = changes.get("value", {})
-        
-        if "messages" in value:
-            message = value["messages"][0]
-            phone = message["from"] # Format: 49176...
-            msg_id = message["id"]
-            
-            # 1. Profil-Namen extrahieren
-            profile_name = "Gast"
-            contacts = value.get("contacts", [])
-            if contacts:
-                profile_name = contacts[0].get("profile", {}).get("name", "Gast")
-
-            # 2. Textinhalt extrahieren
-            text = ""
-            if "interactive" in message:
-                if "button_reply" in message["interactive"]:
-                    text = message["interactive"]["button_reply"]["title"]
-                elif "list_reply" in message["interactive"]:
-                    text = message["interactive"]["list_reply"]["title"]
-            elif "text" in message:
-                text = message["text"]["body"]
-
-            # 3. An Logik übergeben
-            if text and not is_msg_processed(msg_id):
-                await handle_message(phone, text, msg_id, profile_name)
-                
+        if messages:
+            # Bei "reject" VOR dem Dedup abweisen, sonst gilt Metas Redelivery als Duplikat
+            if ingest.full(len(messages)) and ingest.overflow == "reject":
+                return JSONResponse({"status": "busy"}, status_code=503)
+            if not limiter.allow_global(len(messages)):
+                return JSONResponse({"status": "busy"}, status_code=503)
+
+            # Ganzen Batch gegen den Dedup-Cache prüfen (kein Disk-I/O), neue Nachrichten einreihen
+            try:
+                new_ids = set(await dedup.filter_new([m.msg_id for m in messages]))
+            except Exception as e:
+                # Backend (Redis/geteilte DB) nicht erreichbar: nichts wurde gemerkt -> Meta soll erneut zustellen
+                metrics.WEBHOOK_REJECTED.labels("dedup").inc()
+                logger.error(f"Dedup failed, asking for redelivery: {e}")
+                return JSONResponse({"status": "busy"}, status_code=503)
+            rejected = []
+            for m in messages:
+                if m.msg_id in new_ids:
+                    new_ids.discard(m.msg_id) # gleiche ID doppelt im Batch
+                    if rejected:
+                        # Nach der ersten Abweisung alles Weitere abweisen, sonst überholt eine
+                        # spätere Nachricht derselben Nummer die abgewiesene
+                        rejected.append(m.msg_id)
+                        continue
+                    # Rate limit pro Nummer erst nach dem Dedup: Redeliveries kosten keine Tokens
+                    verdict = limiter.check(m.phone)
+                    if verdict == ALLOW:
+                        # Queue kann sich während des Dedup-awaits gefüllt haben oder gestoppt sein
+                        if not ingest.submit(m.phone, m.text, m.msg_id, m.name) and ingest.overflow == "reject":
+                            rejected.append(m.msg_id)
+                    elif verdict == NOTIFY:
+                        limiter.notify(m.phone)
+            if rejected:
+                # Claim zurückgeben, sonst gilt Metas Redelivery als Duplikat und die Nachricht ist verloren
+                try:
+                    await dedup.release(rejected)
+                except Exception as e:
+                    logger.error(f"Could not release {len(rejected)} rejected message IDs: {e}")
+                metrics.WEBHOOK_REJECTED.labels("ingest_full").inc()
+                return JSONResponse({"status": "busy"}, status_code=503)
+
     except Exception as e:
         logger.error(f"Error processing webhook: {e}")
     
     return {"status": "ok"}
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the event loop answers and the ingest workers are running."""
+    if not ingest.alive():
+        return JSONResponse({"status": "unhealthy", "reason": "ingest workers stopped"}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: startup and warm-up are done and the app is not shutting down."""
+    if lifecycle["state"] != "ready":
+        return JSONResponse({"status": lifecycle["state"], "phases": lifecycle["phases"]}, status_code=503)
+    return {"status": "ready"}
+
+def _is_admin(request):
+    # Ohne ADMIN_TOKEN sind die Admin-Endpoints aus
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    return bool(Config.ADMIN_TOKEN) and hmac.compare_digest(token.encode(), Config.ADMIN_TOKEN.encode())
+
+@app.get("/ingest/stats")
+async def ingest_stats(request: Request):
+    if not _is_admin(request):
+        return Response(status_code=403)
+    return {
+        **ingest.stats(),
+        "dedup": dedup.stats(),
+        "sessions": session_store.stats(),
+        "phone_locks": backend.local_locks.stats(),
+        "flow": flow.stats(),
+        "outbox": {**outbox.worker.stats(), "rows": await database.outbox_counts()},
+        "retention": retention.stats(),
+        "scheduler": scheduler.stats(),
+        "broadcast": broadcaster.stats(),
+        "rate_limit": limiter.stats(),
+        "delivery": {**delivery.tracker.stats(),
+                     "last_24h": await database.delivery_summary(time.time() - 86400)},
+    }
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    for table, rows in (await database.table_sizes()).items():
+        metrics.TABLE_ROWS.labels(table).set(rows)
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/broadcasts")
+async def create_broadcast(request: Request):
+    """Start a broadcast to all leads matching the filter (see broadcast.py for the body)."""
+    if not _is_admin(request):
+        return Response(status_code=403)
+    try:
+        spec, lead_filter = parse_broadcast(json.loads(await request.body()))
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    broadcast_id, total = await broadcaster.create(spec, lead_filter)
+    # Sendet sofort, falls dieser Worker Leader ist, sonst beim nächsten Poll des Leaders
+    broadcaster.wake()
+    return {"id": broadcast_id, "total": total}
+
+@app.get("/broadcasts")
+async def list_broadcasts(request: Request, status: str = None):
+    if not _is_admin(request):
+        return Response(status_code=403)
+    return {"broadcasts": await database.list_broadcasts(status), "live": broadcaster.stats()}
+
+@app.get("/broadcasts/{broadcast_id}")
+async def broadcast_status(request: Request, broadcast_id: int):
+    if not _is_admin(request):
+        return Response(status_code=403)
+    row = await broadcaster.status(broadcast_id)
+    if row is None:
+        return Response(status_code=404)
+    return row
+
+@app.post("/broadcasts/{broadcast_id}/{action}")
+async def broadcast_control(request: Request, broadcast_id: int, action: str):
+    """pause, resume or cancel; 409 if the broadcast's state does not allow it."""
+    if not _is_admin(request):
+        return Response(status_code=403)
+    if action not in ("pause", "resume", "cancel"):
+        return Response(status_code=404)
+    if not await broadcaster.control(broadcast_id, action):
+        return JSONResponse({"error": f"cannot {action} broadcast {broadcast_id}"}, status_code=409)
+    return await broadcaster.status(broadcast_id)
+
 @app.post("/data-deletion")
 async def data_deletion(request: Request):
     body = await request.body()
@@ -90,11 +289,9 @@ async def data_deletion(request: Request):
     user_id = decoded.get("user_id")
 
     if user_id:
-        lead_data = delete_user_data(user_id)
-        if lead_data:
-            lead_data["phone"] = user_id
-            lead_data["trigger"] = "Meta data-deletion callback"
-            await send_privacy_email("deletion_request", lead_data)
+        # Lösch-Mail wird in derselben Transaktion in die Outbox gelegt
+        if await delete_user_data(user_id, trigger="Meta data-deletion callback"):
+            outbox.worker.wake()
 
     confirmation_code = hashlib.sha256(f"{user_id}-deleted".encode()).hexdigest()[:12]
     return JSONResponse({
@@ -0,0 +1,167 @@
+"""
+In-process metrics, exposed as Prometheus text on GET /metrics.
+
+All observations happen on the event loop thread (DB timings are measured in
+the worker thread and observed by the awaiting coroutine), so plain counters
+without locks are enough. Histograms have fixed buckets: observe() is one
+bisect and two additions, cumulative bucket counts are only built on scrape.
+Label values must come from small, fixed sets (states, status codes, query
+names) - never phone numbers or message IDs.
+"""
+
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ("upper", "counts", "sum")
+
+    def __init__(self, upper):
+        self.upper = upper
+        self.counts = [0] * (len(upper) + 1)  # letzter Eintrag: +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.upper, value)] += 1
+        self.sum += value
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        _registry.append(self)
+        if not self.label_names:
+            self.labels()  # ungelabelte Metriken erscheinen sofort mit 0
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    def _child(self):
+        return _Value()
+
+    def _samples(self):
+        for values, child in sorted(self._children.items()):
+            yield f"{self.name}{_labels(self.label_names, values)} {_number(child.value)}"
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labels)
+
+    def _child(self):
+        return _Buckets(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _samples(self):
+        bounds = self.buckets + (float("inf"),)
+        for values, child in sorted(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, child.counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                yield f"{self.name}_bucket{_labels(self.label_names, values, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.label_names, values)} {_number(child.sum)}"
+            yield f"{self.name}_count{_labels(self.label_names, values)} {cumulative}"
+
+
+def render():
+    """All metrics in Prometheus text exposition format (0.0.4)."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Metriken ---
+
+WEBHOOK_SECONDS = Histogram("wa_webhook_request_seconds", "Time spent in the webhook handler (parse, dedup, enqueue)")
+WEBHOOK_REJECTED = Counter("wa_webhook_rejected_total", "Webhook POSTs rejected before processing by reason", ("reason",))
+RATE_LIMITED = Counter("wa_rate_limited_total", "Incoming messages hit by rate limits by action (notify, drop, shed)",
+                       ("action",))
+MESSAGE_SECONDS = Histogram("wa_message_e2e_seconds", "From enqueue in the webhook to the end of the conversation turn")
+MESSAGES = Counter("wa_messages_total", "Processed conversation turns by result", ("result",))
+DEDUP_MESSAGES = Counter("wa_dedup_messages_total", "Incoming message IDs by dedup result", ("result",))
+DELIVERY_STATUSES = Counter("wa_delivery_statuses_total", "Status callbacks for outgoing messages by status",
+                            ("status",))
+DB_QUERY_SECONDS = Histogram("wa_db_query_seconds", "Execution time of one DB operation (one transaction for writes)",
+                             ("query", "mode"), DB_BUCKETS)
+GRAPH_REQUEST_SECONDS = Histogram("wa_graph_request_seconds", "Duration of one Graph API send attempt")
+GRAPH_RESPONSES = Counter("wa_graph_responses_total", "Graph API send attempts by HTTP status", ("status",))
+SMTP_SEND_SECONDS = Histogram("wa_smtp_send_seconds", "Duration of one SMTP send (including connect if needed)")
+SMTP_FAILURES = Counter("wa_smtp_failures_total", "Failed SMTP sends by error type", ("error",))
+FLOW_TRANSITIONS = Counter("wa_flow_transitions_total", "Fired flow transitions by step (state before the transition)",
+                           ("step",))
+FLOW_TRANSITION_SECONDS = Histogram("wa_flow_transition_seconds", "Duration of the actions of one transition by step",
+                                    ("step",))
+BROADCAST_MESSAGES = Counter("wa_broadcast_messages_total", "Broadcast sends by result (sent, failed)", ("result",))
+SCHEDULER_LEADER = Gauge("wa_scheduler_leader", "1 if this worker holds the scheduler lease")
+SCHEDULER_JOB_RUNS = Counter("wa_scheduler_job_runs_total", "Finished scheduler job runs by job and result", ("job", "result"))
+STARTUP_SECONDS = Gauge("wa_startup_seconds", "Duration of the startup phases of this process (total = import to ready)",
+                        ("phase",))
+TABLE_ROWS = Gauge("wa_table_rows", "Rows per table (counted on scrape)", ("table",))
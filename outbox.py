@@ -0,0 +1,217 @@
+"""
+Outbox delivery worker.
+
+Rows in the outbox table are written in the same transaction as the change
+that triggers them (lead saved, data deleted). This worker claims due rows
+with a lease, delivers them, retries with exponential backoff and moves rows
+to 'dead' after OUTBOX_MAX_ATTEMPTS. The idempotency key doubles as the
+email Message-ID, so a redelivery after a crash is recognizable as the same
+mail. Deleting a user's data deletes their rows in every state; a delivery
+that is running at that moment is cancelled and never queued again.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from config import Config
+import database
+import email_service
+from email_service import send_lead_email, send_privacy_email, smtp_configured
+from localization import get_msg
+from whatsapp import dispatcher, build_message
+
+logger = logging.getLogger(__name__)
+
+_HANDLERS = {}
+
+
+class PermanentError(Exception):
+    """Raised by a handler when retrying cannot help; the row is dead-lettered at once."""
+
+
+def handler(kind):
+    """Decorator: async fn(payload, idem_key) -> (ok, error, email_log) for one outbox kind.
+    `email_log` (phone, name, email, reason) is written together with the done mark."""
+    def deco(fn):
+        _HANDLERS[kind] = fn
+        return fn
+    return deco
+
+
+def _message_id(idem_key):
+    return f"<{idem_key.replace(':', '.')}@wa-bot>"
+
+
+@handler("lead_email")
+async def deliver_lead_email(payload, idem_key):
+    if not smtp_configured():
+        raise PermanentError("SMTP nicht konfiguriert" if payload["lang"] == "de" else "SMTP not configured")
+    lead = payload["lead"]
+    ok, reason = await send_lead_email(lead, payload["lang"], message_id=_message_id(idem_key))
+    if not ok:
+        return False, reason, None
+    # email_log erst nach bestätigter Zustellung
+    return True, None, (payload["phone"], lead.get("name"), lead.get("email"), lead.get("reason"))
+
+
+@handler("privacy_email")
+async def deliver_privacy_email(payload, idem_key):
+    if not Config.PRIVACY_EMAIL or not smtp_configured():
+        raise PermanentError("PRIVACY_EMAIL/SMTP not configured")
+    ok = await send_privacy_email(payload["email_type"], payload["lead_data"], message_id=_message_id(idem_key))
+    return ok, None if ok else "privacy email not sent", None
+
+
+@handler("whatsapp")
+async def deliver_whatsapp(payload, idem_key):
+    result = await dispatcher.send(payload["to"], build_message(payload["to"], payload["text"], payload.get("buttons")))
+    return result.ok, result.error, None
+
+
+def dead_notice(row, error):
+    """Outbox row (kind, idem_key, payload, phone) telling the user that their lead
+    mail was dead-lettered; written together with the dead mark. None for other kinds."""
+    if row["kind"] != "lead_email":
+        return None
+    payload = row["payload"]
+    text = get_msg("email_send_failed", payload["lang"], REASON=error or "?")
+    return ("whatsapp", f"{row['idem_key']}:failed", {"to": payload["phone"], "text": text}, payload["phone"])
+
+
+class OutboxWorker:
+    def __init__(self, poll_interval=None, batch=None, lease=None, max_attempts=None):
+        self.poll_interval = poll_interval or Config.OUTBOX_POLL_INTERVAL
+        self.batch = batch or Config.OUTBOX_BATCH
+        self.lease = lease or Config.OUTBOX_LEASE
+        self.max_attempts = max_attempts or Config.OUTBOX_MAX_ATTEMPTS
+        self._wake = asyncio.Event()
+        self._task = None
+        # Laufende Zustellungen; eine Lead-Mail kann im Digest bis LEAD_DIGEST_WINDOW warten,
+        # deshalb blockiert eine Zustellung nicht das Claimen weiterer Einträge. Task -> Telefonnummer
+        self._inflight = {}
+
+        self.delivered = 0
+        self.failed = 0
+        self.dead = 0
+
+    def wake(self):
+        """Deliver soon (call after committing new outbox rows)."""
+        self._wake.set()
+
+    def cancel(self, phone):
+        """Abort running deliveries for `phone` (its outbox rows were deleted)."""
+        for task, owner in list(self._inflight.items()):
+            if owner == phone:
+                task.cancel()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout=10):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Wartende Digest-Leads sofort senden, dann laufende Zustellungen abwarten.
+        # Was danach noch läuft, wird abgebrochen und nach Ablauf des Leases erneut zugestellt.
+        await email_service.digest.flush()
+        if self._inflight:
+            _, pending = await asyncio.wait(set(self._inflight), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.drain_once():
+                    pass
+            except Exception as e:
+                logger.error(f"Outbox error: {e}")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def drain_once(self):
+        """Claim due rows for the free delivery slots (OUTBOX_BATCH in total) and
+        start delivering them. Returns the number of claimed rows."""
+        free = self.batch - len(self._inflight)
+        if free <= 0:
+            return 0
+        rows = await database.claim_outbox(time.time(), self.lease, free)
+        for row in rows:
+            task = asyncio.create_task(self._deliver(row))
+            self._inflight[task] = row["phone"]
+            task.add_done_callback(self._delivered)
+        return len(rows)
+
+    def _delivered(self, task):
+        self._inflight.pop(task, None)
+        # Slot frei: fällige Einträge nachziehen
+        self.wake()
+
+    async def _deliver(self, row):
+        # Lease verlängern, solange die Zustellung läuft (Digest wartet bis LEAD_DIGEST_WINDOW,
+        # SMTP kann hängen), sonst claimt ein anderer Worker den Eintrag und die Mail geht doppelt raus
+        keeper = asyncio.create_task(self._keep_lease(row["id"]))
+        try:
+            await self._attempt(row)
+        finally:
+            keeper.cancel()
+
+    async def _keep_lease(self, outbox_id):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                await database.renew_outbox_lease(outbox_id, time.time() + self.lease)
+            except Exception as e:
+                logger.warning(f"Outbox lease renewal failed: {e}")
+
+    async def _attempt(self, row):
+        deliver = _HANDLERS.get(row["kind"])
+        permanent = deliver is None
+        try:
+            if deliver is None:
+                ok, error, email_log = False, f"no handler for {row['kind']!r}", None
+            else:
+                ok, error, email_log = await deliver(row["payload"], row["idem_key"])
+        except PermanentError as e:
+            ok, error, email_log = False, str(e), None
+            permanent = True
+        except Exception as e:
+            ok, error, email_log = False, f"{type(e).__name__}: {e}"[:200], None
+
+        if ok:
+            if await database.outbox_done(row["id"], email_log):
+                self.delivered += 1
+            return
+
+        attempts = row["attempts"] + 1
+        dead = attempts >= self.max_attempts or permanent
+        delay = min(Config.OUTBOX_BACKOFF_MAX, Config.OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1))
+        delay *= 0.5 + random.random() / 2
+        # Dead-Mark und Nachricht an den User in einer Transaktion
+        notice = dead_notice(row, error) if dead else None
+        if not await database.outbox_failed(row["id"], error, time.time() + delay, dead, notice):
+            # Während der Zustellung gelöscht (Datenlöschung): kein Retry, keine Nachricht an den User
+            return
+        if dead:
+            self.dead += 1
+            logger.error(f"Outbox {row['kind']} {row['idem_key']} dead after {attempts} attempts: {error}")
+            if notice:
+                self.wake()
+        else:
+            self.failed += 1
+            logger.warning(f"Outbox {row['kind']} attempt {attempts} failed, retry in {delay:.0f}s: {error}")
+
+    def stats(self):
+        return {"delivered": self.delivered, "retried": self.failed, "dead": self.dead,
+                "in_flight": len(self._inflight), "smtp": email_service.pool.stats(),
+                "digest": email_service.digest.stats()}
+
+
+worker = OutboxWorker()
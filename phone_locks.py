@@ -0,0 +1,108 @@
+"""
+Per-phone serialization: a lock table with refcounted cleanup.
+
+A phone only has a lock while a turn holds it or waits for it, so memory is
+bounded by the number of phones that are active right now. Wait times are
+tracked globally and for recently active phones (bounded LRU, idle phones are
+evicted after PHONE_STATS_IDLE), keyed by a masked number so the stats never
+hold a full phone number.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from config import Config
+
+
+def mask_phone(phone):
+    """'4917612345678' -> '49…5678': enough to tell phones apart in stats, not to contact them."""
+    return f"{phone[:2]}…{phone[-4:]}" if len(phone) > 6 else "…"
+
+
+class WaitStats:
+    """Wait-time aggregates, globally and per phone (bounded)."""
+
+    def __init__(self, max_phones=None, idle_seconds=None):
+        self.max_phones = max_phones or Config.PHONE_STATS_MAX
+        self.idle_seconds = idle_seconds or Config.PHONE_STATS_IDLE
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # maskierte Nummer -> [count, total, max, last_seen]
+        self._phones = OrderedDict()
+
+    def record(self, phone, waited):
+        now = time.monotonic()
+        phone = mask_phone(phone)
+        self.count += 1
+        self.total += waited
+        if waited > self.max:
+            self.max = waited
+
+        entry = self._phones.get(phone)
+        if entry is None:
+            entry = self._phones[phone] = [0, 0.0, 0.0, now]
+        else:
+            self._phones.move_to_end(phone)
+        entry[0] += 1
+        entry[1] += waited
+        if waited > entry[2]:
+            entry[2] = waited
+        entry[3] = now
+        self._evict(now)
+
+    def _evict(self, now):
+        phones = self._phones
+        while phones:
+            phone, entry = next(iter(phones.items()))
+            if len(phones) <= self.max_phones and now - entry[3] < self.idle_seconds:
+                break
+            del phones[phone]
+
+    def summary(self, top=10):
+        self._evict(time.monotonic())
+        worst = sorted(self._phones.items(), key=lambda kv: kv[1][2], reverse=True)[:top]
+        return {
+            "count": self.count,
+            "avg_wait_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_wait_ms": round(self.max * 1000, 2),
+            "tracked_phones": len(self._phones),
+            "slowest_phones": [
+                {"phone": phone, "turns": c, "avg_wait_ms": round(t / c * 1000, 2), "max_wait_ms": round(m * 1000, 2)}
+                for phone, (c, t, m, _) in worst
+            ],
+        }
+
+
+class PhoneLocks:
+    def __init__(self):
+        # phone -> [Lock, refcount]; verschwindet, sobald niemand mehr hält oder wartet
+        self._locks = {}
+        self.waits = WaitStats()
+
+    @asynccontextmanager
+    async def lock(self, phone):
+        entry = self._locks.get(phone)
+        if entry is None:
+            entry = self._locks[phone] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        requested = time.monotonic()
+        try:
+            async with entry[0]:
+                self.waits.record(phone, time.monotonic() - requested)
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[phone]
+
+    def __len__(self):
+        return len(self._locks)
+
+    def stats(self):
+        return {
+            "active_phones": len(self._locks),
+            "waiting": sum(n - 1 for lock, n in self._locks.values() if lock.locked()),
+            "lock_wait": self.waits.summary(),
+        }
@@ -0,0 +1,145 @@
+"""
+Token-bucket rate limiting at the webhook edge.
+
+Every phone has a bucket of RATE_LIMIT_BURST tokens, refilled with
+RATE_LIMIT_PER_MINUTE tokens per minute; each incoming message takes one.
+The first message over the limit gets one polite notice per
+RATE_LIMIT_NOTICE_WINDOW, all others are dropped silently before a worker or
+the Graph API sees them. Phones are checked after dedup, so Meta's
+redeliveries of messages we already have cost no tokens. A global bucket
+(RATE_LIMIT_GLOBAL messages per second) sheds whole deliveries with 503
+before dedup, so Meta redelivers them later instead of us losing them.
+
+Buckets are kept in LRU order, a check is O(1). A bucket that was idle long
+enough to be full again (and whose notice window is over) carries no state
+and is evicted; beyond RATE_LIMIT_MAX_PHONES buckets the least recently used
+go first.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from config import Config
+from localization import get_msg, detect_language
+from whatsapp import dispatcher, build_message
+from sessions import store as session_store
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ALLOW, NOTIFY, DROP = "allow", "notify", "drop"
+
+_NOTIFIED = metrics.RATE_LIMITED.labels("notify")
+_DROPPED = metrics.RATE_LIMITED.labels("drop")
+_SHED = metrics.RATE_LIMITED.labels("shed")
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, n=1, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+
+class RateLimiter:
+    def __init__(self, per_minute=None, burst=None, global_rate=None, global_burst=None,
+                 notice_window=None, max_phones=None):
+        per_minute = Config.RATE_LIMIT_PER_MINUTE if per_minute is None else per_minute
+        self.rate = per_minute / 60
+        self.burst = burst or Config.RATE_LIMIT_BURST
+        self.notice_window = Config.RATE_LIMIT_NOTICE_WINDOW if notice_window is None else notice_window
+        self.max_phones = max_phones or Config.RATE_LIMIT_MAX_PHONES
+        global_rate = Config.RATE_LIMIT_GLOBAL if global_rate is None else global_rate
+        self._global = TokenBucket(global_rate, global_burst or Config.RATE_LIMIT_GLOBAL_BURST) if global_rate else None
+
+        # phone -> [tokens, zuletzt aufgefüllt (monotonic), letzter Hinweis]; vorne = am längsten inaktiv
+        self._phones = OrderedDict()
+        # Ab dieser Inaktivität ist ein Bucket wieder voll und sein Hinweisfenster vorbei
+        self._idle_after = max(self.burst / self.rate, self.notice_window) if self.rate else 0
+        self._notices = set()
+
+        self.dropped = 0
+        self.notified = 0
+        self.shed = 0
+
+    def allow_global(self, n, now=None):
+        """Take `n` tokens from the global bucket; False = shed the whole delivery."""
+        if self._global is None or not n or self._global.take(n, now):
+            return True
+        self.shed += n
+        _SHED.inc(n)
+        return False
+
+    def check(self, phone, now=None):
+        """ALLOW, NOTIFY (first message over the limit in this window) or DROP."""
+        if not self.rate:
+            return ALLOW
+        now = time.monotonic() if now is None else now
+        phones = self._phones
+        entry = phones.get(phone)
+        if entry is None:
+            self._evict(now)
+            entry = phones[phone] = [self.burst, now, None]
+        else:
+            phones.move_to_end(phone)
+            entry[0] = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+            entry[1] = now
+
+        if entry[0] >= 1:
+            entry[0] -= 1
+            return ALLOW
+        if entry[2] is None or now - entry[2] >= self.notice_window:
+            entry[2] = now
+            self.notified += 1
+            _NOTIFIED.inc()
+            return NOTIFY
+        self.dropped += 1
+        _DROPPED.inc()
+        return DROP
+
+    def _evict(self, now):
+        phones = self._phones
+        while phones:
+            phone, entry = next(iter(phones.items()))
+            if now - entry[1] < self._idle_after and len(phones) < self.max_phones:
+                break
+            phones.popitem(last=False)
+
+    def notify(self, phone):
+        """Send the throttle notice in the background (never blocks the webhook)."""
+        task = asyncio.create_task(self._send_notice(phone))
+        self._notices.add(task)
+        task.add_done_callback(self._notices.discard)
+
+    async def _send_notice(self, phone):
+        text = get_msg("rate_limited", session_store.language(phone) or detect_language(phone))
+        try:
+            await dispatcher.send(phone, build_message(phone, text))
+        except Exception as e:
+            logger.error(f"Rate limit notice to {phone} failed: {e}")
+
+    def stats(self):
+        return {
+            "phones": len(self._phones),
+            "max_phones": self.max_phones,
+            "dropped": self.dropped,
+            "notified": self.notified,
+            "shed": self.shed,
+            "global_tokens": round(self._global.tokens, 1) if self._global else None,
+        }
+
+
+limiter = RateLimiter()
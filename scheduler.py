@@ -0,0 +1,192 @@
+"""
+Background jobs with leader election, for deployments with several workers.
+
+Every worker process runs the scheduler, but only the holder of the
+scheduler's row in the leases table runs jobs and leader services. The
+leader renews its lease every SCHEDULER_HEARTBEAT seconds; if it dies or
+stalls, the lease expires after SCHEDULER_LEASE_TTL and the next worker to
+heartbeat takes over. A graceful shutdown releases the lease right away.
+
+Jobs run periodically with their own interval (+-SCHEDULER_JITTER of it, so
+runs drift apart from other periodic work), one run per job at a time, as
+separate tasks so a long job never delays the heartbeat. Services (e.g. the
+outbox worker) are started when leadership is gained and stopped when it is
+lost.
+"""
+
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from config import Config
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def lease_owner():
+    """A name for this process in the leases table (host:pid:random, unique per call)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Job:
+    def __init__(self, name, interval, fn, at_start=True):
+        self.name = name
+        self.interval = interval
+        self.fn = fn
+        self.at_start = at_start
+        self.next_run = None  # monotonic, gesetzt bei Übernahme der Führung
+        self.task = None
+        self.runs = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+        self.last_error = None
+
+
+class Scheduler:
+    def __init__(self, name="scheduler", lease_ttl=None, heartbeat=None, jitter=None):
+        self.name = name
+        self.lease_ttl = lease_ttl or Config.SCHEDULER_LEASE_TTL
+        self.heartbeat = heartbeat or Config.SCHEDULER_HEARTBEAT
+        self.jitter = Config.SCHEDULER_JITTER if jitter is None else jitter
+        self.owner = lease_owner()
+        self.leader = False
+        self._valid_until = 0.0  # monotonic; ohne erfolgreiche Erneuerung bis dahin Leader
+        self._jobs = {}
+        self._services = {}
+        self._task = None
+        self.elections = 0
+
+    def add_job(self, name, interval, fn, at_start=True):
+        """Run `await fn()` every `interval` seconds on the leader (first run right after election)."""
+        self._jobs[name] = Job(name, interval, fn, at_start)
+
+    def add_service(self, name, start, stop):
+        """`start()` when this worker becomes leader, `await stop()` when it stops being leader."""
+        self._services[name] = (start, stop)
+
+    def _jittered(self, seconds):
+        return seconds * (1 + self.jitter * (2 * random.random() - 1))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.leader:
+            await self._step_down()
+            try:
+                await database.release_lease(self.name, self.owner)
+            except Exception as e:
+                logger.error(f"Releasing scheduler lease failed: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                held = await database.acquire_lease(self.name, self.owner, time.time(), self.lease_ttl)
+            except Exception as e:
+                # DB kurz nicht erreichbar: Führung behalten, solange der Lease noch gilt
+                logger.error(f"Scheduler heartbeat failed: {e}")
+                held = self.leader and time.monotonic() < self._valid_until
+            else:
+                if held:
+                    self._valid_until = time.monotonic() + self.lease_ttl
+
+            if held and not self.leader:
+                self._take_over()
+            elif not held and self.leader:
+                logger.warning(f"Scheduler lease lost ({self.owner})")
+                await self._step_down()
+
+            wait = self._jittered(self.heartbeat)
+            if self.leader:
+                self._run_due()
+                now = time.monotonic()
+                for job in self._jobs.values():
+                    if job.task is None:
+                        wait = min(wait, max(0.0, job.next_run - now))
+            await asyncio.sleep(wait)
+
+    def _take_over(self):
+        self.leader = True
+        self.elections += 1
+        metrics.SCHEDULER_LEADER.set(1)
+        logger.info(f"Scheduler: {self.owner} is leader")
+        now = time.monotonic()
+        for job in self._jobs.values():
+            job.next_run = now if job.at_start else now + self._jittered(job.interval)
+        for name, (start, _) in self._services.items():
+            start()
+
+    async def _step_down(self):
+        self.leader = False
+        metrics.SCHEDULER_LEADER.set(0)
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for name, (_, stop) in self._services.items():
+            try:
+                await stop()
+            except Exception as e:
+                logger.error(f"Stopping {name} failed: {e}")
+
+    def _run_due(self):
+        now = time.monotonic()
+        for job in self._jobs.values():
+            if job.task is None and job.next_run <= now:
+                job.task = asyncio.create_task(self._run_job(job))
+
+    async def _run_job(self, job):
+        started = time.monotonic()
+        try:
+            await job.fn()
+            result = "ok"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.errors += 1
+            job.last_error = f"{type(e).__name__}: {e}"
+            result = "error"
+            logger.error(f"Job {job.name} failed: {e}")
+        finally:
+            job.task = None
+            job.last_duration = time.monotonic() - started
+            job.next_run = time.monotonic() + self._jittered(job.interval)
+        job.runs += 1
+        job.last_run = time.time()
+        metrics.SCHEDULER_JOB_RUNS.labels(job.name, result).inc()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "owner": self.owner,
+            "leader": self.leader,
+            "elections": self.elections,
+            "services": list(self._services),
+            "jobs": {
+                job.name: {
+                    "interval": job.interval,
+                    "running": job.task is not None,
+                    "next_run_in": round(job.next_run - now, 1) if self.leader and job.next_run else None,
+                    "runs": job.runs,
+                    "errors": job.errors,
+                    "last_run": job.last_run,
+                    "last_duration": job.last_duration,
+                    "last_error": job.last_error,
+                }
+                for job in self._jobs.values()
+            },
+        }
+
+
+scheduler = Scheduler()
@@ -0,0 +1,178 @@
+"""
+Write-behind session cache for the conversation state machine.
+
+Hot sessions (step, context, language) live in memory. Changes only mark the
+session dirty; a background task flushes all dirty sessions to the sessions
+table in one transaction, every SESSION_FLUSH_INTERVAL seconds or as soon as
+SESSION_FLUSH_THRESHOLD sessions are dirty, and once more on shutdown.
+
+With a shared backend (several workers/hosts) nothing is cached across turns:
+turn() takes the backend's per-phone lock, the session is read fresh and
+written back before the lock is released.
+"""
+
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from config import Config
+from backends import backend
+from writebehind import WriteBehind
+import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore(WriteBehind):
+    def __init__(self, backend, max_entries=None, flush_interval=None, flush_threshold=None):
+        super().__init__(flush_interval or Config.SESSION_FLUSH_INTERVAL)
+        self.backend = backend
+        self.max_entries = max_entries or Config.SESSION_CACHE_SIZE
+        self.flush_threshold = flush_threshold or Config.SESSION_FLUSH_THRESHOLD
+
+        # phone -> (step, context, language), LRU-Reihenfolge
+        self._hot = OrderedDict()
+        self._dirty = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.flushed = 0
+
+    async def get(self, phone):
+        entry = self._hot.get(phone)
+        if entry is not None:
+            self.hits += 1
+            self._hot.move_to_end(phone)
+        else:
+            self.misses += 1
+            entry = await self.backend.get_session(phone)
+            # Während des awaits kann ein update() gelaufen sein -> das gewinnt
+            entry = self._hot.setdefault(phone, entry)
+            self._evict()
+        step, ctx, lang = entry
+        # Kopie, damit logic.py den Cache nicht ohne update() verändert
+        return step, dict(ctx), lang
+
+    def language(self, phone):
+        """Cached language of a hot session, None if unknown (no backend access)."""
+        entry = self._hot.get(phone)
+        return entry[2] if entry else None
+
+    def update(self, phone, step, ctx, language=None):
+        if language is None:
+            cached = self._hot.get(phone)
+            # Unbekannte Sprache bleibt None, der Flush behält dann die Sprache aus der DB
+            language = cached[2] if cached else None
+        self._hot[phone] = (step, dict(ctx), language)
+        self._hot.move_to_end(phone)
+        self._dirty.add(phone)
+        if len(self._dirty) >= self.flush_threshold:
+            self.flush_soon()
+        self._evict()
+
+    def clear(self, phone):
+        self.update(phone, "START", {}, None)
+
+    def put_clean(self, phone, step, ctx, language):
+        """Record a state that was already written to the DB by someone else."""
+        self._hot[phone] = (step, dict(ctx), language)
+        self._hot.move_to_end(phone)
+        self._dirty.discard(phone)
+
+    def discard(self, phone):
+        self._hot.pop(phone, None)
+        self._dirty.discard(phone)
+
+    @asynccontextmanager
+    async def turn(self, phone):
+        """Run one conversation turn for `phone` under the backend's per-phone lock."""
+        async with self.backend.lock(phone):
+            if not self.backend.shared:
+                yield
+                return
+            # Ein anderer Worker kann die Session seit unserem letzten Turn geändert haben
+            self.discard(phone)
+            try:
+                yield
+            finally:
+                entry = self._hot.pop(phone, None)
+                if phone in self._dirty:
+                    self._dirty.discard(phone)
+                    await self.backend.save_sessions([(phone, *entry)])
+                    self.flushed += 1
+
+    def _evict(self):
+        # Nur saubere Einträge verdrängen; dirty bleiben bis zum nächsten Flush
+        excess = len(self._hot) - self.max_entries
+        if excess <= 0:
+            return
+        for phone in list(self._hot):
+            if excess <= 0:
+                break
+            if phone not in self._dirty:
+                del self._hot[phone]
+                excess -= 1
+        if excess > 0:
+            self.flush_soon()
+
+    def start(self):
+        # Shared: turn() schreibt selbst zurück; ein paralleler Flush könnte einen älteren Stand überholen
+        if not self.backend.shared:
+            super().start()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        # Submit ohne await nach dem Snapshot: der Writer-Thread arbeitet FIFO,
+        # spätere Schreibzugriffe (complete_lead, delete_user_data) landen danach
+        phones, self._dirty = self._dirty, set()
+        rows = [(p, *self._hot[p]) for p in phones if p in self._hot]
+        try:
+            await self.backend.save_sessions(rows)
+            self.flushed += len(rows)
+        except Exception as e:
+            # Nochmal als dirty markieren, sofern nicht inzwischen verworfen
+            self._dirty.update(p for p in phones if p in self._hot)
+            logger.error(f"Session flush failed ({len(rows)} sessions): {e}")
+
+    def stats(self):
+        return {
+            "entries": len(self._hot),
+            "max_entries": self.max_entries,
+            "dirty": len(self._dirty),
+            "hits": self.hits,
+            "misses": self.misses,
+            "flushed": self.flushed,
+        }
+
+
+store = SessionStore(backend)
+
+
+# --- Drop-in API für logic.py ---
+
+async def get_session(phone):
+    return await store.get(phone)
+
+async def update_session(phone, step, context, language=None):
+    store.update(phone, step, context, language)
+
+async def clear_session(phone):
+    # Reset auf START, behalte aber Sprache bei, wenn möglich
+    store.clear(phone)
+
+async def complete_lead(phone, ctx, lang, msg_id):
+    """Store the lead and set COMPLETED in one DB transaction, then mirror it in the cache."""
+    # Vorher als sauber markieren, sonst könnte ein Flush danach den alten Stand schreiben
+    store.put_clean(phone, "COMPLETED", {}, lang)
+    try:
+        await backend.complete_lead(phone, ctx, lang, msg_id)
+    except Exception:
+        store.discard(phone)
+        raise
+
+async def delete_user_data(phone, trigger=None):
+    store.discard(phone)
+    lead_data = await backend.delete_user_data(phone, trigger)
+    # Outbox-Einträge der Nummer sind gelöscht; laufende Zustellungen hier abbrechen
+    outbox.worker.cancel(phone)
+    return lead_data
@@ -0,0 +1,44 @@
+"""
+Test setup: the modules read Config at import time, so the environment is
+prepared here before any of them is imported. Every test session gets its own
+SQLite file; STATE_BACKEND=memory keeps the state in-process.
+
+  pip install -r requirements-dev.txt
+  python -m pytest tests
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.update({
+    "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="wabot-test-"), "bot.db"),
+    "STATE_BACKEND": "memory",
+    "STATE_SHARED": "false",
+    "LANG_DIR": os.path.join(ROOT, "lang"),
+    "FLOW_FILE": os.path.join(ROOT, "flows", "lead.json"),
+    "APP_SECRET": "",
+    "SMTP_HOST": "",
+    "LEAD_DIGEST_THRESHOLD": "0",
+})
+
+import database  # noqa: E402
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    database.init_db()
+    yield
+    database.close()
+
+
+@pytest.fixture
+def run():
+    """Run a coroutine to completion on a fresh event loop."""
+    return asyncio.run
@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import backends
+import database
+from config import Config
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def redis_pair(monkeypatch):
+    """Two RedisBackend instances (two "workers") on one in-process fake server."""
+    import fakeredis.aioredis
+    import redis.asyncio
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis.asyncio, "from_url",
+                        lambda url, **kw: fakeredis.aioredis.FakeRedis(server=server, **kw))
+    return backends.RedisBackend(prefix="test"), backends.RedisBackend(prefix="test")
+
+
+def _lead_rows(phone):
+    db = database.get_db()
+    leads = db.execute("SELECT COUNT(*) FROM leads WHERE phone = ?", (phone,)).fetchone()[0]
+    mails = db.execute("SELECT COUNT(*) FROM outbox WHERE kind = 'lead_email' AND phone = ?", (phone,)).fetchone()[0]
+    return leads, mails
+
+
+def test_redis_claim_is_shared_and_releasable(redis_pair, run):
+    a, b = redis_pair
+
+    async def scenario():
+        first = await a.claim_messages(["m1", "m2", "m1"])
+        second = await b.claim_messages(["m2", "m3"])
+        await a.release_messages(["m2"])
+        third = await b.claim_messages(["m2"])
+        return first, second, third
+
+    assert run(scenario()) == ({"m1", "m2"}, {"m3"}, {"m2"})
+
+
+def test_redis_complete_lead(redis_pair, run):
+    a, b = redis_pair
+
+    async def scenario():
+        await a.complete_lead("4911", {"name": "Ann", "email": "a@x"}, "de", "wamid.r1")
+        return await b.get_session("4911"), await a._redis.get(a._key("lead", "4911"))
+
+    session, intent = run(scenario())
+    assert session == ("COMPLETED", {}, "de")
+    assert intent is None
+    assert _lead_rows("4911") == (1, 1)
+
+
+def test_redis_complete_lead_replays_after_failed_commit(redis_pair, run, monkeypatch):
+    a, b = redis_pair
+    save_lead = database.save_lead
+
+    async def broken(*args):
+        raise RuntimeError("disk full")
+
+    async def scenario():
+        monkeypatch.setattr(database, "save_lead", broken)
+        with pytest.raises(RuntimeError):
+            await a.complete_lead("4912", {"name": "Bob"}, "en", "wamid.r2")
+        # Session ist COMPLETED, der Lead nur vorgemerkt
+        assert await a._redis.get(a._key("lead", "4912")) is not None
+        monkeypatch.setattr(database, "save_lead", save_lead)
+        # Nächster Zugriff eines beliebigen Workers holt den Lead nach, ein zweiter ist ein No-op
+        await b.get_session("4912")
+        await b.start()
+        return await b.get_session("4912")
+
+    assert run(scenario()) == ("COMPLETED", {}, "en")
+    assert _lead_rows("4912") == (1, 1)
+
+
+def test_redis_delete_drops_pending_lead(redis_pair, run, monkeypatch):
+    a, _ = redis_pair
+
+    async def broken(*args):
+        raise RuntimeError("disk full")
+
+    async def scenario():
+        monkeypatch.setattr(database, "save_lead", broken)
+        with pytest.raises(RuntimeError):
+            await a.complete_lead("4913", {"name": "Cy"}, "en", "wamid.r3")
+        monkeypatch.undo()
+        await a.delete_user_data("4913")
+        return await a.get_session("4913")
+
+    assert run(scenario()) == ("START", {}, None)
+    assert _lead_rows("4913") == (0, 0)
+
+
+@pytest.mark.parametrize("make", ["redis", "sqlite"])
+def test_lock_is_renewed_during_long_turn(make, redis_pair, run, monkeypatch):
+    monkeypatch.setattr(Config, "LOCK_TTL", 0.3)
+    monkeypatch.setattr(Config, "LOCK_WAIT", 0.1)
+    if make == "redis":
+        a, b = redis_pair
+    else:
+        a, b = backends.SQLiteBackend(shared=True), backends.SQLiteBackend(shared=True)
+
+    async def scenario():
+        async with a.lock("4914"):
+            await asyncio.sleep(1.0)  # > LOCK_TTL
+            with pytest.raises(TimeoutError):
+                async with b.lock("4914"):
+                    pass
+        async with b.lock("4914"):
+            return True
+
+    assert run(scenario())
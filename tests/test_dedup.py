@@ -0,0 +1,81 @@
+import pytest
+
+from backends import MemoryBackend
+from dedup import DedupCache
+
+
+class FlakyBackend(MemoryBackend):
+    """Shared backend whose next `failures` claims/marks raise (Redis or shared DB unreachable)."""
+
+    shared = True
+
+    def __init__(self, failures=1):
+        super().__init__()
+        self.failures = failures
+
+    def _fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("backend down")
+
+    async def claim_messages(self, msg_ids):
+        self._fail()
+        return await super().claim_messages(msg_ids)
+
+    async def mark_messages(self, msg_ids):
+        self._fail()
+        await super().mark_messages(msg_ids)
+
+
+def test_failed_claim_remembers_nothing(run):
+    cache = DedupCache(FlakyBackend(failures=1))
+
+    async def scenario():
+        with pytest.raises(ConnectionError):
+            await cache.filter_new(["m1", "m2"])
+        assert cache.stats()["entries"] == 0
+        # Redelivery nach dem Ausfall wird verarbeitet, eine weitere gilt als Duplikat
+        return await cache.filter_new(["m1", "m2"]), await cache.filter_new(["m1", "m2"])
+
+    assert run(scenario()) == (["m1", "m2"], [])
+
+
+def test_only_own_claims_are_new(run):
+    backend = FlakyBackend(failures=0)
+    ours, theirs = DedupCache(backend), DedupCache(backend)
+
+    async def scenario():
+        await theirs.filter_new(["m2"])
+        return await ours.filter_new(["m1", "m2", "m1"])
+
+    assert run(scenario()) == ["m1"]
+
+
+def test_release_makes_ids_new_again(run):
+    cache = DedupCache(FlakyBackend(failures=0))
+
+    async def scenario():
+        await cache.filter_new(["m1", "m2"])
+        await cache.release(["m2"])
+        return await cache.filter_new(["m1", "m2"])
+
+    assert run(scenario()) == ["m2"]
+
+
+def test_write_behind_retries_failed_flush(run):
+    backend = MemoryBackend()
+    cache = DedupCache(backend, flush_batch=100)
+
+    async def failing(msg_ids):
+        raise ConnectionError("db locked")
+
+    async def scenario():
+        assert await cache.filter_new(["m1", "m1", "m2"]) == ["m1", "m2"]
+        backend.mark_messages, mark = failing, backend.mark_messages
+        await cache.flush()
+        assert cache.stats()["pending_writes"] == 2
+        backend.mark_messages = mark
+        await cache.flush()
+        return cache.stats()["pending_writes"], await backend.claim_messages(["m1", "m2", "m3"])
+
+    assert run(scenario()) == (0, {"m3"})
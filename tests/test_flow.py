@@ -0,0 +1,176 @@
+import itertools
+
+import pytest
+
+import database
+import logic
+import sessions
+from flow import Flow, GLOBAL
+from localization import get_msg
+
+_ids = itertools.count()
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """say(phone, text) runs one turn through flows/lead.json; returns (step, ctx, sent)."""
+    sent = []
+
+    async def send_wa(to, text, buttons=None):
+        sent.append((text, buttons))
+
+    monkeypatch.setattr(logic, "send_wa", send_wa)
+
+    async def say(phone, text):
+        sent.clear()
+        msg_id = f"wamid.flow{next(_ids)}"
+        await logic.process_turn(phone, text, msg_id, "Max")
+        step, ctx, _ = await sessions.get_session(phone)
+        return step, ctx, list(sent), msg_id
+
+    return say
+
+
+def test_lead_happy_path(chat, run):
+    phone = "15550101"
+
+    async def scenario():
+        steps = []
+        for text in ["hi", get_msg("btn_msg", "en"), "Need a website", get_msg("btn_yes_correct", "en"),
+                     "not an email", "max@example.com", get_msg("btn_use_wa_num", "en", PHONE=phone)]:
+            steps.append(await chat(phone, text))
+        return steps
+
+    steps = run(scenario())
+    assert [s[0] for s in steps] == ["MENU_SELECTION", "ASK_REASON", "CONFIRM_NAME", "ASK_EMAIL",
+                                     "ASK_EMAIL", "ASK_PHONE_DECISION", "COMPLETED"]
+    # Begrüßung mit den Menü-Buttons
+    assert steps[0][2][0][1] == [get_msg("btn_msg", "en"), get_msg("btn_contact", "en")]
+    assert steps[3][1] == {"profile_name": "Max", "reason": "Need a website", "name": "Max"}
+    assert steps[4][2] == [(get_msg("email_invalid", "en"), None)]
+    assert steps[5][1]["email"] == "max@example.com"
+
+    final_msg_id = steps[6][3]
+    db = database.get_db()
+    lead = db.execute("SELECT name, email, reason, sms_number, call_optin FROM leads WHERE phone = ?",
+                      (phone,)).fetchone()
+    assert tuple(lead) == ("Max", "max@example.com", "Need a website", phone, 1)
+    assert db.execute("SELECT COUNT(*) FROM outbox WHERE idem_key = ?",
+                      (f"lead_email:{final_msg_id}",)).fetchone()[0] == 1
+
+
+def test_manual_name_and_no_number(chat, run):
+    phone = "15550102"
+
+    async def scenario():
+        for text in ["hi", "I have a question", get_msg("btn_change_name", "en"), "Erika",
+                     "erika@example.com"]:
+            await chat(phone, text)
+        return await chat(phone, get_msg("btn_no_num", "en"))
+
+    step, _, sent, _ = run(scenario())
+    assert step == "COMPLETED"
+    lead = database.get_db().execute("SELECT name, reason, call_optin FROM leads WHERE phone = ?",
+                                     (phone,)).fetchone()
+    assert tuple(lead) == ("Erika", "I have a question", 0)
+
+
+def test_global_stop_resets_from_any_state(chat, run):
+    phone = "15550103"
+
+    async def scenario():
+        for text in ["hi", get_msg("btn_msg", "en"), "reason"]:
+            await chat(phone, text)
+        return await chat(phone, "stop")
+
+    step, ctx, sent, _ = run(scenario())
+    assert (step, ctx) == ("START", {})
+    assert sent == [(get_msg("stop_msg", "en"), None)]
+
+
+def test_help_jumps_to_start_without_globals(chat, run):
+    phone = "15550104"
+
+    async def scenario():
+        await chat(phone, "hi")
+        return await chat(phone, "/help")
+
+    step, _, sent, _ = run(scenario())
+    # goto START, dort greift "else" (Begrüßung) und nicht nochmal das globale HELP
+    assert step == "MENU_SELECTION"
+    assert len(sent) == 1 and sent[0][1] == [get_msg("btn_msg", "en"), get_msg("btn_contact", "en")]
+
+
+def test_invalid_phone_number_is_asked_again(chat, run):
+    phone = "15550105"
+
+    async def scenario():
+        for text in ["hi", get_msg("btn_msg", "en"), "r", get_msg("btn_yes_correct", "en"),
+                     "a@b.io", get_msg("btn_type_num", "en")]:
+            await chat(phone, text)
+        invalid = await chat(phone, "12")
+        valid = await chat(phone, "+1 555-0100-99")
+        return invalid, valid
+
+    invalid, valid = run(scenario())
+    assert invalid[0] == "ASK_PHONE_MANUAL" and invalid[2] == [(get_msg("phone_invalid", "en"), None)]
+    assert valid[0] == "COMPLETED"
+
+
+def test_privacy_confirm_anything_else_cancels(chat, run):
+    phone = "15550106"
+
+    async def scenario():
+        await chat(phone, "hi")
+        confirm = await chat(phone, "privacy")
+        cancelled = await chat(phone, "hmm, no")
+        await chat(phone, "privacy")
+        # Der Button "Cancel" ist zugleich das globale STOP-Kommando
+        stopped = await chat(phone, get_msg("btn_delete_no", "en"))
+        return confirm, cancelled, stopped
+
+    confirm, cancelled, stopped = run(scenario())
+    assert confirm[0] == "CONFIRM_DELETE"
+    assert confirm[2][0][1] == [get_msg("btn_delete_yes", "en"), get_msg("btn_delete_no", "en")]
+    assert cancelled[0] == "START" and cancelled[2] == [(get_msg("privacy_cancelled", "en"), None)]
+    assert stopped[0] == "START" and stopped[2] == [(get_msg("stop_msg", "en"), None)]
+
+
+def test_privacy_delete_after_lead(chat, run):
+    phone = "15550107"
+
+    async def scenario():
+        for text in ["hi", get_msg("btn_msg", "en"), "r", get_msg("btn_yes_correct", "en"),
+                     "d@e.io", get_msg("btn_no_num", "en"), "privacy"]:
+            await chat(phone, text)
+        return await chat(phone, get_msg("btn_delete_yes", "en"))
+
+    step, _, sent, _ = run(scenario())
+    assert step == "START"
+    assert sent == [(get_msg("privacy_deleted", "en"), None)]
+    db = database.get_db()
+    assert db.execute("SELECT COUNT(*) FROM leads WHERE phone = ?", (phone,)).fetchone()[0] == 0
+    # Lead-Mail (noch offen) ist mit den Daten gelöscht
+    assert db.execute("SELECT COUNT(*) FROM outbox WHERE phone = ?", (phone,)).fetchone()[0] == 0
+
+
+def test_lead_json_states_are_reachable():
+    flow = Flow.load()
+    targets = {flow.start} | {s for t in flow.transitions for s in (t.next, t.goto) if s}
+    assert flow.states <= targets | {"COMPLETED"}
+    # COMPLETED wird von finalize_lead gesetzt, nicht per next
+    assert any(a.get("call") == "finalize_lead" for t in flow.transitions for a in t.actions)
+    assert all(t.state in flow.states or t.state == GLOBAL for t in flow.transitions)
+
+
+@pytest.mark.parametrize("rows, error", [
+    ([{"state": "A", "on": "else", "next": "B"}], "unknown state"),
+    ([{"state": "A", "on": "command:STOP"}, {"state": "A", "on": "command:STOP"}], "duplicate matcher"),
+    ([{"state": "A", "on": "shake"}], "unknown matcher"),
+    ([{"state": "A", "on": "else", "do": [{"call": "nope"}]}], "unknown action"),
+    ([{"state": "A", "on": "else", "do": [{"prompt": "nope"}]}], "unknown prompt"),
+    ([{"state": "A", "on": "check:nope"}], "unknown check"),
+])
+def test_invalid_flow_is_rejected(rows, error):
+    with pytest.raises(ValueError, match=error):
+        Flow({"transitions": rows})
@@ -0,0 +1,148 @@
+import asyncio
+import json
+
+import pytest
+
+import main
+from backends import MemoryBackend
+from dedup import DedupCache
+from ingest import IngestQueue
+from ratelimit import RateLimiter
+
+
+class _Request:
+    def __init__(self, body):
+        self._body = body
+        self.headers = {}
+
+    async def body(self):
+        return self._body
+
+
+def _webhook_body(phone, msg_id, text="hi"):
+    return json.dumps({"entry": [{"changes": [{"value": {
+        "contacts": [{"wa_id": phone, "profile": {"name": "Max"}}],
+        "messages": [{"from": phone, "id": msg_id, "text": {"body": text}}],
+    }}]}]}).encode()
+
+
+def test_submit_beyond_max_depth_is_refused(run):
+    gate = asyncio.Event()
+    handled = []
+
+    async def handler(phone, *args):
+        await gate.wait()
+        handled.append((phone, *args))
+
+    async def scenario():
+        queue = IngestQueue(handler, workers=1, max_depth=2, overflow="drop")
+        queue.start()
+        accepted = [queue.submit("491", "a"), queue.submit("492", "b"), queue.submit("493", "c")]
+        full = queue.full()
+        gate.set()
+        await queue.stop(timeout=1)
+        return accepted, full, queue.stats()
+
+    accepted, full, stats = run(scenario())
+    assert accepted == [True, True, False]
+    assert full
+    assert stats["overflowed"] == 1 and stats["processed"] == 2
+    assert sorted(handled) == [("491", "a"), ("492", "b")]
+
+
+def test_stopped_queue_refuses_and_drains(run):
+    async def handler(phone, *args):
+        await asyncio.sleep(0.01)
+
+    async def scenario():
+        queue = IngestQueue(handler, workers=2, max_depth=10, overflow="reject")
+        queue.start()
+        for i in range(5):
+            queue.submit(f"49{i}", i)
+        await queue.stop(timeout=1)
+        return queue.submit("499", 9), queue.stats()
+
+    accepted, stats = run(scenario())
+    assert not accepted
+    assert stats["processed"] == 5 and stats["depth"] == 0
+
+
+@pytest.fixture
+def webhook(monkeypatch):
+    """main._webhook with its own queue, a shared dedup cache and no rate limit.
+    The backend claim fills the queue while the webhook waits on it (depth 1)."""
+    gate = asyncio.Event()
+    handled = []
+
+    async def handler(phone, text, msg_id, name):
+        await gate.wait()
+        handled.append(msg_id)
+
+    queue = IngestQueue(handler, workers=1, max_depth=1, overflow="reject")
+    backend = MemoryBackend()
+    backend.shared = True
+    claim = backend.claim_messages
+
+    async def racing_claim(msg_ids):
+        if not queue.full():
+            queue.submit("4900", "other", "other-msg", "Other")
+        return await claim(msg_ids)
+
+    backend.claim_messages = racing_claim
+    cache = DedupCache(backend)
+    monkeypatch.setattr(main, "ingest", queue)
+    monkeypatch.setattr(main, "dedup", cache)
+    monkeypatch.setattr(main, "limiter", RateLimiter(per_minute=0, global_rate=0))
+    return queue, cache, backend, gate, handled
+
+
+def test_reject_mode_releases_claim_and_answers_503(webhook, run):
+    queue, cache, backend, gate, handled = webhook
+
+    async def scenario():
+        queue.start()
+        first = await main._webhook(_Request(_webhook_body("4911", "wamid.rej")))
+        gate.set()
+        await asyncio.sleep(0.05)
+        # Metas Redelivery derselben Nachricht wird jetzt verarbeitet
+        backend.claim_messages = MemoryBackend.claim_messages.__get__(backend)
+        second = await main._webhook(_Request(_webhook_body("4911", "wamid.rej")))
+        await queue.stop(timeout=1)
+        return first, second
+
+    first, second = run(scenario())
+    assert first.status_code == 503
+    assert second == {"status": "ok"}
+    assert handled == ["other-msg", "wamid.rej"]
+    assert queue.overflowed == 1
+
+
+def test_drop_mode_answers_200_and_keeps_claim(webhook, run):
+    queue, cache, backend, gate, handled = webhook
+    queue.overflow = "drop"
+
+    async def scenario():
+        queue.start()
+        response = await main._webhook(_Request(_webhook_body("4912", "wamid.drop")))
+        gate.set()
+        await queue.stop(timeout=1)
+        return response, await cache.filter_new(["wamid.drop"])
+
+    response, again = run(scenario())
+    assert response == {"status": "ok"}
+    assert again == []
+    assert handled == ["other-msg"]
+    assert queue.overflowed == 1
+
+
+def test_full_queue_rejects_before_dedup(webhook, run):
+    queue, cache, _, _, _ = webhook
+
+    async def scenario():
+        # Queue nicht gestartet = nimmt nichts an
+        response = await main._webhook(_Request(_webhook_body("4913", "wamid.full")))
+        return response, await cache.filter_new(["wamid.full"])
+
+    response, new = run(scenario())
+    assert response.status_code == 503
+    assert new == ["wamid.full"]
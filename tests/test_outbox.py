@@ -0,0 +1,155 @@
+import asyncio
+import json
+
+import pytest
+
+import database
+import outbox
+from outbox import OutboxWorker, PermanentError
+
+
+def _rows(idem_prefix):
+    db = database.get_db()
+    return [dict(r) for r in db.execute(
+        "SELECT kind, idem_key, status, attempts, last_error FROM outbox WHERE idem_key LIKE ? ORDER BY id",
+        (idem_prefix + "%",))]
+
+
+def _make_due(idem_key):
+    db = database.get_db()
+    db.execute("UPDATE outbox SET next_attempt_at = 0 WHERE idem_key = ?", (idem_key,))
+    db.commit()
+
+
+def _enqueue(kind, idem_key, payload, phone=None):
+    database.write_sync(database._enqueue_outbox, kind, idem_key, payload, phone)
+
+
+async def _drain(worker):
+    await worker.drain_once()
+    await asyncio.gather(*list(worker._inflight))
+
+
+@pytest.fixture(autouse=True)
+def empty_outbox():
+    # Der Worker claimt alles Fällige, auch Zeilen anderer Tests
+    database.write_sync(lambda db: db.execute("DELETE FROM outbox"))
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """Register a scripted handler for kind 'test': results are popped per attempt."""
+    results = []
+
+    async def deliver(payload, idem_key):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setitem(outbox._HANDLERS, "test", deliver)
+    return results
+
+
+def test_failed_delivery_is_retried_with_backoff(handler, run):
+    handler.extend([(False, "smtp 451", None), (True, None, None)])
+    _enqueue("test", "test:retry", {})
+    worker = OutboxWorker(max_attempts=5)
+
+    async def scenario():
+        await _drain(worker)
+        after_failure = _rows("test:retry")
+        # Backoff: vor next_attempt_at wird nichts geclaimt
+        assert await worker.drain_once() == 0
+        _make_due("test:retry")
+        await _drain(worker)
+        return after_failure, _rows("test:retry")
+
+    after_failure, after_retry = run(scenario())
+    assert after_failure == [{"kind": "test", "idem_key": "test:retry", "status": "pending",
+                              "attempts": 1, "last_error": "smtp 451"}]
+    assert after_retry[0]["status"] == "done" and after_retry[0]["attempts"] == 2
+    assert (worker.failed, worker.delivered, worker.dead) == (1, 1, 0)
+
+
+def test_exceptions_count_as_failed_attempts(handler, run):
+    handler.append(RuntimeError("boom"))
+    _enqueue("test", "test:raise", {})
+    worker = OutboxWorker(max_attempts=5)
+    run(_drain(worker))
+    row, = _rows("test:raise")
+    assert row["status"] == "pending" and row["last_error"] == "RuntimeError: boom"
+
+
+def test_dead_letter_after_max_attempts(handler, run):
+    handler.extend([(False, "e1", None), (False, "e2", None)])
+    _enqueue("test", "test:dead", {})
+    worker = OutboxWorker(max_attempts=2)
+
+    async def scenario():
+        await _drain(worker)
+        _make_due("test:dead")
+        await _drain(worker)
+        _make_due("test:dead")
+        # Dead-Letter werden nicht mehr geclaimt
+        return await worker.drain_once()
+
+    assert run(scenario()) == 0
+    row, = _rows("test:dead")
+    assert row["status"] == "dead" and row["attempts"] == 2 and row["last_error"] == "e2"
+    assert worker.dead == 1
+
+
+def test_permanent_error_dead_letters_at_once(handler, run):
+    handler.append(PermanentError("not configured"))
+    _enqueue("test", "test:permanent", {})
+    worker = OutboxWorker(max_attempts=8)
+    run(_drain(worker))
+    row, = _rows("test:permanent")
+    assert row["status"] == "dead" and row["attempts"] == 1
+
+
+def test_dead_lead_mail_queues_user_notice(monkeypatch, run):
+    async def failing(payload, idem_key):
+        return False, "mailbox full", None
+
+    monkeypatch.setitem(outbox._HANDLERS, "lead_email", failing)
+    _enqueue("lead_email", "lead_email:wamid.dead", {"phone": "4931", "lang": "de", "lead": {}}, "4931")
+    worker = OutboxWorker(max_attempts=1)
+    run(_drain(worker))
+
+    lead, notice = _rows("lead_email:wamid.dead")
+    assert lead["status"] == "dead"
+    assert notice["kind"] == "whatsapp" and notice["idem_key"] == "lead_email:wamid.dead:failed"
+    payload = json.loads(database.get_db().execute(
+        "SELECT payload FROM outbox WHERE idem_key = ?", (notice["idem_key"],)).fetchone()[0])
+    assert payload["to"] == "4931" and "mailbox full" in payload["text"]
+
+
+def test_deleted_row_is_not_requeued(handler, run):
+    gate = asyncio.Event()
+
+    async def slow(payload, idem_key):
+        await gate.wait()
+        return False, "timeout", None
+
+    outbox._HANDLERS["test"] = slow
+    _enqueue("test", "test:deleted", {}, "4932")
+    worker = OutboxWorker(max_attempts=1)
+
+    async def scenario():
+        await worker.drain_once()
+        await asyncio.sleep(0)
+        await database.delete_user_data("4932")
+        gate.set()
+        await asyncio.gather(*list(worker._inflight))
+
+    run(scenario())
+    assert _rows("test:deleted") == []
+    assert worker.dead == 0
+
+
+def test_same_idempotency_key_is_queued_once(run):
+    _enqueue("test", "test:once", {"n": 1})
+    _enqueue("test", "test:once", {"n": 2})
+    assert len(_rows("test:once")) == 1
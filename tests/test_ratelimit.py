@@ -0,0 +1,69 @@
+from ratelimit import ALLOW, DROP, NOTIFY, RateLimiter, TokenBucket
+
+
+def _limiter(**kw):
+    # 6/min = 0.1 Token/s; ein leerer Bucket ist nach 20 s wieder voll
+    return RateLimiter(**{"per_minute": 6, "burst": 2, "global_rate": 0, "notice_window": 10,
+                          "max_phones": 3, **kw})
+
+
+def test_burst_then_one_notice_then_drop():
+    limiter = _limiter()
+    verdicts = [limiter.check("491", now=0.0) for _ in range(4)]
+    assert verdicts == [ALLOW, ALLOW, NOTIFY, DROP]
+    # Nach 10 s ist ein Token nachgefüllt
+    assert limiter.check("491", now=10.0) == ALLOW
+
+
+def test_idle_bucket_is_evicted():
+    limiter = _limiter()
+    limiter.check("491", now=0.0)
+    limiter.check("492", now=15.0)
+    assert limiter.stats()["phones"] == 2
+    # 491 ist seit 20 s inaktiv -> voll, ohne Zustand -> verschwindet beim nächsten neuen Bucket
+    limiter.check("493", now=20.0)
+    assert set(limiter._phones) == {"492", "493"}
+
+
+def test_throttled_bucket_survives_until_it_is_full_again():
+    limiter = _limiter()
+    for _ in range(4):
+        limiter.check("491", now=0.0)
+    limiter.check("492", now=5.0)
+    # Noch gedrosselt und im Hinweisfenster: kein neuer Hinweis, keine Tokens geschenkt
+    assert limiter.check("491", now=6.0) == DROP
+    assert "491" in limiter._phones
+
+
+def test_lru_eviction_beyond_max_phones():
+    limiter = _limiter()
+    for i, phone in enumerate(["491", "492", "493"]):
+        limiter.check(phone, now=float(i))
+    limiter.check("491", now=3.0)  # 491 wieder aktiv, 492 ist jetzt am längsten inaktiv
+    limiter.check("494", now=4.0)
+    assert list(limiter._phones) == ["493", "491", "494"]
+    assert limiter.stats()["phones"] == 3
+
+
+def test_disabled_limits_allow_everything():
+    limiter = _limiter(per_minute=0)
+    assert all(limiter.check("491", now=0.0) == ALLOW for _ in range(100))
+    assert limiter.allow_global(1000)
+    assert limiter.stats()["phones"] == 0
+
+
+def test_global_bucket_sheds_whole_deliveries():
+    limiter = _limiter(global_rate=10, global_burst=5)
+    limiter._global.updated = 0.0
+    assert limiter.allow_global(5, now=0.0)
+    assert not limiter.allow_global(1, now=0.0)
+    assert limiter.allow_global(1, now=0.1)
+    assert limiter.stats()["shed"] == 1
+
+
+def test_token_bucket_refill_is_capped_at_burst():
+    bucket = TokenBucket(rate=1, burst=3)
+    bucket.updated = 0.0
+    assert bucket.take(3, now=0.0)
+    assert bucket.take(3, now=1000.0)
+    assert not bucket.take(1, now=1000.0)
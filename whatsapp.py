@@ -0,0 +1,259 @@
+"""
+Outbound WhatsApp dispatcher.
+
+One long-lived httpx client (keep-alive, optional HTTP/2) shared by all sends,
+a global concurrency cap, strict ordering per recipient and backoff on
+Graph API 429/5xx responses driven by the error payload.
+"""
+
+import asyncio
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass
+
+import httpx
+from config import Config
+import metrics
+import delivery
+from phone_locks import PhoneLocks
+
+logger = logging.getLogger(__name__)
+
+URL = f"{Config.GRAPH_API_URL}/{Config.PHONE_NUMBER_ID}/messages"
+
+# Graph API error codes, bei denen ein erneuter Versuch sinnvoll ist.
+# Wert = minimale Wartezeit in Sekunden, falls kein Retry-After mitkommt.
+RETRYABLE_CODES = {
+    1: 1.0,          # API Unknown
+    2: 1.0,          # API Service (temporarily unavailable)
+    4: 5.0,          # Application request limit reached
+    80007: 5.0,      # WhatsApp Business Account rate limit
+    130429: 2.0,     # Cloud API throughput reached
+    131000: 1.0,     # Something went wrong
+    131016: 2.0,     # Service unavailable
+    131056: 6.0,     # Pair rate limit (same sender -> same recipient)
+}
+
+# Diese Codes drosseln die ganze Nummer/App, nicht nur einen Empfänger
+GLOBAL_THROTTLE_CODES = {4, 80007, 130429}
+
+
+@dataclass
+class SendResult:
+    ok: bool
+    status: int | None = None
+    message_id: str | None = None
+    error: str | None = None
+    error_code: int | None = None
+    attempts: int = 0
+
+    def __bool__(self):
+        return self.ok
+
+
+def build_message(to, text, buttons=None):
+    """Build a Graph API text or reply-button payload."""
+    text = text[:4090]
+
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "text",
+        "text": {"body": text}
+    }
+
+    if buttons:
+        payload["type"] = "interactive"
+        payload["interactive"] = {
+            "type": "button",
+            "body": {"text": text},
+            "action": {"buttons": []}
+        }
+        for b_text in buttons:
+            # ID safe machen und Länge begrenzen
+            b_id = re.sub(r'\W+', '', b_text)[:20]
+            payload["interactive"]["action"]["buttons"].append({
+                "type": "reply",
+                "reply": {"id": b_id, "title": b_text[:20]}
+            })
+
+    return payload
+
+
+def build_template(to, name, language, params=()):
+    """Build a Graph API template payload (approved template, required outside the 24h window)."""
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to,
+        "type": "template",
+        "template": {"name": name, "language": {"code": language}},
+    }
+    if params:
+        payload["template"]["components"] = [{
+            "type": "body",
+            "parameters": [{"type": "text", "text": str(p)} for p in params],
+        }]
+    return payload
+
+
+def _parse_error(response):
+    """Return (code, message) from a Graph API error body."""
+    try:
+        err = response.json().get("error", {})
+        return err.get("code"), err.get("message")
+    except Exception:
+        return None, response.text[:200]
+
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class WhatsAppDispatcher:
+    """Shared outbound sender. Use the module-level `dispatcher` instance."""
+
+    def __init__(self, url=URL, token=None, max_concurrency=None, max_retries=None,
+                 http2=None, timeout=None):
+        self.url = url
+        self.token = token
+        self.max_concurrency = max_concurrency or Config.WA_MAX_CONCURRENCY
+        self.max_retries = Config.WA_MAX_RETRIES if max_retries is None else max_retries
+        self.http2 = Config.WA_HTTP2 if http2 is None else http2
+        self.timeout = timeout or Config.WA_TIMEOUT
+
+        self._client = None
+        self._sem = asyncio.Semaphore(self.max_concurrency)
+        # Sendereihenfolge pro Empfänger
+        self._recipients = PhoneLocks()
+        self._paused_until = 0.0
+        self.throttled = 0  # Anzahl globaler Pausen (Broadcasts drosseln sich daran)
+
+    async def start(self):
+        if self._client is not None:
+            return
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("WA_HTTP2 enabled but 'h2' is not installed, falling back to HTTP/1.1")
+                http2 = False
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_concurrency,
+                max_keepalive_connections=self.max_concurrency,
+                keepalive_expiry=60,
+            ),
+            headers={
+                "Authorization": f"Bearer {self.token or Config.WHATSAPP_TOKEN}",
+                "Content-Type": "application/json",
+            },
+        )
+
+    async def warm(self):
+        """Open the connection (TLS, HTTP/2) ahead of the first send with a cheap GET on the phone number."""
+        await self.start()
+        try:
+            response = await self._client.get(self.url.rsplit("/", 1)[0], params={"fields": "id"})
+        except httpx.HTTPError as e:
+            logger.warning(f"Graph API pre-connect failed: {type(e).__name__}: {e}")
+            return False
+        if response.status_code >= 400:
+            # Verbindung steht trotzdem; meist falscher Token oder falsche PHONE_NUMBER_ID
+            code, error = _parse_error(response)
+            logger.warning(f"Graph API pre-connect: {response.status_code} {error}")
+        return True
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send(self, to, payload):
+        """Send one payload. Messages to the same recipient go out in call order."""
+        if self._client is None:
+            await self.start()
+
+        async with self._recipients.lock(to):
+            result = await self._post_with_retry(payload)
+
+        if result.ok:
+            delivery.tracker.sent(result.message_id, to)
+        else:
+            logger.warning(f"Failed to send WA to {to}: {result.status} {result.error} "
+                           f"(after {result.attempts} attempts)")
+        return result
+
+    async def _post_with_retry(self, payload):
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._wait_for_global_pause()
+
+            async with self._sem:
+                started = time.perf_counter()
+                try:
+                    response = await self._client.post(self.url, json=payload)
+                    status = str(response.status_code)
+                except httpx.HTTPError as e:
+                    response = None
+                    error = f"{type(e).__name__}: {e}"
+                    status = "error"
+                metrics.GRAPH_REQUEST_SECONDS.observe(time.perf_counter() - started)
+                metrics.GRAPH_RESPONSES.labels(status).inc()
+
+            if response is not None:
+                if response.status_code < 400:
+                    message_id = None
+                    try:
+                        message_id = response.json()["messages"][0]["id"]
+                    except Exception:
+                        pass
+                    return SendResult(True, response.status_code, message_id, attempts=attempt)
+
+                code, error = _parse_error(response)
+                retryable = response.status_code == 429 or response.status_code >= 500 or code in RETRYABLE_CODES
+                if not retryable or attempt > self.max_retries:
+                    return SendResult(False, response.status_code, error=error, error_code=code, attempts=attempt)
+                delay = self._backoff(attempt, response, code)
+            else:
+                if attempt > self.max_retries:
+                    return SendResult(False, error=error, attempts=attempt)
+                delay = self._backoff(attempt)
+
+            await asyncio.sleep(delay)
+
+    def _backoff(self, attempt, response=None, code=None):
+        """Exponential backoff with jitter, raised to Retry-After / error-code minimums."""
+        delay = min(Config.WA_BACKOFF_MAX, Config.WA_BACKOFF_BASE * 2 ** (attempt - 1))
+        delay *= 0.5 + random.random() / 2
+
+        if response is not None:
+            delay = max(delay, RETRYABLE_CODES.get(code, 0.0))
+            retry_after = _retry_after(response)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if code in GLOBAL_THROTTLE_CODES or (response.status_code == 429 and code not in RETRYABLE_CODES):
+                # Ganze App gedrosselt -> alle Sends pausieren, nicht nur diesen
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.throttled += 1
+
+        return delay
+
+    async def _wait_for_global_pause(self):
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+dispatcher = WhatsAppDispatcher()
@@ -0,0 +1,45 @@
+"""
+Write-behind base for in-memory buffers (dedup IDs, sessions, delivery statuses).
+
+Changes are only recorded in memory; a background task calls flush() every
+`flush_interval` seconds or as soon as flush_soon() was called, and stop()
+flushes once more. flush() takes a snapshot of the buffer and swaps in an
+empty one without an await in between, so changes made while the write is
+running land in the next flush; on failure it puts the snapshot back.
+"""
+
+import asyncio
+
+
+class WriteBehind:
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._flush_now = asyncio.Event()
+        self._task = None
+
+    def flush_soon(self):
+        """Wake the flusher before the interval ends (buffer over its threshold)."""
+        self._flush_now.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flusher())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()